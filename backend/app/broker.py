@@ -0,0 +1,137 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Optional
+
+from .logger import logger
+
+# "memory://" keeps delivery inside this process, "redis://host:6379/0" fans
+# out to every worker and replica subscribed to the same redis
+BROKER_URL = os.getenv("BROKER_URL", "memory://")
+
+# returns whether the message reached a socket
+Handler = Callable[[str], Awaitable[bool]]
+
+
+class Broker:
+    """Pub/sub between app processes, one channel per recipient.
+
+    A process subscribes to a channel while it holds a socket for it, and
+    anyone can publish to it. `publish` returns how many subscribers got the
+    message, 0 means nobody anywhere is listening. Across processes that is
+    only known up to the subscriber, not the socket.
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, message: str) -> int:
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+
+class InMemoryBroker(Broker):
+    """Single process broker, publishing is a direct call to the local handler."""
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+
+    async def publish(self, channel: str, message: str) -> int:
+        handler = self._handlers.get(channel)
+        if handler is None:
+            return 0
+        return 1 if await handler(message) else 0
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self._handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self._handlers.pop(channel, None)
+
+
+class RedisBroker(Broker):
+    """Redis pub/sub broker, every worker delivers to the sockets it holds."""
+
+    def __init__(self, url: str, client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError as e:
+                raise RuntimeError(
+                    f"BROKER_URL is {url!r} but the 'redis' package is not installed"
+                ) from e
+            client = redis.from_url(url, decode_responses=True)
+        self._redis = client
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._handlers: Dict[str, Handler] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # fail at startup rather than on the first message
+        await self._redis.ping()
+        logger.info("Connected to the redis message broker.")
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        await self._pubsub.aclose()
+        await self._redis.aclose()
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self._redis.publish(channel, message)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self._handlers[channel] = handler
+        await self._pubsub.subscribe(channel)
+        # the pubsub connection only exists after the first subscribe
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read())
+
+    async def unsubscribe(self, channel: str):
+        self._handlers.pop(channel, None)
+        await self._pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Reading from the redis broker failed: %s", e, exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+
+            handler = self._handlers.get(message["channel"])
+            if handler is None:
+                continue
+            try:
+                await handler(message["data"])
+            except Exception as e:
+                logger.error(
+                    "Delivering a broker message on '%s' failed: %s",
+                    message['channel'], e,
+                    exc_info=True,
+                )
+
+
+def create_broker(url: str = BROKER_URL) -> Broker:
+    if url.startswith("memory://"):
+        return InMemoryBroker()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported BROKER_URL: {url!r}")
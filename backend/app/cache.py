@@ -0,0 +1,224 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+# misses are cached too, but briefly: a user can register on another worker
+USER_CACHE_NEGATIVE_TTL_SECONDS = float(
+    os.getenv("USER_CACHE_NEGATIVE_TTL_SECONDS", "5")
+)
+# verified access tokens kept per process, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+# returned by lookups that have nothing cached, `None` means "cached: no such user"
+MISSING = object()
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Detached snapshot of a `models.User` row, safe to share between sessions."""
+
+    id: int
+    username: str
+    name: str
+    hashed_password: str
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+class UserCache:
+    """LRU + TTL cache of user records, keyed by username and by id.
+
+    Sync routes run in a threadpool, so every operation takes a lock.
+    """
+
+    def __init__(
+        self,
+        max_size: int = USER_CACHE_SIZE,
+        ttl: float = USER_CACHE_TTL_SECONDS,
+        negative_ttl: float = USER_CACHE_NEGATIVE_TTL_SECONDS,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._by_username: OrderedDict = OrderedDict()
+        self._by_id: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = CacheStats()
+
+    def get_by_username(self, username: str):
+        return self._get(self._by_username, username)
+
+    def get_by_id(self, user_id: int):
+        return self._get(self._by_id, user_id)
+
+    def put_by_username(self, username: str, user) -> Optional[CachedUser]:
+        """Caches a lookup result (a user or `None`), returns what callers should use."""
+        cached = self._snapshot(user)
+        with self._lock:
+            self._put(self._by_username, username, cached)
+            if cached is not None:
+                self._put(self._by_id, cached.id, cached)
+        return cached
+
+    def put_by_id(self, user_id: int, user) -> Optional[CachedUser]:
+        cached = self._snapshot(user)
+        with self._lock:
+            self._put(self._by_id, user_id, cached)
+            if cached is not None:
+                self._put(self._by_username, cached.username, cached)
+        return cached
+
+    def invalidate(self, username: Optional[str] = None, user_id: Optional[int] = None):
+        """Drops a user, call it whenever a user row is created or changed."""
+        with self._lock:
+            for key, entries in ((username, self._by_username), (user_id, self._by_id)):
+                if key is None:
+                    continue
+                entry = entries.pop(key, None)
+                if entry is None:
+                    continue
+                self._stats.invalidations += 1
+                cached = entry[1]
+                # drop the entry under the other key as well
+                if cached is not None:
+                    self._by_username.pop(cached.username, None)
+                    self._by_id.pop(cached.id, None)
+
+    def clear(self):
+        with self._lock:
+            self._by_username.clear()
+            self._by_id.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **asdict(self._stats),
+                "size": len(self._by_username),
+                "max_size": self.max_size,
+            }
+
+    def _get(self, entries: OrderedDict, key):
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None:
+                self._stats.misses += 1
+                return MISSING
+            expires_at, cached = entry
+            if expires_at < time.monotonic():
+                del entries[key]
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return MISSING
+            entries.move_to_end(key)
+            self._stats.hits += 1
+            return cached
+
+    def _put(self, entries: OrderedDict, key, cached: Optional[CachedUser]):
+        ttl = self.ttl if cached is not None else self.negative_ttl
+        entries[key] = (time.monotonic() + ttl, cached)
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self._stats.evictions += 1
+
+    @staticmethod
+    def _snapshot(user) -> Optional[CachedUser]:
+        if user is None or isinstance(user, CachedUser):
+            return user
+        return CachedUser(
+            id=user.id,
+            username=user.username,
+            name=user.name,
+            hashed_password=user.hashed_password,
+        )
+
+
+class TokenCache:
+    """LRU cache of verified access token claims, plus the set of revoked tokens.
+
+    Keys are sha256 digests of the token, entries expire at the token's own
+    `exp` so a cache hit never outlives the signature check it stands for.
+    Revoked tokens are remembered until their `exp` as well.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._verified: OrderedDict = OrderedDict()
+        self._revoked: dict = {}
+        self._lock = threading.Lock()
+        self._stats = CacheStats()
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, key: bytes):
+        """The claims of a verified token, `None` if revoked, `MISSING` if unknown."""
+        with self._lock:
+            if key in self._revoked:
+                return None
+            entry = self._verified.get(key)
+            if entry is None:
+                self._stats.misses += 1
+                return MISSING
+            expires_at, claims = entry
+            if expires_at <= time.time():
+                del self._verified[key]
+                self._stats.expirations += 1
+                self._stats.misses += 1
+                return MISSING
+            self._verified.move_to_end(key)
+            self._stats.hits += 1
+            return claims
+
+    def put(self, key: bytes, claims, expires_at: float):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if key in self._revoked:
+                return
+            self._verified[key] = (expires_at, claims)
+            self._verified.move_to_end(key)
+            while len(self._verified) > self.max_size:
+                self._verified.popitem(last=False)
+                self._stats.evictions += 1
+
+    def revoke(self, key: bytes, expires_at: float):
+        with self._lock:
+            now = time.time()
+            # forget revocations of tokens that expired anyway
+            if len(self._revoked) >= self.max_size:
+                self._revoked = {k: exp for k, exp in self._revoked.items() if exp > now}
+            self._revoked[key] = expires_at
+            if self._verified.pop(key, None) is not None:
+                self._stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._verified.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **asdict(self._stats),
+                "size": len(self._verified),
+                "max_size": self.max_size,
+                "revoked": len(self._revoked),
+            }
+
+
+user_cache = UserCache()
+token_cache = TokenCache()
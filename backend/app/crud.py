@@ -1,150 +1,389 @@
+import json
+import zlib
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
-from sqlalchemy import and_, or_
+from sqlalchemy import (Integer, and_, case, column, func, insert, literal,
+                        literal_column, or_, select, table, tuple_, union_all,
+                        update)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from . import models, schemas, security
+from .cache import MISSING, user_cache
 from .logger import logger
+from .user_index import user_index
 
 
 # INFO: USER FUNCTIONS
 def get_user_by_username(db: Session, username: str):
-    logger.debug(f"Querying user by username: {username}")
+    """Returns a `CachedUser` snapshot (or None), served from the user cache when possible."""
     if not username:
         return None
-    return db.query(models.User).filter(models.User.username == username).first()
+    cached = user_cache.get_by_username(username)
+    if cached is not MISSING:
+        return cached
+    logger.debug("Querying user by username: %s", username)
+    user = db.query(models.User).filter(models.User.username == username).first()
+    return user_cache.put_by_username(username, user)
 
 
 def get_user(db: Session, user_id: int):
-    logger.debug(f"Querying user by id: {user_id}")
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    cached = user_cache.get_by_id(user_id)
+    if cached is not MISSING:
+        return cached
+    logger.debug("Querying user by id: %s", user_id)
+    user = db.query(models.User).filter(models.User.id == user_id).first()
+    return user_cache.put_by_id(user_id, user)
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    logger.info(f"Creating user: {user.username}")
-    hashed_password = security.get_password_hash(user.password)
+def create_user(
+    db: Session, user: schemas.UserCreate, hashed_password: Optional[str] = None
+):
+    """Creates a user, pass `hashed_password` if it was already hashed off-thread."""
+    logger.debug("Creating user: %s", user.username)
+    if hashed_password is None:
+        hashed_password = security.get_password_hash(user.password)
     db_user = models.User(
         username=user.username, name=user.name, hashed_password=hashed_password
     )
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
-    logger.info(f"User {user.username} created successfully.")
+    # drop cached "no such user" entries
+    user_cache.invalidate(username=db_user.username, user_id=db_user.id)
+    user_index.add(db_user.id, db_user.username, db_user.name)
+    logger.debug("User %s created successfully.", user.username)
     return db_user
 
 
+def update_password_hash(db: Session, username: str, hashed_password: str):
+    """Replaces a user's password hash, e.g. after the bcrypt cost changed."""
+    logger.debug("Updating the password hash of user: %s", username)
+    db.query(models.User).filter(models.User.username == username).update(
+        {"hashed_password": hashed_password}
+    )
+    db.commit()
+    user_cache.invalidate(username=username)
+
+
+def _fts_phrase(term: str) -> str:
+    """Quotes user input as an FTS5 string, so its syntax characters are plain text."""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _fts_participant(username: str) -> str:
+    """The `messages_fts.participants` token of a user, see `models.SQLITE_MESSAGE_PARTICIPANTS`."""
+    return "u" + username.encode().hex().upper()
+
+
+# trigrams need at least three characters, shorter queries can't use users_fts
+MIN_TRIGRAM_QUERY_LENGTH = 3
+
+
 def search_users(db: Session, username_query: str):
-    logger.debug(f"Searching users with query: {username_query}")
+    """Users whose username or name contains the query, case-insensitively.
+
+    On SQLite a query of three or more characters goes through the `users_fts`
+    trigram index, on postgres the pg_trgm indexes serve the `ilike` directly.
+    """
+    logger.debug("Searching users with query: %s", username_query)
     if not username_query:
         return []
-    return (
-        db.query(models.User)
-        .filter(
-            or_(
-                models.User.username.ilike(f"%{username_query}%"),
-                models.User.name.ilike(f"%{username_query}%"),
-            )
+    query = db.query(models.User)
+    if (
+        db.get_bind().dialect.name == "sqlite"
+        and len(username_query) >= MIN_TRIGRAM_QUERY_LENGTH
+    ):
+        users_fts = table("users_fts", column("rowid", Integer))
+        return (
+            query.join(users_fts, users_fts.c.rowid == models.User.id)
+            .filter(literal_column("users_fts").op("MATCH")(_fts_phrase(username_query)))
+            .all()
         )
-        .all()
-    )
+    return query.filter(
+        or_(
+            models.User.username.ilike(f"%{username_query}%"),
+            models.User.name.ilike(f"%{username_query}%"),
+        )
+    ).all()
 
 
 # INFO: MESSAGE FUNCTIONS
 def create_message(db: Session, message: schemas.MessageCreate):
-    logger.debug(f"Creating message from {message.sender} to {message.recipient}")
+    logger.debug("Creating message from %s to %s", message.sender, message.recipient)
     db_message = models.Message(**message.model_dump())
     db.add(db_message)
+    # flush to get the id, the conversation state is updated in the same transaction
+    db.flush()
+    db.execute(
+        conversation_state_upsert(db.get_bind().dialect.name),
+        conversation_state_rows([db_message]),
+    )
     db.commit()
     db.refresh(db_message)
     return db_message
 
 
-def get_conversations(db: Session, username: str):
-    logger.debug(f"Fetching conversations for user: {username}")
-    # Get all unique contacts for the user
-    contacts = (
-        db.query(models.Message.recipient.label("contact"))
-        .filter(models.Message.sender == username)
-        .distinct()
-        .union(
-            db.query(models.Message.sender.label("contact"))
-            .filter(models.Message.recipient == username)
-            .distinct()
-        )
+def create_messages(db: Session, messages: List[schemas.MessageCreate]):
+    """Inserts several messages in one transaction, ids follow the list order.
+
+    Nothing is refreshed after the commit, use a session that doesn't expire
+    on commit if the returned objects are read afterwards.
+    """
+    logger.debug("Creating %s messages in one transaction", len(messages))
+    db_messages = [models.Message(**message.model_dump()) for message in messages]
+    db.add_all(db_messages)
+    db.flush()
+    db.execute(
+        conversation_state_upsert(db.get_bind().dialect.name),
+        conversation_state_rows(db_messages),
     )
+    db.commit()
+    return db_messages
 
-    # we only have contact column...
-    contact_usernames = {row.contact for row in contacts}
 
-    if not contact_usernames:
-        return []
+# INFO: ASYNC FUNCTIONS (websocket hot path)
+async def get_user_by_username_async(db: AsyncSession, username: str):
+    if not username:
+        return None
+    cached = user_cache.get_by_username(username)
+    if cached is not MISSING:
+        return cached
+    logger.debug("Querying user by username (async): %s", username)
+    result = await db.execute(
+        select(models.User).where(models.User.username == username).limit(1)
+    )
+    return user_cache.put_by_username(username, result.scalars().first())
 
-    # TODO: improve this and speed up?
-    conversations_data = [
-        get_conversation(db, username, contact_username)
-        for contact_username in contact_usernames
-    ]
 
-    conversations_data = [c for c in conversations_data if c is not None]
+async def create_message_async(db: AsyncSession, message: schemas.MessageCreate):
+    logger.debug(
+        "Creating message (async) from %s to %s", message.sender, message.recipient
+    )
+    db_messages = await create_messages_async(db, [message])
+    return db_messages[0]
+
 
-    # newest contact first
-    conversations_data.sort(
-        key=lambda x: x["last_message_timestamp"]
-        if x["last_message_timestamp"]
-        else datetime.min,
-        reverse=True,
+async def create_messages_async(
+    db: AsyncSession, messages: List[schemas.MessageCreate]
+):
+    logger.debug("Creating %s messages (async) in one transaction", len(messages))
+    db_messages = [models.Message(**message.model_dump()) for message in messages]
+    db.add_all(db_messages)
+    await db.flush()
+    await db.execute(
+        conversation_state_upsert(db.bind.dialect.name),
+        conversation_state_rows(db_messages),
     )
+    # every column is set client side and the session doesn't expire on
+    # commit, so unlike `create_message` there's no need to refresh
+    await db.commit()
+    return db_messages
 
-    return conversations_data
 
+# INFO: CONVERSATION STATE FUNCTIONS
+def _dialect_insert(dialect_name: str):
+    """INSERT construct with ON CONFLICT support for the given dialect."""
+    if dialect_name == "postgresql":
+        return postgresql_insert
+    return sqlite_insert
 
-# TODO: maybe this can be improved
-def get_conversation(db: Session, username: str, contact_username: str):
-    """Gets the conversation details between a user and a contact."""
-    logger.debug(f"Fetching conversation between {username} and {contact_username}")
-    # Get the last message for the conversation
-    last_message = (
-        db.query(models.Message)
-        .filter(
-            or_(
-                and_(
-                    models.Message.sender == username,
-                    models.Message.recipient == contact_username,
-                ),
-                and_(
-                    models.Message.sender == contact_username,
-                    models.Message.recipient == username,
-                ),
-            )
+
+@lru_cache(maxsize=None)
+def conversation_state_upsert(dialect_name: str):
+    """The upsert that folds new messages into `conversation_state`.
+
+    Built once per dialect and executed with the rows from
+    `conversation_state_rows`, the inserted `unread_count` is the increment.
+    Sync and async sessions share it.
+    """
+    state = models.ConversationState.__table__
+    statement = _dialect_insert(dialect_name)(state)
+    excluded = statement.excluded
+    # concurrent writers may commit out of order, never move "last" backwards
+    is_newer = excluded.last_message_id > state.c.last_message_id
+    return statement.on_conflict_do_update(
+        index_elements=[state.c.owner, state.c.contact],
+        set_={
+            "last_message_id": case(
+                (is_newer, excluded.last_message_id), else_=state.c.last_message_id
+            ),
+            "last_message": case(
+                (is_newer, excluded.last_message), else_=state.c.last_message
+            ),
+            "last_message_timestamp": case(
+                (is_newer, excluded.last_message_timestamp),
+                else_=state.c.last_message_timestamp,
+            ),
+            "unread_count": state.c.unread_count + excluded.unread_count,
+        },
+    )
+
+
+def conversation_state_rows(messages: List[models.Message]):
+    """Folds messages into one row per (owner, contact), in id order.
+
+    Each message updates both sides of its conversation, only the recipient's
+    side counts it as unread. Rows are merged up front because Postgres
+    refuses to upsert the same row twice in one statement.
+    """
+    rows = {}
+    for message in sorted(messages, key=lambda m: m.id):
+        unread = 0 if message.is_read else 1
+        if message.sender == message.recipient:
+            sides = [(message.sender, message.recipient, unread)]
+        else:
+            sides = [
+                (message.sender, message.recipient, 0),
+                (message.recipient, message.sender, unread),
+            ]
+        for owner, contact, unread_increment in sides:
+            previous = rows.get((owner, contact))
+            rows[(owner, contact)] = {
+                "owner": owner,
+                "contact": contact,
+                "last_message_id": message.id,
+                "last_message": message.text,
+                "last_message_timestamp": message.timestamp,
+                "unread_count": unread_increment
+                + (previous["unread_count"] if previous else 0),
+            }
+    return list(rows.values())
+
+
+def rebuild_conversation_state(db: Session):
+    """Recomputes the whole `conversation_state` table from `messages`."""
+    logger.info("Rebuilding conversation state from messages")
+    message = models.Message
+    # every message seen from both sides, a message to yourself only once
+    sides = union_all(
+        select(
+            message.sender.label("owner"),
+            message.recipient.label("contact"),
+            message.id,
+            message.text,
+            message.timestamp,
+            literal(0).label("unread"),
+        ).where(message.sender != message.recipient),
+        select(
+            message.recipient.label("owner"),
+            message.sender.label("contact"),
+            message.id,
+            message.text,
+            message.timestamp,
+            case((message.is_read == False, 1), else_=0).label("unread"),
+        ),
+    ).subquery()
+
+    partition = (sides.c.owner, sides.c.contact)
+    ranked = select(
+        sides.c.owner,
+        sides.c.contact,
+        sides.c.id,
+        sides.c.text,
+        sides.c.timestamp,
+        func.sum(sides.c.unread).over(partition_by=partition).label("unread_count"),
+        func.row_number()
+        .over(partition_by=partition, order_by=sides.c.id.desc())
+        .label("position"),
+    ).subquery()
+
+    state = models.ConversationState
+    db.query(state).delete()
+    db.execute(
+        insert(state).from_select(
+            [
+                state.owner,
+                state.contact,
+                state.last_message_id,
+                state.last_message,
+                state.last_message_timestamp,
+                state.unread_count,
+            ],
+            select(
+                ranked.c.owner,
+                ranked.c.contact,
+                ranked.c.id,
+                ranked.c.text,
+                ranked.c.timestamp,
+                ranked.c.unread_count,
+            ).where(ranked.c.position == 1),
         )
-        .order_by(models.Message.timestamp.desc())
-        .first()
     )
+    db.commit()
+    rebuilt = db.query(state).count()
+    logger.info("Conversation state rebuilt with %s rows.", rebuilt)
+    return rebuilt
 
-    # Get unread message count
-    unread_count = (
-        db.query(models.Message)
-        .filter(
-            models.Message.sender == contact_username,
-            models.Message.recipient == username,
-            models.Message.is_read == False,
+
+def _conversation_rows(db: Session, username: str):
+    state = models.ConversationState
+    return (
+        db.query(
+            models.User.username,
+            models.User.name,
+            state.last_message_id,
+            state.last_message,
+            state.last_message_timestamp,
+            state.unread_count,
         )
-        .count()
+        .join(models.User, models.User.username == state.contact)
+        .filter(state.owner == username)
     )
 
-    contact_user = (
-        db.query(models.User).filter(models.User.username == contact_username).first()
+
+def _conversation_dict(row):
+    return {
+        "username": row.username,
+        "name": row.name,
+        "last_message_id": row.last_message_id,
+        "last_message": row.last_message,
+        "last_message_timestamp": row.last_message_timestamp,
+        "unread_count": row.unread_count,
+    }
+
+
+def get_conversations(db: Session, username: str):
+    logger.debug("Fetching conversations for user: %s", username)
+    rows = (
+        _conversation_rows(db, username)
+        # newest contact first
+        .order_by(models.ConversationState.last_message_timestamp.desc())
+        .all()
     )
+    return [_conversation_dict(row) for row in rows]
+
+
+def get_conversation(db: Session, username: str, contact_username: str):
+    """Gets the conversation details between a user and a contact."""
+    logger.debug("Fetching conversation between %s and %s", username, contact_username)
+    row = (
+        _conversation_rows(db, username)
+        .filter(models.ConversationState.contact == contact_username)
+        .first()
+    )
+    if row:
+        return _conversation_dict(row)
+
+    # no messages exchanged yet
+    contact_user = get_user_by_username(db, contact_username)
     if contact_user:
         return {
             "username": contact_user.username,
             "name": contact_user.name,
-            "last_message": last_message.text if last_message else None,
-            "last_message_timestamp": last_message.timestamp if last_message else None,
-            "unread_count": unread_count,
+            "last_message_id": None,
+            "last_message": None,
+            "last_message_timestamp": None,
+            "unread_count": 0,
         }
     logger.warning(
-        f"Contact user {contact_username} not found when getting conversation for {username}."
+        "Contact user %s not found when getting conversation for %s.",
+        contact_username, username
     )
     return None
 
@@ -153,8 +392,8 @@ def get_conversation(db: Session, username: str, contact_username: str):
 def mark_all_messages_as_read(
     db: Session, sender_username: str, recipient_username: str
 ):
-    logger.info(
-        f"Marking all messages as read from {sender_username} to {recipient_username}"
+    logger.debug(
+        "Marking all messages as read from %s to %s", sender_username, recipient_username
     )
     # Mark messages sent from sender_username to recipient_username as read
     db.query(models.Message).filter(
@@ -162,25 +401,162 @@ def mark_all_messages_as_read(
         models.Message.recipient == recipient_username,
         models.Message.is_read == False,
     ).update({"is_read": True})
+    db.query(models.ConversationState).filter(
+        models.ConversationState.owner == recipient_username,
+        models.ConversationState.contact == sender_username,
+    ).update({"unread_count": 0})
     db.commit()
 
 
 def mark_message_as_read(db: Session, message_id: int):
-    logger.info(f"Marking message {message_id} as read")
+    logger.debug("Marking message %s as read", message_id)
     db_message = (
         db.query(models.Message).filter(models.Message.id == message_id).first()
     )
     if db_message:
+        if not db_message.is_read:
+            state = models.ConversationState
+            db.query(state).filter(
+                state.owner == db_message.recipient,
+                state.contact == db_message.sender,
+                state.unread_count > 0,
+            ).update({"unread_count": state.unread_count - 1})
         db_message.is_read = True
         db.commit()
         db.refresh(db_message)
     return db_message
 
 
+def mark_messages_read_up_to(
+    db: Session, reader_username: str, contact_username: str, up_to_id: int
+) -> int:
+    """Marks every message from the contact to the reader up to `up_to_id` as read.
+
+    One UPDATE over the (sender, recipient, id) index plus the unread counter,
+    instead of a round trip per message. Returns how many messages changed.
+    """
+    logger.debug(
+        "Marking messages from %s to %s up to %s as read",
+        contact_username, reader_username, up_to_id
+    )
+    result = db.execute(
+        update(models.Message)
+        .where(
+            models.Message.sender == contact_username,
+            models.Message.recipient == reader_username,
+            models.Message.id <= up_to_id,
+            models.Message.is_read == False,
+        )
+        .values(is_read=True)
+        .execution_options(synchronize_session=False)
+    )
+    marked = result.rowcount
+    if marked:
+        state = models.ConversationState
+        db.execute(
+            update(state)
+            .where(state.owner == reader_username, state.contact == contact_username)
+            .values(
+                unread_count=case(
+                    (state.unread_count > marked, state.unread_count - marked),
+                    else_=0,
+                )
+            )
+            .execution_options(synchronize_session=False)
+        )
+    db.commit()
+    return marked
+
+
+# `schemas.Message` columns in field order. Message lists are read as plain
+# rows rather than hydrated ORM objects, the routes encode them as they are
+# (see `responses.rows_response`) and rows still allow `message.id` access.
+MESSAGE_COLUMNS = tuple(
+    getattr(models.Message, field) for field in schemas.Message.model_fields
+)
+
+
+def search_messages(
+    db: Session,
+    username: str,
+    query: str,
+    contact_username: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+):
+    """Full-text search over the messages a user sent or received, best match first.
+
+    SQLite ranks `messages_fts` matches with bm25, postgres matches the GIN
+    indexed tsvector and ranks with ts_rank. Every word of the query has to
+    appear. `contact_username` narrows it down to one conversation.
+    """
+    logger.debug("Searching messages of %s for: %s", username, query)
+    terms = query.split()
+    if not terms:
+        return []
+
+    if contact_username is None:
+        participant = or_(
+            models.Message.sender == username, models.Message.recipient == username
+        )
+    else:
+        participant = or_(
+            and_(
+                models.Message.sender == username,
+                models.Message.recipient == contact_username,
+            ),
+            and_(
+                models.Message.sender == contact_username,
+                models.Message.recipient == username,
+            ),
+        )
+
+    if db.get_bind().dialect.name == "sqlite":
+        # both the words and the participants are matched inside the index,
+        # see `models.SQLITE_SEARCH_DDL`
+        participants = [username]
+        if contact_username is not None:
+            participants.append(contact_username)
+        match = "text : ({}) AND participants : ({})".format(
+            " ".join(_fts_phrase(term) for term in terms),
+            " ".join(_fts_participant(name) for name in participants),
+        )
+        messages_fts = table("messages_fts", column("rowid", Integer))
+        fts = literal_column("messages_fts")
+        statement = (
+            select(*MESSAGE_COLUMNS)
+            .join(messages_fts, messages_fts.c.rowid == models.Message.id)
+            .where(fts.op("MATCH")(match))
+            # bm25 is lower for better matches, only the text column counts
+            .order_by(func.bm25(fts, 1.0, 0.0), models.Message.id.desc())
+        )
+    else:
+        document = func.to_tsvector(
+            literal_column(f"'{models.SEARCH_TEXT_CONFIG}'"), models.Message.text
+        )
+        ts_query = func.plainto_tsquery(
+            literal_column(f"'{models.SEARCH_TEXT_CONFIG}'"), query
+        )
+        statement = (
+            select(*MESSAGE_COLUMNS)
+            .where(document.op("@@")(ts_query))
+            .order_by(func.ts_rank(document, ts_query).desc(), models.Message.id.desc())
+        )
+
+    return db.execute(
+        statement.where(participant).limit(limit).offset(offset)
+    ).all()
+
+
 def get_message_history(db: Session, username1: str, username2: str):
-    logger.debug(f"Fetching message history between {username1} and {username2}")
-    return (
-        db.query(models.Message)
+    """Returns the whole conversation between two users, oldest first, archive included.
+
+    Kept for compatibility, use `get_message_history_page` for anything that
+    can grow large.
+    """
+    logger.debug("Fetching message history between %s and %s", username1, username2)
+    messages = (
+        db.query(*MESSAGE_COLUMNS)
         .filter(
             or_(
                 and_(
@@ -193,6 +569,338 @@ def get_message_history(db: Session, username1: str, username2: str):
                 ),
             )
         )
-        .order_by(models.Message.timestamp)
+        # ids follow commit order and come with the (sender, recipient, id) index
+        .order_by(models.Message.id)
+        .all()
+    )
+    archived = get_archived_messages(db, username1, username2)
+    if archived:
+        # a message left unread stays live between archived ones
+        messages = sorted(archived + messages, key=lambda message: message.id)
+    return messages
+
+
+def get_message_history_page(
+    db: Session,
+    username1: str,
+    username2: str,
+    limit: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+):
+    """Returns one page of the conversation between two users, oldest first.
+
+    Keyset pagination on the message id:
+    - `before_id` returns the `limit` newest messages older than that id
+      (scrolling back through history),
+    - `after_id` returns the `limit` oldest messages newer than that id
+      (catching up after being away),
+    - neither returns the `limit` newest messages.
+
+    Pages continue into the archive (`get_archived_messages`) past the
+    oldest message still in `messages`.
+    """
+    logger.debug(
+        "Fetching message history page between %s and %s (before_id=%s, after_id=%s, limit=%s)",
+        username1, username2, before_id, after_id, limit
+    )
+    # catching up walks forward from after_id, everything else walks backward
+    order = (
+        models.Message.id.asc() if after_id is not None else models.Message.id.desc()
+    )
+
+    # one range scan on the (sender, recipient, id) index per direction of
+    # the conversation, each already capped at `limit` rows
+    def page_ids(sender: str, recipient: str):
+        query = select(models.Message.id).where(
+            models.Message.sender == sender, models.Message.recipient == recipient
+        )
+        if before_id is not None:
+            query = query.where(models.Message.id < before_id)
+        if after_id is not None:
+            query = query.where(models.Message.id > after_id)
+        page = query.order_by(order).limit(limit).subquery()
+        return select(page.c.id)
+
+    messages = (
+        db.query(*MESSAGE_COLUMNS)
+        .filter(
+            models.Message.id.in_(
+                union_all(page_ids(username1, username2), page_ids(username2, username1))
+            )
+        )
+        .order_by(order)
+        .limit(limit)
+        .all()
+    )
+    if after_id is not None:
+        archived = get_archived_messages(
+            db, username1, username2, after_id=after_id, limit=limit, forward=True
+        )
+        if archived:
+            messages = sorted(archived + messages, key=lambda message: message.id)[:limit]
+        return messages
+
+    messages.reverse()
+    # archived messages belong in the page once it runs past the live ones,
+    # or between live ones where an unread message was left behind. A full
+    # page only takes archived messages newer than its oldest row.
+    archived = get_archived_messages(
+        db,
+        username1,
+        username2,
+        before_id=before_id,
+        after_id=messages[0].id if len(messages) == limit else None,
+        limit=limit,
+    )
+    if archived:
+        messages = sorted(archived + messages, key=lambda message: message.id)[-limit:]
+    return messages
+
+
+# INFO: DELIVERY CURSOR FUNCTIONS
+def get_delivery_cursor(db: Session, username: str) -> Optional[int]:
+    """Id of the last message delivered to the user's sockets, None if never tracked."""
+    cursor = db.get(models.DeliveryCursor, username)
+    return cursor.last_delivered_id if cursor else None
+
+
+def get_latest_incoming_message_id(db: Session, username: str) -> int:
+    return (
+        db.query(func.max(models.Message.id))
+        .filter(models.Message.recipient == username)
+        .scalar()
+    ) or 0
+
+
+def get_incoming_messages_after(db: Session, username: str, after_id: int, limit: int):
+    """Messages sent to the user with an id above `after_id`, oldest first."""
+    logger.debug("Fetching up to %s messages for %s after %s", limit, username, after_id)
+    return (
+        db.query(*MESSAGE_COLUMNS)
+        .filter(models.Message.recipient == username, models.Message.id > after_id)
+        .order_by(models.Message.id)
+        .limit(limit)
         .all()
     )
+
+
+def save_delivery_cursors(db: Session, cursors: Dict[str, int]):
+    """Moves the users' delivery cursors forward, never backward."""
+    if not cursors:
+        return
+    table = models.DeliveryCursor.__table__
+    statement = _dialect_insert(db.get_bind().dialect.name)(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.username],
+        set_={
+            "last_delivered_id": case(
+                (
+                    statement.excluded.last_delivered_id > table.c.last_delivered_id,
+                    statement.excluded.last_delivered_id,
+                ),
+                else_=table.c.last_delivered_id,
+            )
+        },
+    )
+    db.execute(
+        statement,
+        [
+            {"username": username, "last_delivered_id": message_id}
+            for username, message_id in cursors.items()
+        ],
+    )
+    db.commit()
+
+
+# INFO: MESSAGE ARCHIVE FUNCTIONS
+# `schemas.Message` field names, archived rows come back as this namedtuple
+# so they mix with the live rows of `MESSAGE_COLUMNS`
+MESSAGE_FIELDS = tuple(schemas.Message.model_fields)
+ArchivedMessage = namedtuple("ArchivedMessage", MESSAGE_FIELDS)
+_TIMESTAMP_INDEX = MESSAGE_FIELDS.index("timestamp")
+
+
+def conversation_key(username1: str, username2: str) -> Tuple[str, str]:
+    """The (user_a, user_b) a conversation is archived under, either way round."""
+    return (username1, username2) if username1 <= username2 else (username2, username1)
+
+
+def pack_messages(rows) -> bytes:
+    values = [list(row) for row in rows]
+    for value in values:
+        value[_TIMESTAMP_INDEX] = value[_TIMESTAMP_INDEX].isoformat()
+    return zlib.compress(json.dumps(values, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack_messages(payload: bytes) -> List[ArchivedMessage]:
+    messages = []
+    for value in json.loads(zlib.decompress(payload)):
+        value[_TIMESTAMP_INDEX] = datetime.fromisoformat(value[_TIMESTAMP_INDEX])
+        messages.append(ArchivedMessage(*value))
+    return messages
+
+
+def _between(username1: str, username2: str):
+    return or_(
+        and_(models.Message.sender == username1, models.Message.recipient == username2),
+        and_(models.Message.sender == username2, models.Message.recipient == username1),
+    )
+
+
+def get_conversation_keys(db: Session, after: Optional[Tuple[str, str]], limit: int):
+    """Up to `limit` conversations as (user_a, user_b), in key order after `after`."""
+    state = models.ConversationState
+    query = db.query(state.owner, state.contact).filter(state.owner <= state.contact)
+    if after is not None:
+        query = query.filter(tuple_(state.owner, state.contact) > tuple_(*after))
+    return [tuple(row) for row in query.order_by(state.owner, state.contact).limit(limit)]
+
+
+def get_nth_newest_message_id(
+    db: Session, username1: str, username2: str, n: int
+) -> Optional[int]:
+    """Id of the conversation's `n`-th newest message, None if it has fewer."""
+
+    def newest(sender: str, recipient: str):
+        page = (
+            select(models.Message.id)
+            .where(models.Message.sender == sender, models.Message.recipient == recipient)
+            .order_by(models.Message.id.desc())
+            .limit(n)
+            .subquery()
+        )
+        return select(page.c.id)
+
+    both = union_all(newest(username1, username2), newest(username2, username1)).subquery()
+    return db.execute(
+        select(both.c.id).order_by(both.c.id.desc()).offset(n - 1).limit(1)
+    ).scalar()
+
+
+def archive_messages_batch(
+    db: Session,
+    username1: str,
+    username2: str,
+    below_id: int,
+    limit: int,
+    up_to_id: Optional[int] = None,
+    older_than: Optional[datetime] = None,
+) -> int:
+    """Moves up to `limit` read messages of a conversation into one archive chunk.
+
+    Only messages with an id below `below_id` qualify, and also below
+    `up_to_id` or sent before `older_than` (either one). Unread messages
+    stay, unread counts and read receipts only look at `messages`. The rows
+    are deleted with RETURNING and only those are archived, so two workers
+    running the job never archive a message twice. Returns how many moved.
+    """
+    reasons = []
+    if up_to_id is not None:
+        reasons.append(models.Message.id < up_to_id)
+    if older_than is not None:
+        reasons.append(models.Message.timestamp < older_than)
+    if not reasons:
+        return 0
+    ids = [
+        row.id
+        for row in db.query(models.Message.id)
+        .filter(
+            _between(username1, username2),
+            models.Message.id < below_id,
+            models.Message.is_read == True,
+            or_(*reasons),
+        )
+        .order_by(models.Message.id)
+        .limit(limit)
+    ]
+    if not ids:
+        return 0
+
+    messages = models.Message.__table__
+    rows = db.execute(
+        messages.delete()
+        .where(messages.c.id.in_(ids), messages.c.is_read == True)
+        .returning(*(messages.c[field] for field in MESSAGE_FIELDS))
+    ).all()
+    if rows:
+        rows.sort(key=lambda row: row.id)
+        user_a, user_b = conversation_key(username1, username2)
+        db.add(
+            models.MessageArchive(
+                user_a=user_a,
+                user_b=user_b,
+                first_message_id=rows[0].id,
+                last_message_id=rows[-1].id,
+                last_timestamp=max(row.timestamp for row in rows),
+                message_count=len(rows),
+                payload=pack_messages(rows),
+            )
+        )
+    db.commit()
+    return len(rows)
+
+
+def get_archived_messages(
+    db: Session,
+    username1: str,
+    username2: str,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    forward: bool = False,
+) -> List[ArchivedMessage]:
+    """Archived messages of a conversation between the two ids, oldest first.
+
+    With `limit`, the newest ones, or the oldest ones when going `forward`.
+    Only the chunks that can hold them are decompressed.
+    """
+    archive = models.MessageArchive
+    user_a, user_b = conversation_key(username1, username2)
+    query = db.query(archive.id, archive.first_message_id, archive.last_message_id).filter(
+        archive.user_a == user_a, archive.user_b == user_b
+    )
+    if before_id is not None:
+        query = query.filter(archive.first_message_id < before_id)
+    if after_id is not None:
+        query = query.filter(archive.last_message_id > after_id)
+    if forward:
+        chunks = query.order_by(archive.first_message_id).all()
+    else:
+        chunks = query.order_by(archive.last_message_id.desc()).all()
+
+    collected: List[ArchivedMessage] = []
+    for chunk in chunks:
+        if limit is not None and len(collected) >= limit:
+            # chunks can overlap, stop once this one is entirely past the page
+            collected.sort(key=lambda message: message.id, reverse=not forward)
+            boundary = collected[limit - 1].id
+            if forward and chunk.first_message_id > boundary:
+                break
+            if not forward and chunk.last_message_id < boundary:
+                break
+        payload = db.query(archive.payload).filter(archive.id == chunk.id).scalar()
+        collected.extend(
+            message
+            for message in unpack_messages(payload)
+            if (before_id is None or message.id < before_id)
+            and (after_id is None or message.id > after_id)
+        )
+
+    collected.sort(key=lambda message: message.id, reverse=not forward)
+    if limit is not None:
+        collected = collected[:limit]
+    if not forward:
+        collected.reverse()
+    return collected
+
+
+def purge_archive(db: Session, older_than: datetime, limit: int) -> int:
+    """Deletes up to `limit` archive chunks whose newest message is older than `older_than`."""
+    archive = models.MessageArchive
+    ids = select(archive.id).where(archive.last_timestamp < older_than).limit(limit)
+    result = db.execute(
+        archive.__table__.delete().where(archive.__table__.c.id.in_(ids.scalar_subquery()))
+    )
+    db.commit()
+    return result.rowcount
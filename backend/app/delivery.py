@@ -0,0 +1,168 @@
+import asyncio
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, schemas
+from .database import SessionLocal
+from .logger import logger
+from .wire import Frame
+
+if TYPE_CHECKING:
+    from .websocket import Connection
+
+# messages sent per round trip to the database while a reconnecting socket catches up
+CATCH_UP_BATCH_SIZE = int(os.getenv("CATCH_UP_BATCH_SIZE", "100"))
+# delivery cursors are kept in memory and written out this often
+DELIVERY_CURSOR_FLUSH_SECONDS = float(os.getenv("DELIVERY_CURSOR_FLUSH_SECONDS", "1"))
+
+
+# `schemas.Message` fields, read straight off the row: validating a model we
+# just loaded from the database cost more than encoding the frame
+MESSAGE_EVENT_FIELDS = tuple(schemas.Message.model_fields)
+
+
+def message_event(message) -> Frame:
+    """The websocket event for a stored message."""
+    return Frame.from_event(
+        {
+            "type": "message",
+            "data": {field: getattr(message, field) for field in MESSAGE_EVENT_FIELDS},
+        }
+    )
+
+
+class DeliveryTracker:
+    """Per-user delivery cursors and the reconnect catch-up built on them.
+
+    A user's cursor is the id of the last message actually sent on one of
+    their sockets, as reported by the sockets' writer tasks. Messages that
+    never made it out (user offline, socket died with frames queued) leave it
+    behind, and the next `/ws` connection streams only what is past it
+    instead of the client reloading whole histories.
+
+    A socket only reports deliveries once its own catch-up is written, the
+    catch-up moves the cursor to its `last_id` in one step, so a socket that
+    drops mid-replay gets the whole replay again (clients drop duplicate ids).
+    Cursors are flushed in the background, a crash replays a few messages.
+
+    The cursor is per user, not per device: while one device is online it
+    moves the cursor along, and another device coming back gets what the
+    user missed since, not what that device missed. Clients load their
+    conversation list and history over HTTP on connect for that.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = CATCH_UP_BATCH_SIZE,
+        flush_interval: float = DELIVERY_CURSOR_FLUSH_SECONDS,
+        session_factory=SessionLocal,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.session_factory = session_factory
+        self._pending: Dict[str, int] = {}
+        # `delivered` is also called from sync routes running in the threadpool
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def delivered(self, username: str, message_id: int):
+        with self._lock:
+            if message_id > self._pending.get(username, 0):
+                self._pending[username] = message_id
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        with self._lock:
+            cursors, self._pending = self._pending, {}
+        if cursors:
+            await run_in_threadpool(self._save, cursors)
+
+    async def catch_up(self, connection: "Connection"):
+        """Streams the messages the user missed while offline to a new socket.
+
+        Batches are read one at a time and each frame waits for room in the
+        socket's send queue, so a slow client slows the catch-up down instead
+        of piling up frames in memory. Always ends with `catch_up_complete`.
+        """
+        username = connection.username
+        cursor, first = await run_in_threadpool(self._load_cursor, username)
+
+        sent = 0
+        # on the first connection ever the client loads its history over HTTP,
+        # the cursor starts at the newest message and there is nothing to replay
+        while not first:
+            events = await run_in_threadpool(self._load_batch, username, cursor)
+            for message_id, event in events:
+                await connection.send(event)
+                cursor = message_id
+            sent += len(events)
+            if len(events) < self.batch_size:
+                break
+
+        # written after every replayed frame, it moves the cursor to `last_id`
+        await connection.send(
+            Frame.from_event({"type": "catch_up_complete", "data": {"last_id": cursor}}),
+            cursor,
+            completes_catch_up=True,
+        )
+        if sent:
+            logger.info("Caught up '%s' with %s missed messages.", username, sent)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Saving delivery cursors failed: %s", e, exc_info=True)
+
+    def _load_cursor(self, username: str) -> Tuple[int, bool]:
+        """The user's delivery cursor, and whether it was only created now."""
+        db = self.session_factory()
+        try:
+            cursor = crud.get_delivery_cursor(db, username)
+            if cursor is None:
+                latest = crud.get_latest_incoming_message_id(db, username)
+                crud.save_delivery_cursors(db, {username: latest})
+                return latest, True
+        finally:
+            db.close()
+        # a delivery may not have been flushed yet
+        with self._lock:
+            return max(cursor, self._pending.get(username, 0)), False
+
+    def _load_batch(self, username: str, after_id: int):
+        db = self.session_factory()
+        try:
+            messages = crud.get_incoming_messages_after(
+                db, username, after_id, self.batch_size
+            )
+            return [(message.id, message_event(message)) for message in messages]
+        finally:
+            db.close()
+
+    def _save(self, cursors: Dict[str, int]):
+        db = self.session_factory()
+        try:
+            crud.save_delivery_cursors(db, cursors)
+        finally:
+            db.close()
+
+
+delivery_tracker = DeliveryTracker()
@@ -1,34 +1,27 @@
-# TODO: improve logging in future
+import atexit
+import copy
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import sys
+import time
+from typing import Optional
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import colorama
 import coloredlogs
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" for people, "json" one object per line for log collectors
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# "auto" colors the console only when it is a terminal, "true" / "false" force it
+LOG_COLOR = os.getenv("LOG_COLOR", "auto").lower()
+
 # log dir
 log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "logs"))
-
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
 log_file = os.path.join(log_dir, "app.log")
 
-# removing old logs file if they exist.
-if os.path.exists(log_file):
-    os.remove(log_file)
-
-# Get the root logger
-logger = logging.getLogger("Enkrypt-Chan")
-logger.setLevel(logging.INFO)
-logger.propagate = False
-
-# Handlers
-stream_handler = logging.StreamHandler()
-file_handler = RotatingFileHandler(
-    log_file, mode="w+", maxBytes=5000000, backupCount=10
-)
-
 
 # Formatter
 def colored(txt, color=None, bright=False, dim=False):
@@ -48,16 +41,122 @@ lineno = colored("%(lineno)d", color=colorama.Fore.MAGENTA, bright=True)
 funcName = colored("%(funcName)s()", color=colorama.Fore.CYAN, bright=True)
 
 # setup format
-log_format = f"[%(asctime)s - %(levelname)s] - %(name)s - {filename}:{lineno}:{funcName} - %(message)s"
+log_format = "[%(asctime)s - %(levelname)s] - %(name)s - %(filename)s:%(lineno)d:%(funcName)s() - %(message)s"
+colored_log_format = f"[%(asctime)s - %(levelname)s] - %(name)s - {filename}:{lineno}:{funcName} - %(message)s"
 date_format = "%d-%b-%y %H:%M:%S"
-formatter = logging.Formatter(log_format, date_format)
 
-stream_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
+# attributes every LogRecord has, anything else was passed in `extra=`
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, `extra=` fields become top-level keys."""
+
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        # ISO 8601 in UTC with milliseconds, what log collectors parse
+        created = time.strftime("%Y-%m-%dT%H:%M:%S", self.converter(record.created))
+        return f"{created}.{int(record.msecs):03d}Z"
+
+
+exception_formatter = logging.Formatter()
+
+
+class LogQueueHandler(QueueHandler):
+    """Hands records to the listener thread, only the message is built here.
+
+    The arguments are merged now, they may change once the call returns, and
+    a traceback is rendered while its frames are still alive. Formatting and
+    I/O happen on the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def use_color(stream) -> bool:
+    if LOG_COLOR in ("1", "true", "yes"):
+        return True
+    if LOG_COLOR in ("0", "false", "no"):
+        return False
+    return hasattr(stream, "isatty") and stream.isatty()
+
+
+def build_handlers(stream=None, path: str = log_file, structured: bool = LOG_FORMAT == "json"):
+    """The console and rotating file handlers, JSON lines when `structured`."""
+    stream_handler = logging.StreamHandler(stream)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # appended to, several processes may log to the same file
+    file_handler = RotatingFileHandler(path, mode="a", maxBytes=5000000, backupCount=10)
+    if structured:
+        stream_handler.setFormatter(JSONFormatter())
+        file_handler.setFormatter(JSONFormatter())
+    else:
+        if use_color(stream_handler.stream):
+            stream_handler.setFormatter(
+                coloredlogs.ColoredFormatter(fmt=colored_log_format, datefmt=date_format)
+            )
+        else:
+            stream_handler.setFormatter(logging.Formatter(log_format, date_format))
+        # escape codes only ever go to a terminal
+        file_handler.setFormatter(logging.Formatter(log_format, date_format))
+    return [stream_handler, file_handler]
+
+
+def queued(target: logging.Logger, handlers) -> QueueListener:
+    """Routes `target` through a queue to `handlers`, returns the started listener."""
+    log_queue = queue.SimpleQueue()
+    target.addHandler(LogQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Get the root logger
+logger = logging.getLogger("Enkrypt-Chan")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+listener: Optional[QueueListener] = None
+
 
-# Set handlers
-logger.addHandler(stream_handler)
-logger.addHandler(file_handler)
+def configure_logging() -> QueueListener:
+    """Sends `logger` to the console and the log file, once per process.
 
-# Colored logs
-coloredlogs.install(level="INFO", logger=logger, fmt=log_format, datefmt=date_format)
+    Only the entry points (`main.py`, `python -m app.maintenance`) call it.
+    Importing this module has no side effects: the password hasher's spawned
+    workers import modules that log and must not touch the server's file.
+    """
+    global listener
+    if listener is None:
+        # the listener thread does the formatting and the writes, it is
+        # stopped (and the queue drained) at interpreter exit
+        listener = queued(logger, build_handlers(sys.stderr))
+        atexit.register(listener.stop)
+    return listener
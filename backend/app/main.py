@@ -1,23 +1,104 @@
 import json
+import logging
 import os
 import time
 import traceback
-from typing import List
+from contextlib import asynccontextmanager
+from typing import List, Optional
 
+from anyio import from_thread
 from fastapi import (Depends, FastAPI, HTTPException, Query, Request,
                      WebSocket, WebSocketDisconnect, status)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, maintenance, metrics, schemas, security
+from .cache import token_cache, user_cache
+from .database import (RECENT_WRITERS_CHANNEL, AsyncSessionLocal,
+                       SessionLocal, async_engine, engine, get_read_db,
+                       get_write_db, on_recent_writers, read_engine,
+                       read_session, recent_writers)
+from .delivery import delivery_tracker, message_event
+from .logger import configure_logging, logger
+from .message_writer import message_writer
+from .password_hasher import PasswordHasherBusy, password_hasher
+from .read_receipts import read_receipts
+from .responses import FastJSONResponse, rows_response
+from .retention import retention_job
+from .sessions import (SESSION_REVOCATION_CHANNEL, RefreshTokenRaced,
+                       RefreshTokenReplayed, session_store)
+from .user_index import USER_SEARCH_DEFAULT_LIMIT, user_index
+from .websocket import AUTH_EXPIRED_CLOSE_CODE, manager
+from .wire import Frame, choose_format
+
+# the schema is managed by alembic, deployments run `python -m app.maintenance
+# migrate` before starting the workers. AUTO_MIGRATE does it on startup instead,
+# for a single process (several workers would race on the DDL).
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() in ("1", "true", "yes")
+
+configure_logging()
+
+
+def check_schema():
+    if AUTO_MIGRATE:
+        maintenance.migrate()
+        return
+    pending = maintenance.pending_migrations()
+    if pending:
+        logger.error(
+            "Database schema is behind by %s migrations (%s), run `python -m app.maintenance migrate`.",
+            len(pending), ", ".join(pending)
+        )
+
 
-from . import crud, models, schemas, security
-from .database import SessionLocal, engine, get_db
-from .logger import logger
-from .websocket import manager
+async def on_session_revoked(session_id: str) -> bool:
+    """Broker handler for `SESSION_REVOCATION_CHANNEL`, runs on every worker."""
+    session_store.mark_revoked(session_id)
+    await manager.close_session(session_id)
+    return True
 
-models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+async def note_writes(*usernames: str):
+    """Sends the next reads of `usernames` to the primary, on every worker."""
+    announce = [username for username in usernames if recent_writers.wrote(username)]
+    if announce:
+        await manager.broker.publish(RECENT_WRITERS_CHANNEL, json.dumps(announce))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(check_schema)
+    await manager.broker.start()
+    await manager.broker.subscribe(
+        security.TOKEN_REVOCATION_CHANNEL, security.on_token_revoked
+    )
+    await manager.broker.subscribe(SESSION_REVOCATION_CHANNEL, on_session_revoked)
+    await manager.broker.subscribe(RECENT_WRITERS_CHANNEL, on_recent_writers)
+    await password_hasher.start()
+    await message_writer.start()
+    await delivery_tracker.start()
+    await user_index.start()
+    await retention_job.start()
+    yield
+    await retention_job.stop()
+    await user_index.stop()
+    # uvicorn runs this on SIGTERM too, so queued messages are committed before exit
+    await message_writer.stop()
+    await delivery_tracker.stop()
+    await manager.broker.stop()
+    await password_hasher.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+metrics.instrument_engine(engine)
+if read_engine is not engine:
+    metrics.instrument_engine(read_engine)
+if async_engine is not None:
+    metrics.instrument_engine(async_engine.sync_engine)
 
 frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
@@ -31,87 +112,270 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    logger.warning("Password hasher saturated, rejecting %s", request.url.path)
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many login attempts, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+
+def get_user_read_db(current_user: dict = Depends(security.get_current_user)):
+    """`get_read_db` for the current user's own data, on the primary right after they wrote."""
+    db = read_session(current_user["username"])
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def is_admin(request: Request) -> bool:
+    """Whether the request carries a valid access token of one of `ADMIN_USERNAMES`."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    claims = await security.authenticate(token)
+    return claims is not None and claims.username in metrics.ADMIN_USERNAMES
+
+
+async def require_admin(current_user: dict = Depends(security.get_current_user)) -> dict:
+    """Dependency of the operator-only routes, the user must be in `ADMIN_USERNAMES`."""
+    if current_user["username"] not in metrics.ADMIN_USERNAMES:
+        logger.warning("User '%s' is not allowed on an admin route.", current_user["username"])
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
+    return current_user
+
+
+async def profile_request(request: Request, call_next):
+    """Runs the request under pyinstrument and answers with the profile as HTML.
+
+    The profiler follows the event loop, sync routes show up as the await
+    on the threadpool. The `db_*` metrics count their queries.
+    """
+    profiler = metrics.Profiler(async_mode="enabled")
+    profiler.start()
+    try:
+        await call_next(request)
+    finally:
+        profiler.stop()
+    logger.info("Profiled %s %s", request.method, request.url.path)
+    return HTMLResponse(profiler.output_html())
+
+
 @app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    logger.info(f"Incoming request: {request.method} {request.url.path}")
+async def observe_requests(request: Request, call_next):
+    """One log line and the metrics per request, a profile when an admin asks for one."""
+    if (
+        metrics.PROFILE_HEADER in request.headers
+        and metrics.Profiler is not None
+        and await is_admin(request)
+    ):
+        return await profile_request(request, call_next)
+
+    queries = metrics.QueryStats()
+    metrics.request_queries.set(queries)
+    start_time = time.perf_counter()
     try:
         response = await call_next(request)
-        process_time = time.time() - start_time
-        logger.info(
-            f"Request {request.method} {request.url.path} completed with status {response.status_code} in {process_time:.4f}s"
-        )
-        return response
-    except Exception as e:
-        process_time = time.time() - start_time
+    except Exception:
+        duration = time.perf_counter() - start_time
+        metrics.observe_request(request.scope, request.method, 500, duration, queries)
         logger.error(
-            f"Request {request.method} {request.url.path} failed in {process_time:.4f}s",
+            "Request %s %s failed in %.4fs",
+            request.method,
+            request.url.path,
+            duration,
             exc_info=True,
+            extra={"method": request.method, "path": request.url.path},
+        )
+        raise
+    duration = time.perf_counter() - start_time
+    metrics.observe_request(
+        request.scope, request.method, response.status_code, duration, queries
+    )
+    if logger.isEnabledFor(logging.INFO):
+        # the fields again as `extra=`, JSON logs carry them as keys
+        logger.info(
+            "%s %s %s in %.4fs (%s queries)",
+            request.method,
+            request.url.path,
+            response.status_code,
+            duration,
+            queries.count,
+            extra={
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 3),
+                "db_queries": queries.count,
+                "db_ms": round(queries.seconds * 1000, 3),
+            },
         )
-        raise e
+    return response
+
+
+def run_with_session(func, *args):
+    """Runs a sync crud function with its own session, for use in the threadpool."""
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
 
 
+# INFO: register and login are async so waiting on bcrypt doesn't hold a
+# threadpool thread, the hashing itself runs in `password_hasher`'s processes
 @app.post("/register", response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    logger.info(f"Attempting to register user '{user.username}'")
-    db_user = crud.get_user_by_username(db, username=user.username)
+async def register_user(user: schemas.UserCreate):
+    logger.info("Attempting to register user '%s'", user.username)
+    db_user = await find_user(user.username)
     if db_user:
         logger.warning(
-            f"Registration failed for '{user.username}': username already exists."
+            "Registration failed for '%s': username already exists.", user.username
         )
         raise HTTPException(status_code=400, detail="Username already registered")
-    new_user = crud.create_user(db=db, user=user)
-    logger.info(f"User '{user.username}' registered successfully.")
+    hashed_password = await password_hasher.hash(user.password)
+    new_user = await run_in_threadpool(
+        run_with_session, crud.create_user, user, hashed_password
+    )
+    logger.info("User '%s' registered successfully.", user.username)
     return new_user
 
 
 @app.post("/token", response_model=schemas.TokenWithUser)
-def login_for_access_token(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
-):
-    logger.info(f"Login attempt for user '{form_data.username}'")
-    user = crud.get_user_by_username(db, username=form_data.username)
-    if not user or not security.verify_password(
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    logger.info("Login attempt for user '%s'", form_data.username)
+    user = await find_user(form_data.username)
+    if not user or not await password_hasher.verify(
         form_data.password, user.hashed_password
     ):
-        logger.warning(f"Authentication failed for user '{form_data.username}'")
+        logger.warning("Authentication failed for user '%s'", form_data.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = security.create_access_token(username=form_data.username)
-    logger.info(f"User '{form_data.username}' logged in successfully.")
+    if security.password_needs_rehash(user.hashed_password):
+        # the cost factor changed since this hash was made, the plain password
+        # is only ever available here
+        logger.info("Rehashing the password of '%s' with the current cost.", user.username)
+        hashed_password = await password_hasher.hash(form_data.password)
+        await run_in_threadpool(
+            run_with_session, crud.update_password_hash, user.username, hashed_password
+        )
+    session = await run_in_threadpool(session_store.create, user.username)
+    logger.info("User '%s' logged in successfully.", form_data.username)
+    return token_response(session, user.name)
+
+
+def token_response(session, name: str) -> dict:
+    """A new access token for the session, along with its refresh token."""
     return {
-        "access_token": access_token,
+        "access_token": security.create_access_token(
+            username=session.username, session_id=session.session_id
+        ),
         "token_type": "bearer",
-        "name": user.name,
-        "username": user.username,
+        "expires_in": security.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        "refresh_token": session.refresh_token,
+        "name": name,
+        "username": session.username,
     }
 
 
+@app.post("/token/refresh", response_model=schemas.TokenWithUser)
+async def refresh_access_token(refresh_request: schemas.RefreshRequest):
+    """Trades a refresh token for a new access token and a new refresh token."""
+    try:
+        session = await run_in_threadpool(
+            session_store.rotate, refresh_request.refresh_token
+        )
+    except RefreshTokenRaced:
+        # another tab refreshed the same token a moment ago, the client picks
+        # up the new one instead of logging out
+        logger.info("Token refresh lost a race with a concurrent refresh.")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Refresh token already rotated",
+        )
+    except RefreshTokenReplayed as e:
+        await manager.broker.publish(SESSION_REVOCATION_CHANNEL, e.session_id)
+        session = None
+    user = await find_user(session.username) if session else None
+    if not user:
+        logger.warning("Token refresh failed: invalid, expired or revoked refresh token.")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    logger.info("Refreshed the access token of '%s'.", user.username)
+    return token_response(session, user.name)
+
+
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    token: str = Depends(security.oauth2_scheme),
+    current_user: dict = Depends(security.get_current_user),
+):
+    """Ends the session on every worker, its tokens and sockets stop working."""
+    logger.info("User '%s' logging out.", current_user["username"])
+    session_id = current_user["session_id"]
+    await run_in_threadpool(session_store.revoke, session_id)
+    await manager.broker.publish(
+        security.TOKEN_REVOCATION_CHANNEL, security.revoke_access_token(token)
+    )
+    await manager.broker.publish(SESSION_REVOCATION_CHANNEL, session_id)
+
+
+@app.get("/stats", dependencies=[Depends(require_admin)])
+def get_stats():
+    """Internal counters, used to size caches. Admins only."""
+    return {
+        "user_cache": user_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "websocket": manager.stats(),
+        "password_hasher": password_hasher.stats(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus exposition of the request, database and websocket metrics."""
+    return Response(metrics.latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
 @app.get("/users/search", response_model=list[schemas.User])
-def search_users(username: str, db: Session = Depends(get_db)):
-    logger.info(f"Searching for users with query: '{username}'")
-    return crud.search_users(db, username_query=username)
+def search_users(
+    username: str,
+    limit: int = Query(USER_SEARCH_DEFAULT_LIMIT, ge=1, le=100),
+    db: Session = Depends(get_read_db),
+):
+    """Best matches first: exact, username prefix, name prefix, then substring."""
+    logger.debug("Searching for users with query: '%s'", username)
+    if not user_index.ready:
+        # still loading right after startup
+        return crud.search_users(db, username_query=username)[:limit]
+    return user_index.search(username, limit=limit)
 
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-def get_user(user_id: int, db: Session = Depends(get_db)):
-    logger.info(f"Fetching user with ID: {user_id}")
+def get_user(user_id: int, db: Session = Depends(get_read_db)):
+    logger.debug("Fetching user with ID: %s", user_id)
     db_user = crud.get_user(db, user_id=user_id)
     if db_user is None:
-        logger.warning(f"User with ID {user_id} not found.")
+        logger.warning("User with ID %s not found.", user_id)
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 
 @app.get("/users/{username}", response_model=schemas.User)
-def get_user_profile(username: str, db: Session = Depends(get_db)):
-    logger.info(f"Fetching profile for user: '{username}'")
+def get_user_profile(username: str, db: Session = Depends(get_read_db)):
+    logger.debug("Fetching profile for user: '%s'", username)
     user = crud.get_user_by_username(db, username=username)
     if not user:
-        logger.warning(f"User with username '{username}' not found.")
+        logger.warning("User with username '%s' not found.", username)
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
@@ -119,92 +383,189 @@ def get_user_profile(username: str, db: Session = Depends(get_db)):
 @app.get("/conversations", response_model=List[schemas.Conversation])
 def get_conversations(
     current_user: dict = Depends(security.get_current_user),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_user_read_db),
 ):
     username = current_user["username"]
-    logger.info(f"Fetching conversations for user: '{username}'")
-    return crud.get_conversations(db, username=username)
+    logger.debug("Fetching conversations for user: '%s'", username)
+    conversations = crud.get_conversations(db, username=username)
+    # the client now has everything up to here, reconnect catch-up starts after it
+    delivery_tracker.delivered(
+        username, crud.get_latest_incoming_message_id(db, username)
+    )
+    return FastJSONResponse(conversations)
 
 
 @app.post("/messages/read", response_model=schemas.Conversation)
 def mark_message_read(
     read_receipt: schemas.ReadReceipt,
     current_user: dict = Depends(security.get_current_user),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_write_db),
 ):
-    logger.info(
-        f"User '{current_user['username']}' marking message {read_receipt.message_id} as read."
+    logger.debug(
+        "User '%s' marking message %s as read.",
+        current_user["username"], read_receipt.message_id
     )
     message = crud.mark_message_as_read(db, message_id=read_receipt.message_id)
+    # a sync route, in a worker thread
+    from_thread.run(note_writes, current_user["username"])
     if not message:
         logger.warning(
-            f"Message with ID {read_receipt.message_id} not found for marking as read."
+            "Message with ID %s not found for marking as read.", read_receipt.message_id
         )
         raise HTTPException(status_code=404, detail="Message not found")
 
     conversation = crud.get_conversation(db, current_user["username"], message.sender)
     if not conversation:
         logger.warning(
-            f"Conversation not found after marking message as read for user '{current_user['username']}'"
+            "Conversation not found after marking message as read for user '%s'",
+            current_user["username"]
         )
         raise HTTPException(status_code=404, detail="Conversation not found")
 
     return conversation
 
 
+@app.get("/search", response_model=List[schemas.Message])
+def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    contact: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user: dict = Depends(security.get_current_user),
+    db: Session = Depends(get_user_read_db),
+):
+    """Ranked full-text search over the caller's own messages, optionally one conversation."""
+    username = current_user["username"]
+    logger.debug("User '%s' searching messages.", username)
+    return rows_response(
+        crud.search_messages(
+            db, username, q, contact_username=contact, limit=limit, offset=offset
+        )
+    )
+
+
+@app.post(
+    "/conversations/{contact_username}/read", response_model=schemas.Conversation
+)
+async def mark_conversation_read(
+    contact_username: str,
+    read_receipt: schemas.ConversationReadReceipt,
+    current_user: dict = Depends(security.get_current_user),
+):
+    """Range read receipt, replaces one `/messages/read` call per message."""
+    username = current_user["username"]
+    logger.debug(
+        "User '%s' marking messages from '%s' up to %s as read.",
+        username, contact_username, read_receipt.up_to_id
+    )
+    conversation = await read_receipts.submit(
+        username, contact_username, read_receipt.up_to_id
+    )
+    await note_writes(username)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversation
+
+
 @app.get(
     "/conversations/{contact_username}/messages", response_model=List[schemas.Message]
 )
 def get_message_history(
     contact_username: str,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    full_history: bool = False,
     current_user: dict = Depends(security.get_current_user),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_user_read_db),
 ):
     username = current_user["username"]
-    logger.info(
-        f"Fetching message history between '{username}' and '{contact_username}'"
+    if full_history:
+        logger.debug(
+            "Fetching full message history between '%s' and '%s'",
+            username, contact_username
+        )
+        return rows_response(
+            crud.get_message_history(db, username1=username, username2=contact_username)
+        )
+
+    logger.debug(
+        "Fetching message history page between '%s' and '%s'", username, contact_username
+    )
+    return rows_response(
+        crud.get_message_history_page(
+            db,
+            username1=username,
+            username2=contact_username,
+            limit=limit,
+            before_id=before_id,
+            after_id=after_id,
+        )
+    )
+
+
+async def find_user(username: str):
+    """User lookup for async routes, async when the async engine is enabled.
+
+    Usually a user cache hit, a miss on the sync engine is one indexed SELECT
+    run in the threadpool, never on the event loop.
+    """
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            return await crud.get_user_by_username_async(db, username)
+    return await run_in_threadpool(run_with_session, crud.get_user_by_username, username)
+
+
+async def reauthenticate(connection, token: Optional[str]):
+    """Moves a live socket onto a renewed access token instead of dropping it."""
+    claims = await security.authenticate(token or "")
+    if not claims or claims.username != connection.username:
+        logger.warning("WebSocket re-auth failed for '%s'.", connection.username)
+        await connection.close(AUTH_EXPIRED_CLOSE_CODE)
+        return
+    connection.authenticated(claims.session_id, claims.expires_at)
+    connection.enqueue(
+        Frame.from_event({"type": "reauth_ok", "data": {"expires_at": claims.expires_at}})
     )
-    return crud.get_message_history(db, username1=username, username2=contact_username)
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
-    username = security.decode_access_token(token)
-    if not username:
+    claims = await security.authenticate(token)
+    if not claims:
         logger.warning("WebSocket connection failed: invalid token.")
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
+    username = claims.username
 
-    db = SessionLocal()
-    try:
-        user = crud.get_user_by_username(db, username)
-        if not user:
-            logger.warning(
-                f"Invalid token or user not found for WebSocket connection: {username}"
-            )
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
-    finally:
-        db.close()
+    user = await find_user(username)
+    if not user:
+        logger.warning(
+            "Invalid token or user not found for WebSocket connection: %s", username
+        )
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-    await manager.connect(websocket, username)
+    subprotocol = choose_format(websocket.scope.get("subprotocols", []))
+    connection = await manager.connect(websocket, username, subprotocol)
+    connection.authenticated(claims.session_id, claims.expires_at)
     try:
+        await delivery_tracker.catch_up(connection)
         while True:
-            data = await websocket.receive_text()
+            data = await connection.receive()
 
-            db = SessionLocal()
             try:
-                message_data = json.loads(data)
+                message_data = connection.decode(data)
+                if message_data.get("type") == "auth":
+                    await reauthenticate(connection, message_data.get("token"))
+                    continue
                 recipient = message_data.get("recipient")
                 text = message_data.get("text")
 
-                if (
-                    not recipient
-                    or not text
-                    or not crud.get_user_by_username(db, recipient)
-                ):
+                if not recipient or not text or not await find_user(recipient):
                     logger.warning(
-                        f"Could not process WebSocket message from '{username}': invalid data format or recipient."
+                        "Could not process WebSocket message from '%s': invalid data format or recipient.",
+                        username,
                     )
                     continue
 
@@ -214,29 +575,34 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
                     text=text,
                     is_read=False,
                 )
-                db_message = crud.create_message(db, message=message_to_store)
+                db_message = await message_writer.submit(message_to_store)
+                # the recipient's client hears of it on its socket and may
+                # read the conversation back right away, same as the sender's
+                await note_writes(username, recipient)
 
-                message_to_send = schemas.Message.model_validate(db_message)
-                message_data_dict = message_to_send.model_dump()
-                json_message = json.dumps(
-                    {"type": "message", "data": message_data_dict}
-                )
+                metrics.messages_received.inc()
+
+                with metrics.message_fanout_duration.time():
+                    # encoded once per wire format for the recipient and the echo
+                    frame = message_event(db_message)
 
-                await manager.send_personal_message(json_message, recipient)
-                await manager.send_personal_message(json_message, username)
+                    await manager.send_personal_message(
+                        frame, recipient, message_id=db_message.id
+                    )
+                    await manager.send_personal_message(frame, username)
             except Exception as e:
                 logger.error(
-                    f"Error processing WebSocket message from '{username}': {e}",
+                    "Error processing WebSocket message from '%s': %s",
+                    username,
+                    e,
                     exc_info=True,
                 )
-            finally:
-                db.close()
 
     except WebSocketDisconnect as e:
-        logger.info(f"WebSocket disconnected for {username}: {e.code}")
+        logger.info("WebSocket disconnected for %s: %s", username, e.code)
         traceback.print_exc()
-        await manager.disconnect(username)
+        await manager.disconnect(username, connection.id)
     except Exception as e:
-        logger.error(f"Unexpected WebSocket error for {username}: {e}", exc_info=True)
+        logger.error("Unexpected WebSocket error for %s: %s", username, e, exc_info=True)
         traceback.print_exc()
-        await manager.disconnect(username)
+        await manager.disconnect(username, connection.id)
@@ -0,0 +1,119 @@
+"""Maintenance commands, run from `backend/`:
+
+    python -m app.maintenance migrate
+    python -m app.maintenance rebuild-conversation-state
+    python -m app.maintenance rebuild-search-index
+    python -m app.maintenance archive
+    python -m app.maintenance optimize
+    python -m app.maintenance vacuum
+"""
+
+import argparse
+import asyncio
+import os
+from typing import List
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect
+
+from . import crud, models, retention
+from .database import SessionLocal, engine
+from .logger import configure_logging, logger
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(__file__)), "alembic.ini")
+# the baseline `users` and `messages` tables, what `create_all` made before
+# there were migrations
+BASELINE_REVISION = "0001"
+
+
+def alembic_config(connection=None) -> Config:
+    config = Config(ALEMBIC_INI)
+    # keep the app's logging setup
+    config.attributes["configure_logger"] = False
+    # migrations run on this connection instead of one to `DATABASE_URL`
+    config.attributes["connection"] = connection
+    return config
+
+
+def pending_migrations(bind=engine) -> List[str]:
+    """Revisions not applied to the database yet, oldest first."""
+    script = ScriptDirectory.from_config(alembic_config())
+    with bind.connect() as connection:
+        current = MigrationContext.configure(connection).get_current_heads()
+    pending = [
+        revision.revision
+        for revision in script.iterate_revisions("heads", current or "base")
+        if revision.revision not in current
+    ]
+    return pending[::-1]
+
+
+def migrate(bind=engine):
+    """Upgrades the database schema of `bind` to the latest revision.
+
+    A database created by `create_all` before migrations existed is stamped
+    with the baseline revision first, its tables are already there. Revision
+    0002 then only creates the tables and indexes that are still missing.
+    """
+    with bind.begin() as connection:
+        config = alembic_config(connection)
+        tables = inspect(connection).get_table_names()
+        if "users" in tables and "alembic_version" not in tables:
+            logger.info("Existing database without migrations, stamping %s.", BASELINE_REVISION)
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, "head")
+    logger.info("Database schema is up to date.")
+
+
+def rebuild_conversation_state():
+    """Builds `conversation_state` from `messages`, needed once for existing databases."""
+    db = SessionLocal()
+    try:
+        crud.rebuild_conversation_state(db)
+    finally:
+        db.close()
+
+
+def rebuild_search_index():
+    """Refills the SQLite full-text tables from `messages` and `users`.
+
+    Migrations create and fill the indexes, this is for an index that got
+    out of sync, e.g. rows written while the triggers were gone.
+    """
+    with engine.begin() as connection:
+        models.create_search_indexes(connection, rebuild=True)
+
+
+def archive():
+    """One pass of the retention job, with the `MESSAGE_*` settings of the environment."""
+    counts = asyncio.run(retention.retention_job.run_once())
+    logger.info(
+        "Archived %s messages, purged %s archive chunks and %s expired sessions.",
+        counts["archived"], counts["purged"], counts["expired_sessions"]
+    )
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "rebuild-conversation-state": rebuild_conversation_state,
+    "rebuild-search-index": rebuild_search_index,
+    "archive": archive,
+    "optimize": retention.optimize,
+    "vacuum": retention.vacuum,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enkrypt-Chan maintenance commands")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    configure_logging()
+    logger.info("Running maintenance command: %s", args.command)
+    COMMANDS[args.command]()
+
+
+if __name__ == "__main__":
+    main()
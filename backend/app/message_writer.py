@@ -0,0 +1,139 @@
+import asyncio
+import os
+from typing import List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, schemas
+from .database import AsyncSessionLocal, SessionLocal
+from .logger import logger
+
+# Group commit: wait this long for more messages before writing a batch...
+MESSAGE_BATCH_WINDOW_MS = float(os.getenv("MESSAGE_BATCH_WINDOW_MS", "2"))
+# ...unless this many are already waiting.
+MESSAGE_BATCH_MAX_SIZE = int(os.getenv("MESSAGE_BATCH_MAX_SIZE", "100"))
+
+
+class MessageWriter:
+    """Collects incoming messages and inserts them in batches, one commit per batch.
+
+    `submit` resolves once the message is committed, with its assigned id, so
+    fan-out only ever sends stored messages. `stop` drains whatever is queued.
+    """
+
+    def __init__(
+        self,
+        window_ms: float = MESSAGE_BATCH_WINDOW_MS,
+        max_batch_size: int = MESSAGE_BATCH_MAX_SIZE,
+        session_factory=SessionLocal,
+        async_session_factory=AsyncSessionLocal,
+    ):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            "Message writer started (window=%gms, max batch=%s)",
+            self.window * 1000, self.max_batch_size
+        )
+
+    async def stop(self):
+        """Stops accepting messages into the queue and waits until it's written."""
+        if not self.running:
+            return
+        task, self._task = self._task, None
+        # messages submitted from now on are written directly, see `submit`
+        self._queue.put_nowait(None)
+        await task
+        logger.info("Message writer stopped, queue drained.")
+
+    async def submit(self, message: schemas.MessageCreate):
+        """Queues a message and returns it once committed."""
+        if not self.running:
+            # not started (tests, scripts) or shutting down, write it on its own
+            return (await self._write([message]))[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((message, future))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+
+            stopping = self._drain_into(batch)
+            if not stopping and len(batch) < self.max_batch_size and self.window > 0:
+                await asyncio.sleep(self.window)
+                stopping = self._drain_into(batch)
+
+            await self._write_batch(batch)
+
+    def _drain_into(self, batch: list) -> bool:
+        """Moves queued messages into the batch, returns True on the stop marker."""
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _write_batch(self, batch: list):
+        messages = [message for message, _ in batch]
+        try:
+            db_messages = await self._write(messages)
+        except Exception as e:
+            if len(batch) == 1:
+                future = batch[0][1]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # one bad message shouldn't fail its neighbours, retry them one by one
+            logger.error(
+                "Writing a batch of %s messages failed, retrying individually: %s",
+                len(batch), e,
+                exc_info=True,
+            )
+            for item in batch:
+                await self._write_batch([item])
+            return
+
+        logger.debug("Wrote a batch of %s messages", len(db_messages))
+        for (_, future), db_message in zip(batch, db_messages):
+            if not future.done():
+                future.set_result(db_message)
+
+    async def _write(self, messages: List[schemas.MessageCreate]):
+        if self.async_session_factory is not None:
+            async with self.async_session_factory() as db:
+                return await crud.create_messages_async(db, messages)
+        return await run_in_threadpool(self._write_sync, messages)
+
+    def _write_sync(self, messages: List[schemas.MessageCreate]):
+        # the messages are handed to the websocket code after the commit
+        db = self.session_factory(expire_on_commit=False)
+        try:
+            return crud.create_messages(db, messages)
+        finally:
+            db.close()
+
+
+message_writer = MessageWriter()
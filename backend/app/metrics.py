@@ -0,0 +1,141 @@
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter,
+                               Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # optional, request profiling is off without it
+    Profiler = None
+
+# with several uvicorn workers every process keeps its own numbers, point
+# PROMETHEUS_MULTIPROC_DIR at an empty directory shared by the workers to
+# have /metrics report all of them
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# users allowed to profile a request with the `PROFILE_HEADER` and to read
+# /stats, comma separated
+ADMIN_USERNAMES = frozenset(
+    name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()
+)
+PROFILE_HEADER = "x-profile"
+
+# request latencies from ~1ms to 10s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency, by route template.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+db_queries_per_request = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed while handling one HTTP request.",
+    ["route"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+db_time_per_request = Histogram(
+    "db_time_per_request_seconds",
+    "Time spent in SQL statements while handling one HTTP request.",
+    ["route"],
+    buckets=LATENCY_BUCKETS,
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds",
+    "Latency of single SQL statements, by statement kind.",
+    ["operation"],
+    buckets=QUERY_BUCKETS,
+)
+websocket_connections = Gauge(
+    "websocket_connections",
+    "Open websocket connections.",
+    multiprocess_mode="livesum",
+)
+messages_received = Counter(
+    "messages_received_total",
+    "Chat messages accepted from websocket clients and stored.",
+)
+message_fanout_duration = Histogram(
+    "message_fanout_seconds",
+    "From a stored message to its frames published to the recipient and the sender.",
+    buckets=QUERY_BUCKETS,
+)
+
+
+class QueryStats:
+    """SQL statements run for the current request, shared with its threadpool calls."""
+
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# set by the request middleware, contexts are copied into the threadpool so
+# sync routes and dependencies add to the same object
+request_queries: ContextVar[Optional[QueryStats]] = ContextVar("request_queries", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    db_query_duration.labels(statement_operation(statement)).observe(elapsed)
+    stats = request_queries.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+
+def _handle_error(exception_context):
+    # the after hook does not run for a failed statement
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+
+def statement_operation(statement: str) -> str:
+    """SELECT, INSERT, ... a bounded label, never the statement itself."""
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    if operation in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+        return operation
+    return "OTHER"
+
+
+def instrument_engine(engine):
+    """Times every statement `engine` runs, pass `AsyncEngine.sync_engine` for async ones."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def route_template(scope) -> str:
+    """The matched path template, e.g. "/users/{user_id}", raw paths would explode the labels."""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def observe_request(scope, method: str, status: int, duration: float, stats: QueryStats):
+    route = route_template(scope)
+    http_request_duration.labels(method, route, str(status)).observe(duration)
+    db_queries_per_request.labels(route).observe(stats.count)
+    db_time_per_request.labels(route).observe(stats.seconds)
+
+
+def latest() -> bytes:
+    """The exposition text of this process, or of every worker in multiprocess mode."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
@@ -1,10 +1,45 @@
 from datetime import datetime, timezone
 
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import (Boolean, Column, DateTime, Index, Integer, LargeBinary,
+                        String, TypeDecorator, UniqueConstraint, event, text)
 
 from .database import Base
 
 
+def utcnow() -> datetime:
+    """The one clock for stored timestamps, timezone-aware UTC."""
+    return datetime.now(timezone.utc)
+
+
+class UTCDateTime(TypeDecorator):
+    """Timezone-aware datetimes, always handed back in UTC.
+
+    `timestamptz` on postgres. SQLite has no timezone support, values are
+    stored as naive UTC in SQLAlchemy's fixed-width DATETIME text, which
+    sorts chronologically.
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if value.tzinfo is None:
+            raise ValueError(f"Naive datetime {value!r}, timestamps must be timezone-aware")
+        value = value.astimezone(timezone.utc)
+        if dialect.name == "sqlite":
+            return value.replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -16,14 +51,190 @@ class User(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # keyset pagination of a conversation, one range scan per direction
+        Index("ix_messages_sender_recipient_id", "sender", "recipient", "id"),
+        # reconnect catch-up, everything sent to a user after their delivery cursor
+        Index("ix_messages_recipient_id", "recipient", "id"),
+        # no (recipient, is_read) index: unread counts are kept in
+        # `conversation_state`, and read receipts mark ranges of one
+        # conversation through (sender, recipient, id)
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     sender = Column(String, index=True, nullable=False)
     recipient = Column(String, index=True, nullable=False)
     text = Column(String, nullable=False)
-    timestamp = Column(
-        String,
-        default=lambda: datetime.now(timezone.utc).isoformat(),
-        nullable=False,
-    )
+    timestamp = Column(UTCDateTime, default=utcnow, nullable=False)
     is_read = Column(Boolean, default=False, nullable=False)
+
+
+class ConversationState(Base):
+    """Chat list summary, one row per (owner, contact), kept up to date on write."""
+
+    __tablename__ = "conversation_state"
+    __table_args__ = (
+        UniqueConstraint("owner", "contact", name="uq_conversation_state_owner_contact"),
+        # the chat list is a range scan over one owner, newest first
+        Index(
+            "ix_conversation_state_owner_timestamp", "owner", "last_message_timestamp"
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner = Column(String, nullable=False)
+    contact = Column(String, nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    last_message = Column(String, nullable=True)
+    last_message_timestamp = Column(UTCDateTime, nullable=True)
+    unread_count = Column(Integer, default=0, nullable=False)
+
+
+class DeliveryCursor(Base):
+    """Last message id delivered to any of the user's sockets."""
+
+    __tablename__ = "delivery_cursors"
+
+    username = Column(String, primary_key=True)
+    last_delivered_id = Column(Integer, nullable=False)
+
+
+class MessageArchive(Base):
+    """Read messages moved out of `messages` by the retention job, one compressed chunk per batch.
+
+    A conversation is keyed by its two usernames in sorted order. `payload`
+    is the chunk's rows as zlib-compressed JSON, see `crud.pack_messages`.
+    Chunks of a conversation can overlap in id range, a message left unread
+    is archived later than its neighbours.
+    """
+
+    __tablename__ = "message_archive"
+    __table_args__ = (
+        # history pages walk a conversation's chunks by id
+        Index("ix_message_archive_conversation", "user_a", "user_b", "last_message_id"),
+        Index("ix_message_archive_last_timestamp", "last_timestamp"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_a = Column(String, nullable=False)
+    user_b = Column(String, nullable=False)
+    first_message_id = Column(Integer, nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    last_timestamp = Column(UTCDateTime, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+
+
+class AuthSession(Base):
+    """A login, named by the `sid` claim of its access tokens.
+
+    The refresh token is only stored hashed and rotates on every use, the
+    previous hash is kept to recognise a stolen token being replayed. Times
+    are unix seconds.
+    """
+
+    __tablename__ = "auth_sessions"
+
+    id = Column(String, primary_key=True)
+    username = Column(String, index=True, nullable=False)
+    refresh_token_hash = Column(String, unique=True, nullable=False)
+    previous_refresh_token_hash = Column(String, index=True, nullable=True)
+    rotated_at = Column(Integer, nullable=False)
+    expires_at = Column(Integer, nullable=False)
+    revoked = Column(Boolean, default=False, nullable=False)
+
+
+# INFO: SEARCH INDEXES
+# text search configuration of the postgres message index, no stemming since
+# chats mix languages
+SEARCH_TEXT_CONFIG = "simple"
+
+# FTS5 tables kept in sync by triggers, however the rows are written.
+# `messages_fts` is contentless (the text stays in `messages` only) and also
+# indexes each message's participants, so a search is an intersection with the
+# caller's own messages instead of ranking every match in the database. The
+# users table is indexed with trigrams so substring search doesn't scan.
+SQLITE_MESSAGE_PARTICIPANTS = "'u' || hex({row}.sender) || ' u' || hex({row}.recipient)"
+
+SQLITE_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, participants, content='',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, participants)
+        VALUES (new.id, new.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="new")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, participants)
+        VALUES ('delete', old.id, old.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="old")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, participants)
+        VALUES ('delete', old.id, old.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="old")});
+        INSERT INTO messages_fts(rowid, text, participants)
+        VALUES (new.id, new.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="new")});
+    END""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, name, content='users', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, name)
+        VALUES ('delete', old.id, old.username, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, name)
+        VALUES ('delete', old.id, old.username, old.name);
+        INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name);
+    END""",
+)
+
+SQLITE_SEARCH_REBUILD = (
+    "INSERT INTO messages_fts(messages_fts) VALUES ('delete-all')",
+    f"""INSERT INTO messages_fts(rowid, text, participants)
+        SELECT id, text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="messages")} FROM messages""",
+    "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+)
+
+# GIN indexes are maintained by postgres itself, pg_trgm makes `ilike '%q%'`
+# on users an index scan
+POSTGRES_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"""CREATE INDEX IF NOT EXISTS ix_messages_text_fts
+        ON messages USING gin (to_tsvector('{SEARCH_TEXT_CONFIG}', text))""",
+    """CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+        ON users USING gin (username gin_trgm_ops)""",
+    """CREATE INDEX IF NOT EXISTS ix_users_name_trgm
+        ON users USING gin (name gin_trgm_ops)""",
+)
+
+
+def create_search_indexes(connection, rebuild: bool = False):
+    """Creates the full-text indexes if missing, idempotent.
+
+    An FTS5 table created next to existing rows starts empty, so it is
+    filled from `messages` and `users` then, or whenever `rebuild` is set.
+    """
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+        ).first()
+        for statement in SQLITE_SEARCH_DDL:
+            connection.execute(text(statement))
+        if rebuild or not exists:
+            for statement in SQLITE_SEARCH_REBUILD:
+                connection.execute(text(statement))
+    elif dialect == "postgresql":
+        for statement in POSTGRES_SEARCH_DDL:
+            connection.execute(text(statement))
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _create_search_indexes(target, connection, **kw):
+    # runs on every `create_all`, so databases created before the search
+    # indexes existed get them on the next start
+    create_search_indexes(connection)
@@ -0,0 +1,91 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from . import security
+from .logger import logger
+
+# bcrypt is CPU bound, it gets its own processes instead of the threadpool
+# that every sync route shares
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+# hashes queued or running at once, beyond that requests get a 503
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8))
+)
+
+
+class PasswordHasherBusy(Exception):
+    """Raised instead of queueing when the password pool is saturated."""
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool.
+
+    A login burst can at most fill the pool's queue, requests beyond
+    `max_pending` fail fast with `PasswordHasherBusy` (a 503 with Retry-After)
+    instead of piling up, and the rest of the API keeps its threads.
+    """
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def start(self):
+        if self._pool is None:
+            # spawn, forking a process that runs an event loop and threads isn't safe
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.info(
+                "Password hasher started (%s processes, max %s pending)",
+                self.workers, self.max_pending
+            )
+
+    async def stop(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(security.get_password_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(security.verify_password, password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+        }
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        try:
+            if self._pool is None:
+                # not started (scripts), keep the event loop free anyway
+                return await asyncio.to_thread(func, *args)
+            return await asyncio.get_running_loop().run_in_executor(
+                self._pool, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,119 @@
+import asyncio
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud
+from .database import SessionLocal
+from .logger import logger
+from .websocket import manager
+from .wire import Frame
+
+# receipts for the same conversation arriving within this window share one write
+READ_RECEIPT_WINDOW_MS = float(os.getenv("READ_RECEIPT_WINDOW_MS", "50"))
+
+
+class ReadReceiptCoalescer:
+    """Merges rapid "read up to" receipts per (reader, contact) into one write.
+
+    A client scrolling through unread messages reports each one as it comes
+    into view. Receipts for the same conversation within the window collapse
+    into the highest id, written once, and every caller gets the resulting
+    conversation summary. The contact's sockets get a single "read" event.
+    """
+
+    def __init__(
+        self, window_ms: float = READ_RECEIPT_WINDOW_MS, session_factory=SessionLocal
+    ):
+        self.window = window_ms / 1000
+        self.session_factory = session_factory
+        self._pending: Dict[Tuple[str, str], Tuple[int, List[asyncio.Future]]] = {}
+        # keeps the flush tasks referenced until they finish
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(
+        self, reader_username: str, contact_username: str, up_to_id: int
+    ) -> Optional[dict]:
+        """Marks the conversation read up to `up_to_id`, returns its summary."""
+        key = (reader_username, contact_username)
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = (up_to_id, [future])
+            task = asyncio.create_task(self._flush_after_window(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._pending[key] = (max(pending[0], up_to_id), pending[1] + [future])
+        return await future
+
+    async def _flush_after_window(self, key: Tuple[str, str]):
+        if self.window > 0:
+            await asyncio.sleep(self.window)
+        up_to_id, futures = self._pending.pop(key)
+        reader_username, contact_username = key
+        try:
+            marked, conversation = await run_in_threadpool(
+                self._write, reader_username, contact_username, up_to_id
+            )
+        except Exception as e:
+            logger.error(
+                "Saving read receipt of '%s' for '%s' failed: %s",
+                reader_username, contact_username, e,
+                exc_info=True,
+            )
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(futures) > 1:
+            logger.debug(
+                "Coalesced %s read receipts of '%s' for '%s'",
+                len(futures), reader_username, contact_username
+            )
+        for future in futures:
+            if not future.done():
+                future.set_result(conversation)
+        if marked and conversation is not None:
+            await self._notify(reader_username, contact_username, up_to_id, conversation)
+
+    async def _notify(
+        self,
+        reader_username: str,
+        contact_username: str,
+        up_to_id: int,
+        conversation: dict,
+    ):
+        try:
+            # the sender's messages up to this id now show as read
+            await manager.send_personal_message(
+                Frame.from_event(
+                    {
+                        "type": "read",
+                        "data": {"reader": reader_username, "up_to_id": up_to_id},
+                    }
+                ),
+                contact_username,
+            )
+            # the reader's other devices update their unread badge
+            await manager.send_personal_message(
+                Frame.from_event({"type": "conversation_update", "data": conversation}),
+                reader_username,
+            )
+        except Exception as e:
+            logger.error("Sending read receipt events failed: %s", e, exc_info=True)
+
+    def _write(self, reader_username: str, contact_username: str, up_to_id: int):
+        db = self.session_factory()
+        try:
+            marked = crud.mark_messages_read_up_to(
+                db, reader_username, contact_username, up_to_id
+            )
+            return marked, crud.get_conversation(db, reader_username, contact_username)
+        finally:
+            db.close()
+
+
+read_receipts = ReadReceiptCoalescer()
@@ -0,0 +1,35 @@
+import json
+from typing import Any, Iterable, Sequence
+
+from fastapi.responses import JSONResponse
+
+from .wire import encode_default
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the stdlib encoder
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson when it is installed.
+
+    Returned straight from a route it skips the `response_model` pass, so
+    only hand it data that already has the schema's shape.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return json.dumps(
+            content, separators=(",", ":"), default=encode_default
+        ).encode("utf-8")
+
+
+def rows_response(rows: Sequence, fields: Iterable[str] = ()) -> FastJSONResponse:
+    """A JSON list of objects built from column tuples, keyed by `fields`.
+
+    `fields` defaults to the rows' own column names (SQLAlchemy `Row._fields`).
+    """
+    fields = tuple(fields) or (rows[0]._fields if rows else ())
+    return FastJSONResponse([dict(zip(fields, row)) for row in rows])
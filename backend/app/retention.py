@@ -0,0 +1,225 @@
+import asyncio
+import os
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud
+from .database import SessionLocal, engine
+from .logger import logger
+from .models import utcnow
+from .sessions import session_store
+
+# read messages beyond this many per conversation are archived, 0 keeps them all live
+MESSAGE_LIVE_LIMIT = int(os.getenv("MESSAGE_LIVE_LIMIT", "0"))
+# read messages older than this are archived, 0 never archives by age
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "0"))
+# archived messages older than this are deleted for good, 0 keeps them forever
+MESSAGE_ARCHIVE_RETENTION_DAYS = float(os.getenv("MESSAGE_ARCHIVE_RETENTION_DAYS", "0"))
+# how often every worker runs the job, 0 leaves it to `python -m app.maintenance archive`
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_INTERVAL_SECONDS", "3600"))
+# rows per transaction, and the pause between transactions so chat writes
+# never wait long behind the job (SQLite has a single writer)
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+MAINTENANCE_BATCH_PAUSE_SECONDS = float(os.getenv("MAINTENANCE_BATCH_PAUSE_SECONDS", "0.1"))
+# free pages handed back to the filesystem per run, 0 for all of them
+SQLITE_INCREMENTAL_VACUUM_PAGES = int(os.getenv("SQLITE_INCREMENTAL_VACUUM_PAGES", "2000"))
+
+
+def optimize(bind=engine):
+    """Refreshes the planner statistics, and on SQLite returns free pages to the filesystem.
+
+    Cheap enough to run after every retention pass, unlike `vacuum`.
+    """
+    with bind.connect() as connection:
+        if connection.dialect.name == "sqlite":
+            # only analyzes the tables whose statistics are stale
+            connection.exec_driver_sql("PRAGMA optimize")
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+                connection.commit()
+                # `execute` steps the pragma once and frees a single page,
+                # `executescript` runs it to completion
+                connection.connection.driver_connection.executescript(
+                    f"PRAGMA incremental_vacuum({SQLITE_INCREMENTAL_VACUUM_PAGES});"
+                )
+        else:
+            connection.exec_driver_sql("ANALYZE messages, message_archive")
+        connection.commit()
+
+
+def vacuum(bind=engine):
+    """Full VACUUM, rewrites the whole SQLite file under an exclusive lock.
+
+    Also switches an existing SQLite database to incremental auto_vacuum,
+    which only new ones get from the connection pragmas. Run it from the
+    command line in a quiet hour, never from a worker.
+    """
+    with bind.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if connection.dialect.name == "sqlite":
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+        else:
+            connection.exec_driver_sql("VACUUM (ANALYZE) messages, message_archive")
+
+
+class RetentionJob:
+    """Moves old read messages into `message_archive` and expires the archive.
+
+    Expired login sessions (`auth_sessions`) are deleted on every pass too.
+
+    Every worker runs it, `crud.archive_messages_batch` deletes with
+    RETURNING so concurrent runs never archive a message twice. Work is done
+    in bounded transactions with a pause in between, each in the threadpool.
+    The newest message of a conversation always stays live, it is what the
+    conversation list shows.
+    """
+
+    def __init__(
+        self,
+        live_limit: int = MESSAGE_LIVE_LIMIT,
+        archive_after_days: float = MESSAGE_ARCHIVE_AFTER_DAYS,
+        retention_days: float = MESSAGE_ARCHIVE_RETENTION_DAYS,
+        interval: float = MAINTENANCE_INTERVAL_SECONDS,
+        batch_size: int = MAINTENANCE_BATCH_SIZE,
+        batch_pause: float = MAINTENANCE_BATCH_PAUSE_SECONDS,
+        session_factory=SessionLocal,
+        bind=engine,
+        sessions=session_store,
+    ):
+        self.live_limit = live_limit
+        self.archive_after_days = archive_after_days
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.session_factory = session_factory
+        self.bind = bind
+        self.sessions = sessions
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> Dict[str, int]:
+        """One full pass: archive, purge, expire sessions, optimize. Returns the counts."""
+        archived = purged = 0
+        if self.live_limit > 0 or self.archive_after_days > 0:
+            archived = await self._archive()
+        if self.retention_days > 0:
+            purged = await self._purge()
+        expired = await self._expire_sessions()
+        await run_in_threadpool(optimize, self.bind)
+        if archived or purged or expired:
+            logger.info(
+                "Retention: archived %s messages, purged %s archive chunks, %s expired sessions.",
+                archived, purged, expired
+            )
+        return {"archived": archived, "purged": purged, "expired_sessions": expired}
+
+    async def _run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error("Message retention failed: %s", e, exc_info=True)
+
+    async def _archive(self) -> int:
+        older_than = None
+        if self.archive_after_days > 0:
+            older_than = utcnow() - timedelta(days=self.archive_after_days)
+        archived = 0
+        after = None
+        while True:
+            keys = await run_in_threadpool(self._conversation_keys, after)
+            if not keys:
+                return archived
+            for user_a, user_b in keys:
+                below_id, up_to_id = await run_in_threadpool(self._limits, user_a, user_b)
+                if below_id is None:
+                    continue
+                while True:
+                    moved = await run_in_threadpool(
+                        self._archive_batch, user_a, user_b, below_id, up_to_id, older_than
+                    )
+                    archived += moved
+                    if moved:
+                        await asyncio.sleep(self.batch_pause)
+                    if moved < self.batch_size:
+                        break
+            after = keys[-1]
+
+    async def _purge(self) -> int:
+        older_than = utcnow() - timedelta(days=self.retention_days)
+        purged = 0
+        while True:
+            deleted = await run_in_threadpool(self._purge_batch, older_than)
+            purged += deleted
+            if deleted < self.batch_size:
+                return purged
+            await asyncio.sleep(self.batch_pause)
+
+    async def _expire_sessions(self) -> int:
+        expired = 0
+        while True:
+            deleted = await run_in_threadpool(self.sessions.purge_expired, self.batch_size)
+            expired += deleted
+            if deleted < self.batch_size:
+                return expired
+            await asyncio.sleep(self.batch_pause)
+
+    def _conversation_keys(self, after: Optional[Tuple[str, str]]):
+        db = self.session_factory()
+        try:
+            return crud.get_conversation_keys(db, after, self.batch_size)
+        finally:
+            db.close()
+
+    def _limits(self, user_a: str, user_b: str) -> Tuple[Optional[int], Optional[int]]:
+        """The conversation's newest message id, and the id the live limit keeps from."""
+        db = self.session_factory()
+        try:
+            newest_id = crud.get_nth_newest_message_id(db, user_a, user_b, 1)
+            up_to_id = None
+            if newest_id is not None and self.live_limit > 0:
+                up_to_id = crud.get_nth_newest_message_id(db, user_a, user_b, self.live_limit)
+            return newest_id, up_to_id
+        finally:
+            db.close()
+
+    def _archive_batch(self, user_a, user_b, below_id, up_to_id, older_than) -> int:
+        db = self.session_factory()
+        try:
+            return crud.archive_messages_batch(
+                db,
+                user_a,
+                user_b,
+                below_id,
+                self.batch_size,
+                up_to_id=up_to_id,
+                older_than=older_than,
+            )
+        finally:
+            db.close()
+
+    def _purge_batch(self, older_than) -> int:
+        db = self.session_factory()
+        try:
+            return crud.purge_archive(db, older_than, self.batch_size)
+        finally:
+            db.close()
+
+
+retention_job = RetentionJob()
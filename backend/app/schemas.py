@@ -1,7 +1,16 @@
-from datetime import datetime, timezone
-from typing import Optional
+from datetime import datetime
+from typing import Annotated, Optional
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, PlainSerializer
+
+from .models import utcnow
+
+# ISO 8601 with "+00:00", as `datetime.isoformat` and orjson write it, so
+# every response path formats timestamps the same (pydantic would use "Z")
+Timestamp = Annotated[
+    datetime,
+    PlainSerializer(lambda value: value.isoformat(), return_type=str, when_used="json"),
+]
 
 
 class User(BaseModel):
@@ -23,6 +32,9 @@ class Token(BaseModel):
 
     access_token: str
     token_type: str
+    # seconds until the access token expires, renew it with the refresh token
+    expires_in: Optional[int] = None
+    refresh_token: Optional[str] = None
 
 
 class TokenWithUser(Token):
@@ -32,15 +44,17 @@ class TokenWithUser(Token):
     username: str
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
 class MessageBase(BaseModel):
     """Base message schema."""
 
     sender: str
     recipient: str
     text: str
-    timestamp: str = Field(
-        default_factory=lambda: datetime.now(timezone.utc).isoformat()
-    )
+    timestamp: Timestamp = Field(default_factory=utcnow)
     is_read: bool = False
 
 
@@ -60,11 +74,20 @@ class Message(MessageBase):
 class Conversation(BaseModel):
     username: str
     name: str
+    # the counters below cover every message up to this id, clients skip
+    # older message events (a reconnect catch-up replays some)
+    last_message_id: Optional[int] = None
     last_message: Optional[str] = None
-    last_message_timestamp: Optional[str] = None
+    last_message_timestamp: Optional[Timestamp] = None
     unread_count: int = 0
     model_config = ConfigDict(from_attributes=True)
 
 
 class ReadReceipt(BaseModel):
     message_id: int
+
+
+class ConversationReadReceipt(BaseModel):
+    """Marks every message from the contact up to and including `up_to_id` as read."""
+
+    up_to_id: int
@@ -1,21 +1,31 @@
 import os
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 
+from .cache import MISSING, token_cache
 from .logger import logger
+from .sessions import session_store
 
 # Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "a_very_secret_key_for_enkrypt_chan")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 60 * 24 * 30  # 30 days
+# access tokens are short-lived, clients renew them with their session's
+# refresh token (see `sessions.py`)
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+# bcrypt cost factor, every +1 doubles the time per hash. Stored hashes with
+# another cost are rehashed on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # For HTTP endpoints
 
+# broker channel that spreads revocations to every worker's token cache
+TOKEN_REVOCATION_CHANNEL = "auth:revoked"
+
 
 def verify_password(plain_password, hashed_password):
     """Verifies a plain password against a hashed password using bcrypt."""
@@ -28,16 +38,36 @@ def verify_password(plain_password, hashed_password):
     return verified
 
 
-def get_password_hash(password):
+def get_password_hash(password, rounds: int = BCRYPT_ROUNDS):
     """Hashes a password using bcrypt."""
     logger.debug("Hashing password.")
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return bcrypt.hashpw(
+        password.encode("utf-8"), bcrypt.gensalt(rounds=rounds)
+    ).decode("utf-8")
+
+
+def password_needs_rehash(hashed_password: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    """Whether a stored hash was made with a different cost factor than configured."""
+    # "$2b$12$<salt and hash>"
+    try:
+        return int(hashed_password.split("$")[2]) != rounds
+    except (IndexError, ValueError):
+        return True
+
 
+class AccessTokenClaims(NamedTuple):
+    username: str
+    session_id: Optional[str]
+    expires_at: float
 
-# TODO: add auto refresh of access token if user is active
-def create_access_token(username: str, expires_delta: Optional[timedelta] = None):
-    """Creates a JWT access token with an expiration time."""
-    logger.debug(f"Creating access token for user: {username}")
+
+def create_access_token(
+    username: str,
+    session_id: Optional[str] = None,
+    expires_delta: Optional[timedelta] = None,
+):
+    """Creates a JWT access token for a session with an expiration time."""
+    logger.debug("Creating access token for user: %s", username)
     if not username:
         raise ValueError("Username must be provided for token creation")
 
@@ -48,29 +78,80 @@ def create_access_token(username: str, expires_delta: Optional[timedelta] = None
             minutes=ACCESS_TOKEN_EXPIRE_MINUTES
         )
 
-    to_encode = {"data": username, "exp": expire}
+    to_encode = {"data": username, "sid": session_id, "exp": expire}
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def decode_access_token(token: str):
-    """Decodes the access token and returns the username."""
+def decode_access_token(token: str) -> Optional[AccessTokenClaims]:
+    """Verifies the access token and returns its claims.
+
+    Tokens that verified before are answered from `token_cache` until they
+    expire, revoked ones are rejected without decoding. The session isn't
+    checked here, see `authenticate`.
+    """
+    key = token_cache.key(token)
+    claims = token_cache.get(key)
+    if claims is not MISSING:
+        if claims is None:
+            logger.warning("Rejected a revoked access token.")
+        return claims
+
     logger.debug("Attempting to decode access token.")
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("data")
-        return username
     except JWTError as e:
         logger.warning(
-            f"Failed to decode access token due to JWTError: {e}", exc_info=True
+            "Failed to decode access token due to JWTError: %s", e, exc_info=True
         )
         return None
+    if not payload.get("data") or "exp" not in payload:
+        return None
+    claims = AccessTokenClaims(payload["data"], payload.get("sid"), float(payload["exp"]))
+    token_cache.put(key, claims, claims.expires_at)
+    return claims
+
+
+async def authenticate(token: str) -> Optional[AccessTokenClaims]:
+    """The claims of a valid access token whose session is still active."""
+    claims = decode_access_token(token)
+    if claims is None:
+        return None
+    # tokens from before sessions existed can't be revoked, they're refused
+    if not claims.session_id or not await session_store.is_active(claims.session_id):
+        logger.warning("Rejected an access token of '%s': session not active.", claims.username)
+        return None
+    return claims
+
+
+def revoke_access_token(token: str) -> str:
+    """Revokes a token in this process, returns the message for other workers.
+
+    Publish it on `TOKEN_REVOCATION_CHANNEL`, `on_token_revoked` applies it.
+    """
+    # only called with tokens that just verified, the claims can be trusted
+    expires_at = float(jwt.get_unverified_claims(token).get("exp", 0))
+    key = token_cache.key(token)
+    token_cache.revoke(key, expires_at)
+    return f"{key.hex()}:{expires_at}"
+
+
+async def on_token_revoked(message: str) -> bool:
+    """Broker handler for `TOKEN_REVOCATION_CHANNEL`."""
+    key, _, expires_at = message.partition(":")
+    token_cache.revoke(bytes.fromhex(key), float(expires_at))
+    return True
+
 
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    """Dependency for HTTP routes to get the current user from a token.
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    """Dependency for HTTP routes to get the current user from a token."""
-    username = decode_access_token(token)
-    if username is None:
+    Async so it runs on the event loop instead of costing every request a
+    threadpool hop, a cache hit is a dict lookup and a miss one HMAC check.
+    The session check is answered from `session_store`'s cache as well.
+    """
+    claims = await authenticate(token)
+    if claims is None:
         logger.warning(
             "Authentication failed: could not validate credentials from token."
         )
@@ -79,4 +160,4 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return {"username": username}
+    return {"username": claims.username, "session_id": claims.session_id}
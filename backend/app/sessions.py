@@ -0,0 +1,220 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from sqlalchemy import delete, select, update
+from starlette.concurrency import run_in_threadpool
+
+from . import models
+from .database import SessionLocal
+from .logger import logger
+
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+# a session's state is re-read from the database at most this often, broker
+# messages make revocations take effect before that
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "30"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+# two tabs refreshing at once present the same token, the loser of that race
+# is told to retry instead of being treated as a replayed stolen token
+REFRESH_REUSE_GRACE_SECONDS = int(os.getenv("REFRESH_REUSE_GRACE_SECONDS", "10"))
+
+# broker channel that spreads session revocations to every worker
+SESSION_REVOCATION_CHANNEL = "auth:sessions_revoked"
+
+
+class RefreshTokenRaced(Exception):
+    """The token was rotated by a concurrent refresh moments ago.
+
+    Not an attack, the client should pick up the winner's new token.
+    """
+
+
+class RefreshTokenReplayed(Exception):
+    """A token rotated away long ago came back, its session was revoked."""
+
+    def __init__(self, session_id: str):
+        super().__init__(session_id)
+        self.session_id = session_id
+
+
+class RefreshResult(NamedTuple):
+    session_id: str
+    username: str
+    refresh_token: str
+
+
+def _hash_refresh_token(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode("utf-8")).hexdigest()
+
+
+class SessionStore:
+    """Server-side login sessions behind the short-lived access tokens.
+
+    Every access token names its session, `is_active` is asked on each
+    request and answered from an in-memory LRU that re-checks the database
+    every `SESSION_CACHE_TTL_SECONDS`, so revoking a session (logout, a
+    replayed refresh token) locks its tokens out without a query per request.
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        cache_ttl: float = SESSION_CACHE_TTL_SECONDS,
+        cache_size: int = SESSION_CACHE_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # session id -> (checked at, active)
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, username: str) -> RefreshResult:
+        """Opens a session, returns it with its first refresh token."""
+        refresh_token = secrets.token_urlsafe(32)
+        now = int(time.time())
+        session_id = uuid.uuid4().hex
+        auth_session = models.AuthSession(
+            id=session_id,
+            username=username,
+            refresh_token_hash=_hash_refresh_token(refresh_token),
+            rotated_at=now,
+            expires_at=now + REFRESH_TOKEN_EXPIRE_DAYS * 86400,
+        )
+        db = self.session_factory()
+        try:
+            db.add(auth_session)
+            db.commit()
+        finally:
+            db.close()
+        self._remember(session_id, True)
+        return RefreshResult(session_id, username, refresh_token)
+
+    def rotate(self, refresh_token: str) -> Optional[RefreshResult]:
+        """Swaps a refresh token for a new one, `None` if it isn't valid.
+
+        Presenting a token that was already rotated away means it was copied
+        and revokes the session (`RefreshTokenReplayed`, the caller spreads
+        the revocation), unless it happened within the grace period or lost
+        a concurrent rotation (`RefreshTokenRaced`).
+        """
+        token_hash = _hash_refresh_token(refresh_token)
+        now = int(time.time())
+        sessions = models.AuthSession
+        db = self.session_factory()
+        try:
+            auth_session = (
+                db.query(sessions).filter(sessions.refresh_token_hash == token_hash).first()
+            )
+            if auth_session is None:
+                replayed = (
+                    db.query(sessions)
+                    .filter(sessions.previous_refresh_token_hash == token_hash)
+                    .first()
+                )
+                if replayed is not None and not replayed.revoked:
+                    if now - replayed.rotated_at <= REFRESH_REUSE_GRACE_SECONDS:
+                        raise RefreshTokenRaced()
+                    logger.warning(
+                        "Refresh token of session %s ('%s') was replayed, revoking it.",
+                        replayed.id, replayed.username
+                    )
+                    self._revoke(db, replayed.id)
+                    raise RefreshTokenReplayed(replayed.id)
+                return None
+            if auth_session.revoked or auth_session.expires_at <= now:
+                return None
+            session_id, username = auth_session.id, auth_session.username
+
+            new_refresh_token = secrets.token_urlsafe(32)
+            # conditional on the old hash, of two concurrent rotations one wins
+            result = db.execute(
+                update(sessions)
+                .where(
+                    sessions.id == session_id,
+                    sessions.refresh_token_hash == token_hash,
+                )
+                .values(
+                    refresh_token_hash=_hash_refresh_token(new_refresh_token),
+                    previous_refresh_token_hash=token_hash,
+                    rotated_at=now,
+                    expires_at=now + REFRESH_TOKEN_EXPIRE_DAYS * 86400,
+                )
+            )
+            db.commit()
+            if result.rowcount != 1:
+                raise RefreshTokenRaced()
+            return RefreshResult(session_id, username, new_refresh_token)
+        finally:
+            db.close()
+
+    def revoke(self, session_id: str):
+        db = self.session_factory()
+        try:
+            self._revoke(db, session_id)
+        finally:
+            db.close()
+
+    def purge_expired(self, limit: int) -> int:
+        """Deletes up to `limit` expired sessions, their tokens can't be used anymore."""
+        sessions = models.AuthSession
+        ids = select(sessions.id).where(sessions.expires_at <= int(time.time())).limit(limit)
+        db = self.session_factory()
+        try:
+            result = db.execute(
+                delete(sessions.__table__).where(sessions.id.in_(ids.scalar_subquery()))
+            )
+            db.commit()
+            return result.rowcount
+        finally:
+            db.close()
+
+    def mark_revoked(self, session_id: str):
+        """Updates the cache only, for revocations done by another worker."""
+        self._remember(session_id, False)
+
+    async def is_active(self, session_id: str) -> bool:
+        with self._lock:
+            entry = self._cache.get(session_id)
+            if entry is not None and entry[0] + self.cache_ttl > time.monotonic():
+                self._cache.move_to_end(session_id)
+                return entry[1]
+        active = await run_in_threadpool(self._load_active, session_id)
+        self._remember(session_id, active)
+        return active
+
+    def _load_active(self, session_id: str) -> bool:
+        db = self.session_factory()
+        try:
+            auth_session = db.get(models.AuthSession, session_id)
+            return (
+                auth_session is not None
+                and not auth_session.revoked
+                and auth_session.expires_at > time.time()
+            )
+        finally:
+            db.close()
+
+    def _revoke(self, db, session_id: str):
+        db.execute(
+            update(models.AuthSession)
+            .where(models.AuthSession.id == session_id)
+            .values(revoked=True)
+        )
+        db.commit()
+        self._remember(session_id, False)
+
+    def _remember(self, session_id: str, active: bool):
+        with self._lock:
+            self._cache[session_id] = (time.monotonic(), active)
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+session_store = SessionStore()
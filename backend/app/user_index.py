@@ -0,0 +1,196 @@
+import asyncio
+import os
+import threading
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from . import models
+from .database import SessionLocal
+from .logger import logger
+
+# users registered on other workers show up in this process's index this often
+USER_INDEX_REFRESH_SECONDS = float(os.getenv("USER_INDEX_REFRESH_SECONDS", "5"))
+USER_SEARCH_DEFAULT_LIMIT = 20
+# ids can commit out of order across workers, each refresh re-reads this many
+REFRESH_OVERLAP = 100
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def _name_keys(name: str) -> List[str]:
+    """The lowercased name from every word on, so "tab" finds "Bobby Tables"."""
+    words = name.lower().split()
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+class UserSearchIndex:
+    """In-memory user search, ranked exact > username prefix > name prefix > substring.
+
+    Prefix matches are bisects into sorted key lists, substring matches walk
+    the rarest trigram's posting list. Every tier is read in sorted order and
+    the search stops once `limit` users are found, so a one letter query
+    doesn't touch every user. Queries shorter than three characters only
+    match exactly or by prefix.
+
+    Loaded from the database in the background on startup (about 2.5s per
+    100k users), `ready` tells callers when to stop falling back to the
+    database. Registrations on this process are added right away, ones from
+    other workers on the next refresh.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float = USER_INDEX_REFRESH_SECONDS,
+        session_factory=SessionLocal,
+    ):
+        self.refresh_interval = refresh_interval
+        self.session_factory = session_factory
+        self._lock = threading.Lock()
+        self._names: Dict[str, str] = {}
+        self._by_lower_username: Dict[str, str] = {}
+        self._by_lower_name: Dict[str, List[str]] = {}
+        # sorted (key, username) pairs
+        self._username_keys: List[Tuple[str, str]] = []
+        self._name_keys: List[Tuple[str, str]] = []
+        # trigram -> sorted usernames
+        self._postings: Dict[str, List[str]] = {}
+        self._max_id = 0
+        self.ready = False
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._load_and_refresh())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def refresh(self):
+        """Adds users created since the last refresh, by any process."""
+        db = self.session_factory()
+        try:
+            rows = (
+                db.query(models.User.id, models.User.username, models.User.name)
+                .filter(models.User.id > self._max_id - REFRESH_OVERLAP)
+                .order_by(models.User.id)
+                .all()
+            )
+        finally:
+            db.close()
+        if rows:
+            self.add_many(rows)
+            self._max_id = max(self._max_id, rows[-1].id)
+
+    def add(self, user_id: int, username: str, name: str):
+        """Adds a user registered by this process, already indexed users are skipped."""
+        self.add_many([(user_id, username, name)])
+
+    def add_many(self, users: Iterable[Tuple[int, str, str]]):
+        users = list(users)
+        # appending and sorting once beats an insort per key for bulk loads
+        bulk = len(users) > 100
+        add_key = list.append if bulk else insort
+        with self._lock:
+            postings = self._postings
+            for _, username, name in users:
+                if username in self._names:
+                    continue
+                lowered_username, lowered_name = username.lower(), name.lower()
+                self._names[username] = name
+                self._by_lower_username[lowered_username] = username
+                self._by_lower_name.setdefault(lowered_name, []).append(username)
+                add_key(self._username_keys, (lowered_username, username))
+                for key in _name_keys(name):
+                    add_key(self._name_keys, (key, username))
+                for trigram in _trigrams(lowered_username) | _trigrams(lowered_name):
+                    posting = postings.get(trigram)
+                    if posting is None:
+                        postings[trigram] = [username]
+                    else:
+                        add_key(posting, username)
+            if bulk:
+                self._username_keys.sort()
+                self._name_keys.sort()
+                for posting in postings.values():
+                    posting.sort()
+
+    def search(self, query: str, limit: int = USER_SEARCH_DEFAULT_LIMIT) -> List[dict]:
+        query = query.strip().lower()
+        if not query or limit <= 0:
+            return []
+
+        found: List[str] = []
+        seen: Set[str] = set()
+
+        def collect(usernames: Iterable[str]) -> bool:
+            """Adds matches in order, returns True once the limit is reached."""
+            for username in usernames:
+                if username not in seen:
+                    seen.add(username)
+                    found.append(username)
+                    if len(found) >= limit:
+                        return True
+            return False
+
+        with self._lock:
+            exact = []
+            if query in self._by_lower_username:
+                exact.append(self._by_lower_username[query])
+            exact.extend(sorted(self._by_lower_name.get(query, ())))
+            done = (
+                collect(exact)
+                or collect(self._prefixed(self._username_keys, query))
+                or collect(self._prefixed(self._name_keys, query))
+            )
+            if not done and len(query) >= 3:
+                collect(self._containing(query))
+            return [{"username": u, "name": self._names[u]} for u in found]
+
+    @staticmethod
+    def _prefixed(keys: List[Tuple[str, str]], prefix: str) -> Iterator[str]:
+        for i in range(bisect_left(keys, (prefix,)), len(keys)):
+            key, username = keys[i]
+            if not key.startswith(prefix):
+                return
+            yield username
+
+    def _containing(self, query: str) -> Iterator[str]:
+        postings = [self._postings.get(trigram) for trigram in _trigrams(query)]
+        if not all(postings):
+            return
+        # every match is in the rarest trigram's list, check it for the whole query
+        for username in min(postings, key=len):
+            if query in username.lower() or query in self._names[username].lower():
+                yield username
+
+    async def _load_and_refresh(self):
+        while not self.ready:
+            try:
+                await run_in_threadpool(self.refresh)
+                self.ready = True
+                logger.info("User search index loaded with %s users.", len(self))
+            except Exception as e:
+                logger.error("Loading the user search index failed: %s", e, exc_info=True)
+                await asyncio.sleep(self.refresh_interval or 1)
+        while self.refresh_interval > 0:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception as e:
+                logger.error("Refreshing the user search index failed: %s", e, exc_info=True)
+
+
+user_index = UserSearchIndex()
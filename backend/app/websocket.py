@@ -1,44 +1,370 @@
-from typing import Dict
+import asyncio
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
 
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
 
+from .broker import Broker, create_broker
+from .delivery import delivery_tracker
 from .logger import logger
+from .metrics import websocket_connections
+from .wire import DEFAULT_FORMAT, Encoded, Frame, decode
 
+# a device that takes longer than this to accept a frame is dropped
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "5"))
+# outbound frames buffered per socket before the overflow policy kicks in
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# "drop_oldest" keeps the socket and loses its oldest queued frames,
+# "disconnect" closes it with SLOW_CONSUMER_CLOSE_CODE, the client then
+# reconnects and catches up from its delivery cursor
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "disconnect")
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+# clients get a "reauth_required" event this long before their access token
+# expires and answer with {"type": "auth", "token": <new access token>}
+WS_REAUTH_LEAD_SECONDS = float(os.getenv("WS_REAUTH_LEAD_SECONDS", "60"))
 
-    async def connect(self, websocket: WebSocket, username: str):
-        await websocket.accept()
-        self.active_connections[username] = websocket
-        logger.info(f"User '{username}' connected")
+SLOW_CONSUMER_CLOSE_CODE = 4029
+# access token expired without a re-auth, or its session was revoked
+AUTH_EXPIRED_CLOSE_CODE = 4001
 
-    async def disconnect(self, username: str):
-        if username not in self.active_connections:
-            return
-        conn = self.active_connections.pop(username, None)
-        if conn.client_state == WebSocketState.CONNECTED:
-            await conn.close()
-        logger.info(f"User '{username}' disconnected")
-
-    async def send_personal_message(self, message: str, recipient: str):
-        if recipient in self.active_connections:
-            websocket = self.active_connections[recipient]
-            if websocket.client_state == WebSocketState.CONNECTED:
-                logger.debug(f"Sending message to '{recipient}'.")
-                await websocket.send_text(message)
-            else:
+
+def user_channel(username: str) -> str:
+    return f"user:{username}"
+
+
+def pack_frame(frame: Frame, message_id: Optional[int] = None) -> str:
+    """Broker payload, the frame prefixed with the id of the message it delivers (if any)."""
+    return f"{message_id or ''}:{frame.payload}"
+
+
+def unpack_frame(payload: str) -> Tuple[str, Optional[int]]:
+    """The frame's payload and message id of a broker payload."""
+    message_id, _, frame = payload.partition(":")
+    return frame, int(message_id) if message_id else None
+
+
+class Connection:
+    """One socket with a bounded outbound queue drained by its own writer task.
+
+    Queueing never waits on the network, so a stalled recipient can't block
+    whoever is sending to it, and the queue caps the memory a socket can hold.
+    Frames are encoded in the socket's negotiated `wire_format` on the way out.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        username: str,
+        on_close: Callable[["Connection", int], Awaitable[None]],
+        on_delivered: Optional[Callable[[str, int], None]] = None,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        overflow_policy: str = WS_OVERFLOW_POLICY,
+        send_timeout: float = WS_SEND_TIMEOUT_SECONDS,
+        wire_format: str = DEFAULT_FORMAT,
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown websocket overflow policy: {overflow_policy!r}")
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.username = username
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.wire_format = wire_format
+        self.dropped = 0
+        self.closed = False
+        self.close_code = 1000
+        # deliveries are reported once the reconnect catch-up is written: a
+        # live frame sent meanwhile may be ahead of messages not replayed yet
+        self.caught_up = False
+        self.session_id: Optional[str] = None
+        self.auth_expires_at: Optional[float] = None
+        self._on_close = on_close
+        self._on_delivered = on_delivered
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._writer: Optional[asyncio.Task] = None
+        self._auth_watcher: Optional[asyncio.Task] = None
+        # set by `close`, wakes up senders waiting for room in the queue
+        self._closing = asyncio.Event()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+
+    def authenticated(self, session_id: Optional[str], expires_at: float):
+        """Records the access token the socket runs on, at connect and on every re-auth."""
+        self.session_id = session_id
+        self.auth_expires_at = expires_at
+        if self._auth_watcher is not None:
+            self._auth_watcher.cancel()
+        if not self.closed:
+            self._auth_watcher = asyncio.create_task(self._watch_auth(expires_at))
+
+    def enqueue(self, frame: Frame, message_id: Optional[int] = None) -> bool:
+        """Queues a frame without waiting, applying the overflow policy when full.
+
+        `message_id` is reported to `on_delivered` once the frame is sent,
+        if the socket is caught up by then.
+        """
+        if self.closed:
+            return False
+        if self._queue.full():
+            if self.overflow_policy == "disconnect":
                 logger.warning(
-                    f"Cannot send message: recipient '{recipient}' websocket is not in connected state."
+                    "Send queue of '%s' (%s) is full, disconnecting slow consumer.",
+                    self.username, self.id
+                )
+                asyncio.create_task(self.close(SLOW_CONSUMER_CLOSE_CODE))
+                return False
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait((frame, message_id, False))
+        return True
+
+    async def send(
+        self, frame: Frame, message_id: Optional[int] = None, completes_catch_up: bool = False
+    ):
+        """Queues a frame, waiting for room instead of applying the overflow policy.
+
+        For bulk senders like the reconnect catch-up, which should slow down
+        to the socket's pace rather than overflow it. Once a frame with
+        `completes_catch_up` is written the socket is caught up and reports
+        its deliveries. Raises `WebSocketDisconnect` once the socket is
+        closed, also while waiting: the writer is gone then and the queue
+        never drains.
+        """
+        if self.closed:
+            raise WebSocketDisconnect(self.close_code)
+        item = (frame, message_id, completes_catch_up)
+        if not self._queue.full():
+            self._queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(self._queue.put(item))
+        closing = asyncio.ensure_future(self._closing.wait())
+        try:
+            done, _ = await asyncio.wait((put, closing), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            put.cancel()
+            closing.cancel()
+        if put not in done:
+            raise WebSocketDisconnect(self.close_code)
+
+    async def receive(self) -> Encoded:
+        """The next inbound frame, text or binary depending on the wire format."""
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        data = message.get("text")
+        return message.get("bytes") if data is None else data
+
+    def decode(self, data: Encoded) -> dict:
+        return decode(data, self.wire_format)
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        self._closing.set()
+        for task in (self._writer, self._auth_watcher):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        await self._on_close(self, code)
+        if self.websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close(code=code)
+            except Exception as e:
+                logger.debug("Closing the socket of '%s' failed: %s", self.username, e)
+
+    async def _watch_auth(self, expires_at: float):
+        """Asks for a fresh token before this one expires, closes if none came."""
+        await asyncio.sleep(max(0.0, expires_at - WS_REAUTH_LEAD_SECONDS - time.time()))
+        self.enqueue(
+            Frame.from_event({"type": "reauth_required", "data": {"expires_at": expires_at}})
+        )
+        await asyncio.sleep(max(0.0, expires_at - time.time()))
+        logger.info("Access token of '%s' (%s) expired without re-auth.", self.username, self.id)
+        await self.close(AUTH_EXPIRED_CLOSE_CODE)
+
+    async def _write(self):
+        while True:
+            frame, message_id, completes_catch_up = await self._queue.get()
+            try:
+                data = frame.encoded(self.wire_format)
+                send = (
+                    self.websocket.send_bytes(data)
+                    if isinstance(data, bytes)
+                    else self.websocket.send_text(data)
                 )
-                await self.disconnect(recipient)
-        else:
-            logger.warning(
-                f"Cannot send message: recipient '{recipient}' is not connected."
+                await asyncio.wait_for(send, self.send_timeout)
+            except Exception as e:
+                # dead or stalled device, the sender never notices. Frames
+                # still queued are not reported as delivered, so the next
+                # connection catches up on them.
+                logger.warning("Sending to '%s' (%s) failed: %r", self.username, self.id, e)
+                await self.close()
+                return
+            if completes_catch_up:
+                self.caught_up = True
+            if self.caught_up and message_id is not None and self._on_delivered is not None:
+                self._on_delivered(self.username, message_id)
+
+
+class ConnectionManager:
+    """Keeps this process's sockets, delivery to them goes through the broker.
+
+    Messages are published on the recipient's channel and whichever process
+    holds the recipient's sockets delivers it, so several uvicorn workers or
+    replicas can share one redis broker. A user can have several sockets
+    (tabs, devices), each one a `Connection` with its own send queue.
+    """
+
+    def __init__(
+        self,
+        broker: Broker,
+        on_delivered: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.broker = broker
+        # called with (username, message id) once a message frame reached a socket
+        self.on_delivered = on_delivered
+        self.active_connections: Dict[str, Dict[str, Connection]] = {}
+        self.slow_consumer_disconnects = 0
+        # frames dropped by connections that are gone, live ones keep their own count
+        self._dropped_by_closed = 0
+        # frames being published by this process, by payload, so local
+        # delivery reuses their encodings instead of decoding the payload
+        self._publishing: Dict[str, Frame] = {}
+
+    async def connect(
+        self, websocket: WebSocket, username: str, subprotocol: Optional[str] = None
+    ) -> Connection:
+        """Accepts the socket, speaking `subprotocol` (see `wire.choose_format`)."""
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(
+            websocket,
+            username,
+            on_close=self._forget,
+            on_delivered=self.on_delivered,
+            wire_format=subprotocol or DEFAULT_FORMAT,
+        )
+        connections = self.active_connections.setdefault(username, {})
+        connections[connection.id] = connection
+        websocket_connections.inc()
+        connection.start()
+        # the channel is per user, subscribe with the first socket only
+        if len(connections) == 1:
+            await self.broker.subscribe(
+                user_channel(username),
+                lambda payload: self.deliver_local(payload, username),
+            )
+        logger.info(
+            "User '%s' connected (%s, %s, %s open)",
+            username, connection.id, connection.wire_format, len(connections)
+        )
+        return connection
+
+    async def disconnect(self, username: str, connection_id: str):
+        connection = self.active_connections.get(username, {}).get(connection_id)
+        if connection is not None:
+            await connection.close()
+
+    async def close_session(self, session_id: str):
+        """Closes this process's sockets that authenticated with a revoked session."""
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections.values()):
+                if connection.session_id == session_id:
+                    await connection.close(AUTH_EXPIRED_CLOSE_CODE)
+
+    async def send_personal_message(
+        self, frame: Frame, recipient: str, message_id: Optional[int] = None
+    ) -> bool:
+        """Returns whether any process holds a socket for the recipient.
+
+        Pass the stored message's id to have its delivery tracked. Sending
+        the same `Frame` to several users encodes it once per wire format.
+        """
+        self._publishing[frame.payload] = frame
+        try:
+            receivers = await self.broker.publish(
+                user_channel(recipient), pack_frame(frame, message_id)
+            )
+        finally:
+            self._publishing.pop(frame.payload, None)
+        if not receivers:
+            # picked up by the reconnect catch-up, see `DeliveryTracker`
+            logger.info(
+                "Recipient '%s' is not connected, message left for catch-up.", recipient
             )
-            # TODO: handle case where recipient is not connected, store message for later delivery or log it
+        return bool(receivers)
+
+    async def deliver_local(self, payload: str, recipient: str) -> bool:
+        """Queues a frame on every socket of the recipient held by this process.
+
+        Called by the broker. It only queues, each socket's writer task sends.
+        """
+        connections = self.active_connections.get(recipient)
+        if not connections:
+            return False
+        frame_payload, message_id = unpack_frame(payload)
+        # published by this process: the in-memory broker delivers during `publish`
+        frame = self._publishing.get(frame_payload) or Frame.from_payload(frame_payload)
+        logger.debug("Queueing message for '%s' on %s sockets.", recipient, len(connections))
+        queued = [
+            connection.enqueue(frame, message_id)
+            for connection in list(connections.values())
+        ]
+        return any(queued)
+
+    async def _forget(self, connection: Connection, code: int):
+        """Drops a closing connection from the registry, called by `Connection.close`."""
+        connections = self.active_connections.get(connection.username, {})
+        if connections.pop(connection.id, None) is None:
+            return
+        websocket_connections.dec()
+        self._dropped_by_closed += connection.dropped
+        if code == SLOW_CONSUMER_CLOSE_CODE:
+            self.slow_consumer_disconnects += 1
+        if not connections:
+            del self.active_connections[connection.username]
+            await self.broker.unsubscribe(user_channel(connection.username))
+        logger.info("User '%s' disconnected (%s)", connection.username, connection.id)
+
+    def stats(self) -> dict:
+        """Connection and send queue counts of this process, without exposing who is online."""
+        users_by_connection_count: Dict[int, int] = {}
+        connections_by_format: Dict[str, int] = {}
+        queued_frames, max_queue_depth = 0, 0
+        dropped_frames = self._dropped_by_closed
+        for connections in self.active_connections.values():
+            count = len(connections)
+            users_by_connection_count[count] = users_by_connection_count.get(count, 0) + 1
+            for connection in connections.values():
+                connections_by_format[connection.wire_format] = (
+                    connections_by_format.get(connection.wire_format, 0) + 1
+                )
+                queued_frames += connection.queue_depth
+                max_queue_depth = max(max_queue_depth, connection.queue_depth)
+                dropped_frames += connection.dropped
+        return {
+            "users": len(self.active_connections),
+            "connections": sum(
+                count * users for count, users in users_by_connection_count.items()
+            ),
+            "users_by_connection_count": users_by_connection_count,
+            "connections_by_format": connections_by_format,
+            "queued_frames": queued_frames,
+            "max_queue_depth": max_queue_depth,
+            "dropped_frames": dropped_frames,
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+        }
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    broker=create_broker(), on_delivered=delivery_tracker.delivered
+)
@@ -0,0 +1,123 @@
+import json
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+
+from .logger import logger
+
+try:
+    import orjson
+except ImportError:  # optional, the "orjson" subprotocol is offered when installed
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, the "msgpack" subprotocol is offered when installed
+    msgpack = None
+
+# websocket subprotocols a client can ask for in `Sec-WebSocket-Protocol`:
+# "json" is the original stdlib JSON text frames and the default when none is
+# asked for, "orjson" the same JSON in compact form from orjson, "msgpack"
+# MessagePack binary frames. Compression is uvicorn's permessage-deflate
+# (`--ws-per-message-deflate`, or UVICORN_WS_PER_MESSAGE_DEFLATE).
+DEFAULT_FORMAT = "json"
+WIRE_FORMATS = tuple(
+    name
+    for name, available in (
+        ("json", True),
+        ("orjson", orjson is not None),
+        ("msgpack", msgpack is not None),
+    )
+    if available
+)
+
+# the broker carries frames as JSON text, in the fastest encoding available,
+# so a socket speaking that format sends the payload as it arrived
+PAYLOAD_FORMAT = "orjson" if orjson is not None else "json"
+
+Encoded = Union[str, bytes]
+
+
+def choose_format(offered: List[str]) -> Optional[str]:
+    """The first subprotocol the client offered that this server speaks.
+
+    `None` when the client offered none, it then gets JSON without a
+    subprotocol in the handshake. An offer with nothing we speak also gets
+    `None`, the browser then fails the handshake instead of misreading frames.
+    """
+    for subprotocol in offered:
+        if subprotocol in WIRE_FORMATS:
+            return subprotocol
+    if offered:
+        logger.warning("No supported websocket subprotocol in %r.", offered)
+    return None
+
+
+class Frame:
+    """One outbound websocket event, encoded at most once per wire format.
+
+    A message goes out to every socket of its recipient and its sender, the
+    encodings are cached on the frame so each format is paid for once, not
+    once per socket. The `PAYLOAD_FORMAT` encoding doubles as the broker payload.
+    """
+
+    __slots__ = ("_event", "_encoded")
+
+    def __init__(self, event: Optional[dict] = None, payload: Optional[str] = None):
+        self._event = event
+        self._encoded: Dict[str, Encoded] = {}
+        if payload is not None:
+            self._encoded[PAYLOAD_FORMAT] = payload
+
+    @classmethod
+    def from_event(cls, event: dict) -> "Frame":
+        return cls(event=event)
+
+    @classmethod
+    def from_payload(cls, payload: str) -> "Frame":
+        """A frame received from the broker."""
+        return cls(payload=payload)
+
+    @property
+    def event(self) -> dict:
+        if self._event is None:
+            self._event = decode(self._encoded[PAYLOAD_FORMAT], PAYLOAD_FORMAT)
+        return self._event
+
+    @property
+    def payload(self) -> str:
+        return self.encoded(PAYLOAD_FORMAT)
+
+    def encoded(self, wire_format: str) -> Encoded:
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            encoded = self._encoded[wire_format] = encode(self.event, wire_format)
+        return encoded
+
+
+def encode_default(value):
+    """Types the encoders don't know, timestamps go out as ISO 8601 like orjson writes them."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def encode(event: dict, wire_format: str) -> Encoded:
+    if wire_format == "json":
+        return json.dumps(event, default=encode_default)
+    if wire_format == "orjson":
+        # websocket text frames are UTF-8 anyway, decoding here is a memcpy
+        return orjson.dumps(event).decode("utf-8")
+    if wire_format == "msgpack":
+        return msgpack.packb(event, default=encode_default)
+    raise ValueError(f"Unknown wire format: {wire_format!r}")
+
+
+def decode(data: Encoded, wire_format: str) -> dict:
+    """An inbound frame, clients send in the format they negotiated."""
+    if isinstance(data, bytes):
+        if wire_format != "msgpack":
+            raise ValueError(f"Binary frame on a {wire_format!r} socket")
+        return msgpack.unpackb(data)
+    if wire_format == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,131 @@
+"""Per-request cost of authenticating with the access token.
+
+Compares the old auth dependency (sync, so a threadpool hop, plus a
+python-jose HS256 verification on every request) with the current one
+(async, answered from the verified-token cache and the session cache):
+
+- dependency: the bare call, as awaited by FastAPI,
+- ASGI: requests/s and latency of a minimal FastAPI app whose only work is
+  the dependency, driven in process by concurrent httpx clients. The real
+  routes add their own logging and database work on top of this.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_auth
+    python -m benchmarks.bench_auth --concurrency 100 --requests 50000
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+from fastapi import Depends, FastAPI
+from jose import jwt
+from starlette.concurrency import run_in_threadpool
+
+from app import security
+from app.cache import token_cache
+from app.sessions import session_store
+
+from .common import fresh_session_factory, percentile
+
+CALLS = 20000
+
+
+def decode_uncached(token: str):
+    """`decode_access_token` as it was before the token cache."""
+    payload = jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM])
+    return payload.get("data")
+
+
+def old_get_current_user(token: str = Depends(security.oauth2_scheme)):
+    """The sync dependency as it was before the token cache."""
+    return {"username": decode_uncached(token)}
+
+
+def make_app(dependency) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/me")
+    async def me(current_user: dict = Depends(dependency)):
+        return current_user
+
+    return app
+
+
+async def bare_calls(token: str):
+    async def measure(call):
+        start = time.perf_counter()
+        for _ in range(CALLS):
+            await call()
+        return (time.perf_counter() - start) / CALLS * 1e6
+
+    old = await measure(lambda: run_in_threadpool(old_get_current_user, token))
+    new = await measure(lambda: security.get_current_user(token))
+    print(f"{'dependency':<26} {'us/call':>8}")
+    print(f"{'sync, jose every time':<26} {old:>8.1f}")
+    print(f"{'async, token cache':<26} {new:>8.1f}")
+
+
+async def load(app: FastAPI, token: str, concurrency: int, requests: int):
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", headers=headers
+    ) as client:
+        remaining = requests
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                response = await client.get("/me")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return requests / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    with fresh_session_factory() as session_factory:
+        session_store.session_factory = session_factory
+        session = session_store.create("user0")
+        token = security.create_access_token(
+            username="user0", session_id=session.session_id
+        )
+        token_cache.clear()
+        compare(token, args)
+
+
+def compare(token: str, args):
+    asyncio.run(bare_calls(token))
+
+    print(f"\n{'ASGI':<26} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, dependency in (
+        ("sync, jose every time", old_get_current_user),
+        ("async, token cache", security.get_current_user),
+    ):
+        app = make_app(dependency)
+        asyncio.run(load(app, token, args.concurrency, 1000))  # warm up
+        rate, latencies = asyncio.run(
+            load(app, token, args.concurrency, args.requests)
+        )
+        print(
+            f"{label:<26} {rate:>8.0f} {percentile(latencies, 50) * 1000:>8.2f} "
+            f"{percentile(latencies, 99) * 1000:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Compares the ways the chat list has been built.
+
+- per-contact: one UNION plus three queries per contact (the original code),
+- window query: one set-based query over `messages`,
+- conversation state: one range scan over the materialized `conversation_state`
+  table, which is what `crud.get_conversations` does now.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_conversations
+"""
+
+from datetime import datetime, timezone
+
+from sqlalchemy import and_, case, func, or_
+
+from app import crud, models
+
+from .common import fresh_session, seed_conversations, timed
+
+CONTACT_COUNTS = (10, 100, 1000)
+MESSAGES_PER_CONTACT = 20
+
+
+def per_contact_get_conversation(db, username: str, contact_username: str):
+    pair = or_(
+        and_(
+            models.Message.sender == username,
+            models.Message.recipient == contact_username,
+        ),
+        and_(
+            models.Message.sender == contact_username,
+            models.Message.recipient == username,
+        ),
+    )
+    last_message = (
+        db.query(models.Message)
+        .filter(pair)
+        .order_by(models.Message.timestamp.desc())
+        .first()
+    )
+    unread_count = (
+        db.query(models.Message)
+        .filter(
+            models.Message.sender == contact_username,
+            models.Message.recipient == username,
+            models.Message.is_read == False,
+        )
+        .count()
+    )
+    contact_user = (
+        db.query(models.User).filter(models.User.username == contact_username).first()
+    )
+    if not contact_user:
+        return None
+    return {
+        "username": contact_user.username,
+        "name": contact_user.name,
+        "last_message": last_message.text if last_message else None,
+        "last_message_timestamp": last_message.timestamp if last_message else None,
+        "unread_count": unread_count,
+    }
+
+
+def per_contact_get_conversations(db, username: str):
+    contacts = (
+        db.query(models.Message.recipient.label("contact"))
+        .filter(models.Message.sender == username)
+        .distinct()
+        .union(
+            db.query(models.Message.sender.label("contact"))
+            .filter(models.Message.recipient == username)
+            .distinct()
+        )
+    )
+    conversations = [
+        per_contact_get_conversation(db, username, row.contact) for row in contacts
+    ]
+    conversations = [c for c in conversations if c is not None]
+    conversations.sort(
+        key=lambda x: x["last_message_timestamp"] or datetime.min.replace(tzinfo=timezone.utc),
+        reverse=True,
+    )
+    return conversations
+
+
+def window_query_get_conversations(db, username: str):
+    contact = case(
+        (models.Message.sender == username, models.Message.recipient),
+        else_=models.Message.sender,
+    )
+    ranked = (
+        db.query(
+            contact.label("contact"),
+            models.Message.text.label("last_message"),
+            models.Message.timestamp.label("last_message_timestamp"),
+            func.row_number()
+            .over(
+                partition_by=contact,
+                order_by=(models.Message.timestamp.desc(), models.Message.id.desc()),
+            )
+            .label("position"),
+        )
+        .filter(
+            or_(models.Message.sender == username, models.Message.recipient == username)
+        )
+        .subquery()
+    )
+    unread = (
+        db.query(
+            models.Message.sender.label("contact"),
+            func.count(models.Message.id).label("unread_count"),
+        )
+        .filter(models.Message.recipient == username, models.Message.is_read == False)
+        .group_by(models.Message.sender)
+        .subquery()
+    )
+    rows = (
+        db.query(
+            models.User.username,
+            models.User.name,
+            ranked.c.last_message,
+            ranked.c.last_message_timestamp,
+            func.coalesce(unread.c.unread_count, 0).label("unread_count"),
+        )
+        .join(ranked, ranked.c.contact == models.User.username)
+        .outerjoin(unread, unread.c.contact == models.User.username)
+        .filter(ranked.c.position == 1)
+        .order_by(ranked.c.last_message_timestamp.desc())
+        .all()
+    )
+    return [dict(row._mapping) for row in rows]
+
+
+def main():
+    print(
+        f"{'contacts':>10} {'per-contact (ms)':>17} {'window query (ms)':>18}"
+        f" {'conversation state (ms)':>24}"
+    )
+    for contacts in CONTACT_COUNTS:
+        with fresh_session() as db:
+            seed_conversations(db, "owner", contacts, MESSAGES_PER_CONTACT)
+            per_contact_time, per_contact = timed(
+                lambda: per_contact_get_conversations(db, "owner")
+            )
+            window_time, window = timed(
+                lambda: window_query_get_conversations(db, "owner")
+            )
+            state_time, state = timed(lambda: crud.get_conversations(db, "owner"))
+            assert per_contact == window == state, "chat list implementations differ"
+            print(
+                f"{contacts:>10} {per_contact_time * 1000:>17.2f}"
+                f" {window_time * 1000:>18.2f} {state_time * 1000:>24.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
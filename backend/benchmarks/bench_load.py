@@ -0,0 +1,481 @@
+"""Load test of the REST and websocket paths, with JSON output for CI.
+
+Seeds a synthetic dataset into a fresh database migrated with alembic:
+`--users` users, each with `--contacts` conversations of
+`--messages` messages. Then it drives the app with `--concurrency`
+concurrent clients, in one or both of these modes:
+
+- inprocess: the FastAPI app in a child process, called through
+  httpx's ASGI transport and an ASGI websocket driver. No sockets or
+  HTTP parsing, so this is the app's own cost.
+- uvicorn: the app served by uvicorn, called over real HTTP and
+  websocket connections.
+
+The scenarios:
+- token: POST /token, including bcrypt
+- conversations: GET /conversations
+- history: GET /conversations/{contact}/messages
+- search: GET /users/search
+- ws: the websocket round trip, from send() on the sender to receipt on
+  the recipient
+
+The report goes to stdout, or to `--output`, as JSON. With `--compare` a
+previous report is the baseline, and any scenario whose p50 latency or
+throughput got worse by more than `--tolerance` fails the run.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_load --output baseline.json
+    python -m benchmarks.bench_load --mode uvicorn --concurrency 50 --compare baseline.json
+
+The app logs at LOG_LEVEL=WARNING during the run, so the numbers don't
+include one console line per request.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy.orm import sessionmaker
+from websockets.asyncio.client import connect
+
+from app import crud, models
+from app.database import create_database_engine
+
+from .common import (BACKEND_DIR, access_tokens, fresh_database_url,
+                     percentile, running_server, seed_users)
+
+MODES = ("inprocess", "uvicorn")
+SCENARIOS = ("token", "conversations", "history", "search", "ws")
+# the password every seeded user shares, see `common.seed_users`
+PASSWORD = "password"
+WORDS = "hey so did you see the game last night I think we should meet tomorrow".split()
+# app settings for both modes
+APP_ENV = {"LOG_LEVEL": "WARNING"}
+
+
+def migrate(database_url: str):
+    subprocess.run(
+        [sys.executable, "-m", "app.maintenance", "migrate"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, **APP_ENV, "DATABASE_URL": database_url},
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def contacts_of(index: int, users: int, contacts: int):
+    """Each user talks to the next `contacts // 2` users and so also to the previous ones."""
+    return [(index + step) % users for step in range(1, contacts // 2 + 1)]
+
+
+def seed_dataset(database_url: str, users: int, contacts: int, messages: int, seed: int):
+    """Users, conversations and their messages, returns the usernames."""
+    usernames = seed_users(database_url, users)
+    rng = random.Random(seed)
+    engine = create_database_engine(database_url)
+    started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    batch = []
+    with engine.begin() as connection:
+        for index, username in enumerate(usernames):
+            for other in contacts_of(index, users, contacts):
+                contact = usernames[other]
+                for n in range(messages):
+                    incoming = n % 2 == 0
+                    batch.append(
+                        {
+                            "sender": contact if incoming else username,
+                            "recipient": username if incoming else contact,
+                            "text": " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+                            "timestamp": started + timedelta(seconds=len(batch)),
+                            "is_read": n < messages - 2,
+                        }
+                    )
+                if len(batch) >= 10000:
+                    connection.execute(models.Message.__table__.insert(), batch)
+                    started += timedelta(seconds=len(batch))
+                    batch = []
+        if batch:
+            connection.execute(models.Message.__table__.insert(), batch)
+    db = sessionmaker(bind=engine)()
+    try:
+        crud.rebuild_conversation_state(db)
+    finally:
+        db.close()
+        engine.dispose()
+    return usernames
+
+
+class ASGIWebSocket:
+    """A websocket client talking to an ASGI app directly, `websockets`-like API."""
+
+    def __init__(self, app, path: str, query_string: str):
+        self.scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query_string.encode(),
+            "headers": [],
+            "subprotocols": [],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        self.inbound = asyncio.Queue()
+        self.outbound = asyncio.Queue()
+        self.accepted = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(app(self.scope, self.inbound.get, self._send))
+
+    async def _send(self, message):
+        if message["type"] == "websocket.accept":
+            self.accepted.set_result(True)
+        elif message["type"] == "websocket.close":
+            if not self.accepted.done():
+                self.accepted.set_exception(ConnectionError("websocket rejected"))
+            await self.outbound.put(None)
+        else:
+            await self.outbound.put(message.get("text") or message.get("bytes"))
+
+    async def open(self):
+        await self.inbound.put({"type": "websocket.connect"})
+        await self.accepted
+        return self
+
+    async def send(self, text: str):
+        await self.inbound.put({"type": "websocket.receive", "text": text})
+
+    async def recv(self):
+        frame = await self.outbound.get()
+        if frame is None:
+            raise ConnectionError("websocket closed")
+        return frame
+
+    async def close(self):
+        await self.inbound.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, timeout=10)
+
+
+def summary(latencies, errors: dict, elapsed: float) -> dict:
+    """`errors` counts failures by status code or exception name."""
+    done = len(latencies)
+    return {
+        "requests": done + sum(errors.values()),
+        "errors": sum(errors.values()),
+        "errors_by_kind": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(done / elapsed, 1) if elapsed else 0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / done * 1000, 3) if done else None,
+            "p50": round(percentile(latencies, 50) * 1000, 3) if done else None,
+            "p90": round(percentile(latencies, 90) * 1000, 3) if done else None,
+            "p99": round(percentile(latencies, 99) * 1000, 3) if done else None,
+            "max": round(max(latencies) * 1000, 3) if done else None,
+        },
+    }
+
+
+async def http_scenario(
+    client: httpx.AsyncClient, make_request, requests: int, concurrency: int
+):
+    """`requests` calls of `make_request(client)`, `concurrency` at a time."""
+    latencies, errors = [], {}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await make_request(client)
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            if response.is_error:
+                # e.g. 503 from the password hasher's backpressure on /token
+                status = str(response.status_code)
+                errors[status] = errors.get(status, 0) + 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summary(latencies, errors, time.perf_counter() - start)
+
+
+async def ws_scenario(open_socket, tokens, usernames, messages: int, concurrency: int):
+    """`concurrency` senders each send `messages` to a neighbour, one at a time.
+
+    Round trip: from the sender's send() to the recipient reading the frame.
+    """
+    # every sender has its own recipient, so a frame has a single waiter
+    senders = usernames[:concurrency]
+    recipients = usernames[concurrency : 2 * concurrency]
+    sockets = {}
+    for start in range(0, len(senders + recipients), 100):
+        chunk = (senders + recipients)[start : start + 100]
+        opened = await asyncio.gather(*(open_socket(tokens[u]) for u in chunk))
+        sockets.update(zip(chunk, opened))
+
+    waiting = {}
+    latencies, errors = [], {}
+
+    async def receive(username):
+        try:
+            while True:
+                event = json.loads(await sockets[username].recv())
+                data = event.get("data") or {}
+                if event.get("type") != "message" or data.get("recipient") != username:
+                    continue
+                future = waiting.pop(data.get("text"), None)
+                if future is not None and not future.done():
+                    future.set_result(time.perf_counter())
+        except Exception:
+            pass
+
+    async def send(sender, recipient):
+        loop = asyncio.get_running_loop()
+        for n in range(messages):
+            text = f"{sender}:{n}"
+            waiting[text] = future = loop.create_future()
+            start = time.perf_counter()
+            await sockets[sender].send(json.dumps({"recipient": recipient, "text": text}))
+            try:
+                latencies.append(await asyncio.wait_for(future, timeout=30) - start)
+            except asyncio.TimeoutError:
+                errors["timeout"] = errors.get("timeout", 0) + 1
+
+    readers = [asyncio.create_task(receive(u)) for u in recipients]
+    start = time.perf_counter()
+    await asyncio.gather(*(send(s, r) for s, r in zip(senders, recipients)))
+    elapsed = time.perf_counter() - start
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*(s.close() for s in sockets.values()), return_exceptions=True)
+    return summary(latencies, errors, elapsed)
+
+
+async def run_scenarios(client_factory, open_socket, tokens, args) -> dict:
+    usernames = list(tokens)
+    rng = random.Random(args.seed)
+    index_of = {username: index for index, username in enumerate(usernames)}
+
+    def any_user():
+        return rng.choice(usernames)
+
+    def auth(username):
+        return {"Authorization": f"Bearer {tokens[username]}"}
+
+    def history(client):
+        username = any_user()
+        partners = contacts_of(index_of[username], len(usernames), args.contacts)
+        contact = usernames[rng.choice(partners)]
+        return client.get(
+            f"/conversations/{contact}/messages", params={"limit": 50}, headers=auth(username)
+        )
+
+    requests = {
+        "token": lambda client: client.post(
+            "/token", data={"username": any_user(), "password": PASSWORD}
+        ),
+        "conversations": lambda client: client.get("/conversations", headers=auth(any_user())),
+        "history": history,
+        # a prefix of a username, matches a handful of users
+        "search": lambda client: client.get(
+            "/users/search", params={"username": any_user()[:-1]}, headers=auth(any_user())
+        ),
+    }
+
+    results = {}
+    async with client_factory() as client:
+        for name in args.scenarios:
+            if name == "ws":
+                continue
+            count = args.token_requests if name == "token" else args.requests
+            # warm the caches and the connection pool first
+            warm_up = min(count, args.concurrency * 2)
+            await http_scenario(client, requests[name], warm_up, args.concurrency)
+            results[name] = await http_scenario(
+                client, requests[name], count, args.concurrency
+            )
+    if "ws" in args.scenarios:
+        concurrency = min(args.concurrency, len(usernames) // 2)
+        results["ws"] = await ws_scenario(
+            open_socket, tokens, usernames, args.ws_messages, concurrency
+        )
+    return results
+
+
+async def run_inprocess(args) -> dict:
+    """Child process side of the inprocess mode, DATABASE_URL already points at the dataset."""
+    from app.main import app
+
+    tokens = access_tokens(os.environ["DATABASE_URL"], [f"user{i}" for i in range(args.users)])
+
+    def client_factory():
+        transport = httpx.ASGITransport(app=app)
+        return httpx.AsyncClient(transport=transport, base_url="http://bench")
+
+    def open_socket(token):
+        return ASGIWebSocket(app, "/ws", f"token={token}").open()
+
+    # httpx does not run the lifespan, the message writer and broker live there
+    async with app.router.lifespan_context(app):
+        return await run_scenarios(client_factory, open_socket, tokens, args)
+
+
+def inprocess(database_url: str, argv) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_load", *argv, "--inprocess-child"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, **APP_ENV, "DATABASE_URL": database_url},
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return json.loads(output)
+
+
+def through_uvicorn(database_url: str, args) -> dict:
+    tokens = access_tokens(database_url, [f"user{i}" for i in range(args.users)])
+    limits = httpx.Limits(max_connections=args.concurrency)
+    with running_server({**APP_ENV, "DATABASE_URL": database_url}) as base_url:
+        ws_url = base_url.replace("http", "ws", 1)
+
+        def client_factory():
+            return httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60)
+
+        def open_socket(token):
+            return connect(f"{ws_url}/ws?token={token}", open_timeout=60, max_queue=None)
+
+        return asyncio.run(run_scenarios(client_factory, open_socket, tokens, args))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def regressions(report: dict, baseline: dict, tolerance: float):
+    """(mode, scenario, metric, baseline, current) beyond `tolerance` in the bad direction."""
+    found = []
+    for mode, scenarios in report["results"].items():
+        for name, current in scenarios.items():
+            previous = baseline.get("results", {}).get(mode, {}).get(name)
+            if not previous:
+                continue
+            before, after = previous["latency_ms"]["p50"], current["latency_ms"]["p50"]
+            if before and after and after > before * (1 + tolerance):
+                found.append((mode, name, "p50 ms", before, after))
+            before, after = previous["throughput"], current["throughput"]
+            if before and after < before * (1 - tolerance):
+                found.append((mode, name, "throughput", before, after))
+            if current["errors"] > previous["errors"]:
+                found.append((mode, name, "errors", previous["errors"], current["errors"]))
+    return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--contacts", type=int, default=10, help="conversations per user")
+    parser.add_argument("--messages", type=int, default=50, help="messages per conversation")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per REST scenario")
+    parser.add_argument(
+        "--token-requests", type=int, default=200, help="logins, each one runs bcrypt"
+    )
+    parser.add_argument("--ws-messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--mode", choices=(*MODES, "both"), default="both")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--database-url", help="an empty database to use instead of a throwaway SQLite file"
+    )
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="a previous JSON report to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--inprocess-child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run(database_url: str, args, argv) -> dict:
+    start = time.perf_counter()
+    migrate(database_url)
+    seed_dataset(database_url, args.users, args.contacts, args.messages, args.seed)
+    seed_seconds = time.perf_counter() - start
+
+    modes = MODES if args.mode == "both" else (args.mode,)
+    results = {}
+    for mode in modes:
+        print(f"running {mode} ...", file=sys.stderr)
+        if mode == "inprocess":
+            results[mode] = inprocess(database_url, argv)
+        else:
+            results[mode] = through_uvicorn(database_url, args)
+
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": database_url.split(":", 1)[0],
+            "seed_seconds": round(seed_seconds, 3),
+            "dataset": {
+                "users": args.users,
+                "contacts": args.contacts,
+                "messages_per_conversation": args.messages,
+            },
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def main():
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.inprocess_child:
+        json.dump(asyncio.run(run_inprocess(args)), sys.stdout)
+        return
+
+    if args.database_url:
+        report = run(args.database_url, args, argv)
+    else:
+        with fresh_database_url() as database_url:
+            report = run(database_url, args, argv)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        found = regressions(report, baseline, args.tolerance)
+        for mode, name, metric, before, after in found:
+            print(f"REGRESSION {mode}/{name} {metric}: {before} -> {after}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
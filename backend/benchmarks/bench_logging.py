@@ -0,0 +1,134 @@
+"""Per-request logging overhead on the thread that handles the request.
+
+Compares the original setup, console, rotating file and coloredlogs handlers
+called synchronously with two f-string lines per request, with the queued
+setup from `app.logger`: one lazy line per request handed to the listener
+thread, in text and in JSON. "drain" is the time the listener needs for the
+rest of the work, which no longer happens on the request thread. The last
+rows are a disabled debug call, f-string against lazy arguments.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_logging
+"""
+
+import logging
+import os
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+import coloredlogs
+
+from app.logger import (build_handlers, colored_log_format, date_format,
+                        queued)
+
+REQUESTS = 20000
+METHOD, PATH, STATUS, DURATION = "GET", "/conversations/alice/messages", 200, 0.00123
+
+
+def original_logger(path: str, stream) -> logging.Logger:
+    """The setup `app.logger` had, every handler runs on the calling thread."""
+    logger = logging.getLogger("bench.original")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    formatter = logging.Formatter(colored_log_format, date_format)
+    for handler in (
+        logging.StreamHandler(stream),
+        RotatingFileHandler(path, mode="w+", maxBytes=5000000, backupCount=10),
+    ):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    coloredlogs.install(
+        level="INFO", logger=logger, fmt=colored_log_format, datefmt=date_format, stream=stream
+    )
+    return logger
+
+
+def original_requests(logger: logging.Logger):
+    for _ in range(REQUESTS):
+        logger.info(f"Incoming request: {METHOD} {PATH}")
+        logger.info(
+            f"Request {METHOD} {PATH} completed with status {STATUS} in {DURATION:.4f}s"
+        )
+
+
+def queued_requests(logger: logging.Logger):
+    for _ in range(REQUESTS):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "%s %s %s in %.4fs",
+                METHOD,
+                PATH,
+                STATUS,
+                DURATION,
+                extra={
+                    "method": METHOD,
+                    "path": PATH,
+                    "status": STATUS,
+                    "duration_ms": round(DURATION * 1000, 3),
+                },
+            )
+
+
+def run(label: str, logger: logging.Logger, requests, stop=None):
+    start = time.perf_counter()
+    requests(logger)
+    calling = time.perf_counter() - start
+    drain = 0.0
+    if stop is not None:
+        start = time.perf_counter()
+        stop()
+        drain = time.perf_counter() - start
+    print(
+        f"{label:<28} {calling / REQUESTS * 1e6:>14.2f} {drain / REQUESTS * 1e6:>10.2f}"
+    )
+
+
+def disabled_debug(label: str, call):
+    logger = logging.getLogger("bench.disabled")
+    logger.setLevel(logging.INFO)
+    # a message with some arguments worth formatting
+    state = {"pending": list(range(20)), "user": "alice"}
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        call(logger, state)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / REQUESTS * 1e6:>14.2f} {0:>10.2f}")
+
+
+def main():
+    print(f"{'setup':<28} {'us/request':>14} {'drain us':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        run(
+            "sync handlers, 2 f-strings",
+            original_logger(os.path.join(tmp_dir, "original.log"), devnull),
+            original_requests,
+        )
+        for label, structured in (
+            ("queued text, 1 lazy line", False),
+            ("queued json, 1 lazy line", True),
+        ):
+            logger = logging.getLogger(f"bench.{'json' if structured else 'text'}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            listener = queued(
+                logger,
+                build_handlers(
+                    devnull, os.path.join(tmp_dir, f"{label}.log"), structured=structured
+                ),
+            )
+            run(label, logger, queued_requests, stop=listener.stop)
+
+        disabled_debug(
+            "disabled debug, f-string",
+            lambda logger, state: logger.debug(f"State of {state['user']}: {state}"),
+        )
+        disabled_debug(
+            "disabled debug, lazy",
+            lambda logger, state: logger.debug("State of %s: %s", state["user"], state),
+        )
+
+
+if __name__ == "__main__":
+    main()
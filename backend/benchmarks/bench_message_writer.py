@@ -0,0 +1,69 @@
+"""Message insert throughput, one commit per message vs group commit.
+
+`--senders` coroutines submit messages to a `MessageWriter` at the same time.
+A writer with no window and a batch cap of 1 behaves like the old
+one-`create_message`-per-frame path.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_message_writer
+"""
+
+import argparse
+import asyncio
+import time
+
+from app import models, schemas
+from app.message_writer import MessageWriter
+
+from .common import fresh_session_factory
+
+
+async def run_writer(writer: MessageWriter, senders: int, messages_per_sender: int):
+    async def sender(index):
+        for n in range(messages_per_sender):
+            await writer.submit(
+                schemas.MessageCreate(
+                    sender=f"user{index}",
+                    recipient=f"user{(index + 1) % senders}",
+                    text=f"message {n}",
+                )
+            )
+
+    await writer.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(sender(i) for i in range(senders)))
+    await writer.stop()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--senders", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=25, help="messages per sender")
+    args = parser.parse_args()
+    total = args.senders * args.messages
+
+    print(f"{'writer':>28} {'msg/s':>9}")
+    for label, window_ms, max_batch_size in (
+        ("one commit per message", 0, 1),
+        ("group commit 2ms / 100", 2, 100),
+        ("group commit 5ms / 500", 5, 500),
+    ):
+        with fresh_session_factory() as session_factory:
+            writer = MessageWriter(
+                window_ms=window_ms,
+                max_batch_size=max_batch_size,
+                session_factory=session_factory,
+                async_session_factory=None,
+            )
+            elapsed = asyncio.run(run_writer(writer, args.senders, args.messages))
+            db = session_factory()
+            stored = db.query(models.Message).count()
+            db.close()
+            assert stored == total, f"{stored} of {total} messages stored"
+        print(f"{label:>28} {total / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Per-row cost of the message list responses.
+
+Compares the original path, ORM objects validated and encoded by FastAPI
+through `response_model=List[schemas.Message]`, with the fast path the list
+routes use now: column tuples from `crud.MESSAGE_COLUMNS` encoded by
+`responses.rows_response`. Both are measured end to end through a minimal
+FastAPI app driven in process by httpx, and split into query and encode.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_responses
+"""
+
+import asyncio
+from typing import List
+
+import httpx
+from fastapi import FastAPI
+from pydantic import TypeAdapter
+
+from app import crud, models, schemas
+from app.responses import rows_response
+
+from .common import fresh_session, seed_conversations, timed
+
+HISTORY_SIZES = (50, 500, 5000)
+
+
+def orm_history(db):
+    return (
+        db.query(models.Message)
+        .filter(models.Message.recipient == "owner")
+        .order_by(models.Message.id)
+        .all()
+    )
+
+
+def row_history(db):
+    return (
+        db.query(*crud.MESSAGE_COLUMNS)
+        .filter(models.Message.recipient == "owner")
+        .order_by(models.Message.id)
+        .all()
+    )
+
+
+def make_app(db) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/orm", response_model=List[schemas.Message])
+    def orm():
+        return orm_history(db)
+
+    @app.get("/rows", response_model=List[schemas.Message])
+    def rows():
+        return rows_response(row_history(db))
+
+    return app
+
+
+async def request_time(app: FastAPI, path: str, repeat: int = 5):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        best, body = float("inf"), None
+        for _ in range(repeat):
+            start = asyncio.get_running_loop().time()
+            response = await client.get(path)
+            best = min(best, asyncio.get_running_loop().time() - start)
+            body = response.json()
+    return best, body
+
+
+def main():
+    print(
+        f"{'rows':>6} {'path':>5} {'query us/row':>13} {'encode us/row':>14}"
+        f" {'request us/row':>15}"
+    )
+    for size in HISTORY_SIZES:
+        with fresh_session() as db:
+            # half of every contact's messages are incoming to "owner"
+            seed_conversations(db, "owner", contacts=size // 5, messages_per_contact=10)
+            app = make_app(db)
+
+            orm_query, orm_rows = timed(lambda: orm_history(db))
+            # what FastAPI does with a `response_model`: validate, then dump
+            adapter = TypeAdapter(List[schemas.Message])
+            adapter_encode, _ = timed(
+                lambda: adapter.dump_json(
+                    adapter.validate_python(orm_rows, from_attributes=True)
+                )
+            )
+            orm_request, orm_body = asyncio.run(request_time(app, "/orm"))
+
+            rows_query, rows = timed(lambda: row_history(db))
+            rows_encode, _ = timed(lambda: rows_response(rows).body)
+            rows_request, rows_body = asyncio.run(request_time(app, "/rows"))
+
+            assert orm_body == rows_body, "response bodies differ"
+            count = len(rows)
+            for label, query, encode, request in (
+                ("orm", orm_query, adapter_encode, orm_request),
+                ("rows", rows_query, rows_encode, rows_request),
+            ):
+                print(
+                    f"{count:>6} {label:>5} {query / count * 1e6:>13.2f}"
+                    f" {encode / count * 1e6:>14.2f} {request / count * 1e6:>15.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Compares message and user search with and without the full-text indexes.
+
+- LIKE: `text LIKE '%word%'` over the caller's messages, the only option
+  before the FTS index, and `ilike '%q%'` over usernames and names,
+- FTS: `crud.search_messages` (FTS5 + bm25) and `crud.search_users`
+  (FTS5 trigram index).
+
+Run from `backend/` (seeding 1M messages takes a minute or two):
+
+    python -m benchmarks.bench_search
+    python -m benchmarks.bench_search --messages 100000 --users 10000
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import and_, or_
+
+from app import crud, models
+
+from .common import fresh_session, timed
+
+PARTICIPANTS = 100
+VOCABULARY_SIZE = 20000
+WORDS_PER_MESSAGE = 8
+INSERT_CHUNK = 50000
+
+
+def make_vocabulary(rng: random.Random):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def seed(db, message_count: int, user_count: int, rng: random.Random):
+    vocabulary = make_vocabulary(rng)
+    # zipf-like: a few words are very common, most are rare
+    cum_weights, total = [], 0.0
+    for rank in range(len(vocabulary)):
+        total += 1 / (rank + 1)
+        cum_weights.append(total)
+    participants = [f"user{i}" for i in range(PARTICIPANTS)]
+    db.bulk_insert_mappings(
+        models.User,
+        [
+            {"username": f"user{i}", "name": f"{rng.choice(vocabulary).title()} {i}", "hashed_password": "x"}
+            for i in range(user_count)
+        ],
+    )
+    db.commit()
+    for start in range(0, message_count, INSERT_CHUNK):
+        rows = []
+        for _ in range(min(INSERT_CHUNK, message_count - start)):
+            sender, recipient = rng.sample(participants, 2)
+            rows.append(
+                {
+                    "sender": sender,
+                    "recipient": recipient,
+                    "text": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=WORDS_PER_MESSAGE)),
+                    "timestamp": datetime(2024, 1, 1, tzinfo=timezone.utc),
+                    "is_read": True,
+                }
+            )
+        # the FTS triggers index every row as it is inserted
+        db.execute(models.Message.__table__.insert(), rows)
+        db.commit()
+    return vocabulary
+
+
+def like_search(db, username: str, query: str, limit: int = 20):
+    return (
+        db.query(models.Message)
+        .filter(
+            or_(models.Message.sender == username, models.Message.recipient == username),
+            and_(*(models.Message.text.like(f"%{term}%") for term in query.split())),
+        )
+        .order_by(models.Message.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def like_search_users(db, query: str):
+    return (
+        db.query(models.User)
+        .filter(
+            or_(
+                models.User.username.ilike(f"%{query}%"),
+                models.User.name.ilike(f"%{query}%"),
+            )
+        )
+        .all()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with fresh_session() as db:
+        start = time.perf_counter()
+        vocabulary = seed(db, args.messages, args.users, rng)
+        print(
+            f"seeded {args.messages} messages and {args.users} users "
+            f"in {time.perf_counter() - start:.1f}s (FTS indexed on insert)"
+        )
+
+        queries = {
+            "common word": vocabulary[0],
+            "rare word": vocabulary[-1],
+            "two words": f"{vocabulary[1]} {vocabulary[50]}",
+        }
+        print(f"\n{'message query':<14} {'LIKE ms':>10} {'FTS ms':>10} {'hits':>6}")
+        for label, query in queries.items():
+            like_seconds, like_rows = timed(lambda: like_search(db, "user0", query))
+            fts_seconds, fts_rows = timed(
+                lambda: crud.search_messages(db, "user0", query)
+            )
+            print(
+                f"{label:<14} {like_seconds * 1000:>10.2f} {fts_seconds * 1000:>10.2f} "
+                f"{len(fts_rows):>6}"
+            )
+
+        user_queries = {"username": "user4242", "name": vocabulary[7][:4], "no match": "zzzzzz"}
+        print(f"\n{'user query':<14} {'ILIKE ms':>10} {'FTS ms':>10} {'hits':>6}")
+        for label, query in user_queries.items():
+            like_seconds, like_rows = timed(lambda: like_search_users(db, query))
+            fts_seconds, fts_rows = timed(lambda: crud.search_users(db, query))
+            assert {u.id for u in like_rows} == {u.id for u in fts_rows}
+            print(
+                f"{label:<14} {like_seconds * 1000:>10.2f} {fts_seconds * 1000:>10.2f} "
+                f"{len(fts_rows):>6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
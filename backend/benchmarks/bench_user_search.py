@@ -0,0 +1,85 @@
+"""Measures `GET /users/search` backends at 100k users.
+
+- database: `crud.search_users` (FTS5 trigram index on SQLite), every match,
+- index: the in-memory `UserSearchIndex`, ranked and capped at `--limit`.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_user_search
+    python -m benchmarks.bench_user_search --users 1000000
+"""
+
+import argparse
+import random
+import time
+
+from app import crud, models
+from app.user_index import UserSearchIndex
+
+from .common import fresh_session, timed
+
+FIRST_NAMES = (
+    "Alice Bob Carol Dave Erin Frank Grace Heidi Ivan Judy Mallory Niaj Olivia "
+    "Peggy Rupert Sybil Trent Victor Walter Yuki Zoe Amir Bea Chen Dmitri Eva"
+).split()
+
+
+def make_users(count: int, rng: random.Random):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    last_names = [
+        "".join(rng.choice(letters) for _ in range(rng.randint(4, 9))).title()
+        for _ in range(5000)
+    ]
+    users = []
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(last_names)
+        users.append(
+            {
+                "username": f"{first.lower()}{last.lower()[:3]}{i}",
+                "name": f"{first} {last}",
+                "hashed_password": "x",
+            }
+        )
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    with fresh_session() as db:
+        users = make_users(args.users, rng)
+        db.execute(models.User.__table__.insert(), users)
+        db.commit()
+
+        index = UserSearchIndex(session_factory=lambda: db)
+        start = time.perf_counter()
+        index.refresh()
+        print(f"index built for {len(index)} users in {time.perf_counter() - start:.2f}s")
+
+        sample = users[len(users) // 2]
+        queries = {
+            "one letter": "a",
+            "exact username": sample["username"],
+            "username prefix": sample["username"][:6],
+            "name word prefix": sample["name"].split()[1][:3],
+            "substring": sample["username"][2:7],
+            "no match": "qqqqzz",
+        }
+        print(f"\n{'query':<18} {'database ms':>12} {'rows':>7} {'index ms':>10} {'rows':>5}")
+        for label, query in queries.items():
+            db_seconds, db_rows = timed(lambda: crud.search_users(db, query))
+            index_seconds, index_rows = timed(
+                lambda: index.search(query, limit=args.limit), repeat=50
+            )
+            print(
+                f"{label:<18} {db_seconds * 1000:>12.2f} {len(db_rows):>7} "
+                f"{index_seconds * 1000:>10.3f} {len(index_rows):>5}"
+            )
+
+
+if __name__ == "__main__":
+    main()
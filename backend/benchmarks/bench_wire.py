@@ -0,0 +1,114 @@
+"""Encode cost and bytes on the wire of the websocket formats.
+
+A chat message goes out twice, to the recipient and as the sender's echo.
+Compares the original path (pydantic dump plus `json.dumps` for each send)
+with `wire.Frame`, which dumps once and encodes once per format, for each
+subprotocol in `wire.WIRE_FORMATS`. Sizes are per frame, uncompressed and
+with permessage-deflate both with and without context takeover (websockets
+and browsers keep the context by default, so repeated keys get cheaper).
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_wire
+"""
+
+import json
+import random
+import time
+import zlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from app import schemas, wire
+from app.delivery import message_event
+
+from .common import timed
+
+MESSAGES = 2000
+# recipient plus the sender's echo
+SENDS_PER_MESSAGE = 2
+
+
+def sample_messages(count: int):
+    words = "hey so did you see the game last night I think we should meet tomorrow".split()
+    rng = random.Random(0)
+    return [
+        SimpleNamespace(
+            id=100000 + i,
+            sender=f"user{rng.randrange(1000)}",
+            recipient=f"user{rng.randrange(1000)}",
+            text=" ".join(rng.choices(words, k=rng.randint(3, 30))),
+            timestamp=datetime(2024, 5, 1, 12, i % 60, i % 59, i, tzinfo=timezone.utc),
+            is_read=False,
+        )
+        for i in range(count)
+    ]
+
+
+def original_frames(messages):
+    frames = []
+    for message in messages:
+        for _ in range(SENDS_PER_MESSAGE):
+            frames.append(
+                json.dumps(
+                    {
+                        "type": "message",
+                        # timestamps were strings then, "json" mode dumps them as such
+                        "data": schemas.Message.model_validate(message).model_dump(
+                            mode="json"
+                        ),
+                    }
+                )
+            )
+    return frames
+
+
+def frames_in(wire_format: str):
+    def build(messages):
+        frames = []
+        for message in messages:
+            frame = message_event(message)
+            # the broker payload, whatever the socket's format
+            frame.payload
+            for _ in range(SENDS_PER_MESSAGE):
+                frames.append(frame.encoded(wire_format))
+        return frames
+
+    return build
+
+
+def deflated_sizes(frames):
+    """Average frame size compressed per message, without and with context takeover."""
+    isolated, shared = 0, 0
+    # raw deflate, as permessage-deflate sends it
+    stream = zlib.compressobj(wbits=-15)
+    for frame in frames:
+        data = frame.encode("utf-8") if isinstance(frame, str) else frame
+        one = zlib.compressobj(wbits=-15)
+        isolated += len(one.compress(data) + one.flush(zlib.Z_SYNC_FLUSH)) - 4
+        shared += len(stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return isolated / len(frames), shared / len(frames)
+
+
+def main():
+    messages = sample_messages(MESSAGES)
+    rows = [("json, per send (original)", original_frames)]
+    rows += [(f"{name}, Frame", frames_in(name)) for name in wire.WIRE_FORMATS]
+
+    print(
+        f"{'format':<28} {'us/message':>10} {'bytes':>7} {'deflate':>8} {'deflate+ctx':>12}"
+    )
+    for label, build in rows:
+        seconds, frames = timed(lambda: build(messages))
+        raw = sum(
+            len(f.encode("utf-8") if isinstance(f, str) else f) for f in frames
+        ) / len(frames)
+        isolated, shared = deflated_sizes(frames)
+        print(
+            f"{label:<28} {seconds / MESSAGES * 1e6:>10.1f} {raw:>7.0f}"
+            f" {isolated:>8.0f} {shared:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
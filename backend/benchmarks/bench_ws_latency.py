@@ -0,0 +1,119 @@
+"""WebSocket send-to-deliver latency under many concurrent sockets.
+
+Starts the app under uvicorn twice, once with the blocking sync session on the
+websocket path (USE_ASYNC_DB=false) and once with the async engine, connects
+`--sockets` clients and has every client send messages to its neighbour.
+Latency is measured from `send()` on the sender to `recv()` on the recipient.
+
+Run from `backend/`:
+
+    python -m benchmarks.bench_ws_latency --sockets 1000
+
+Both runs use SQLite. aiosqlite moves every call onto a worker thread, so on
+a local SQLite file the async path costs more than the blocking one. It pays
+off when the database is across the network (Postgres) or commits are slow.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from websockets.asyncio.client import connect
+
+from .common import (access_tokens, fresh_database_url, percentile,
+                     running_server, seed_users)
+
+
+async def run_clients(base_url: str, tokens, messages_per_socket: int, interval: float):
+    ws_url = base_url.replace("http", "ws", 1)
+    usernames = list(tokens)
+    latencies = []
+    pending = {}
+    sockets = {}
+
+    async def open_socket(username):
+        sockets[username] = await connect(
+            f"{ws_url}/ws?token={tokens[username]}", open_timeout=60, max_queue=None
+        )
+
+    # connect in chunks, a thousand simultaneous handshakes only measures the accept backlog
+    for start in range(0, len(usernames), 100):
+        await asyncio.gather(*(open_socket(u) for u in usernames[start : start + 100]))
+
+    expected = len(usernames) * messages_per_socket
+    delivered = asyncio.Event()
+
+    async def receive(username):
+        async for frame in sockets[username]:
+            event = json.loads(frame)
+            data = event.get("data", {})
+            if event.get("type") != "message" or data.get("recipient") != username:
+                continue
+            sent_at = pending.pop(data["text"], None)
+            if sent_at is not None:
+                latencies.append(time.perf_counter() - sent_at)
+                if len(latencies) == expected:
+                    delivered.set()
+
+    async def send(index, username):
+        recipient = usernames[(index + 1) % len(usernames)]
+        # spread the sockets over the interval instead of sending in lockstep
+        await asyncio.sleep(random.uniform(0, interval))
+        for n in range(messages_per_socket):
+            text = f"{username}:{n}"
+            pending[text] = time.perf_counter()
+            await sockets[username].send(json.dumps({"recipient": recipient, "text": text}))
+            await asyncio.sleep(interval)
+
+    receivers = [asyncio.create_task(receive(u)) for u in usernames]
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i, u) for i, u in enumerate(usernames)))
+    try:
+        await asyncio.wait_for(delivered.wait(), timeout=120)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*(s.close() for s in sockets.values()), return_exceptions=True)
+    return latencies, expected, elapsed
+
+
+def run(label: str, env: dict, args):
+    with fresh_database_url() as database_url:
+        tokens = access_tokens(database_url, seed_users(database_url, args.sockets))
+        with running_server({**env, "DATABASE_URL": database_url}) as base_url:
+            latencies, expected, elapsed = asyncio.run(
+                run_clients(base_url, tokens, args.messages, args.interval)
+            )
+
+    if not latencies:
+        print(f"{label:>10} no message was delivered")
+        return
+    print(
+        f"{label:>10} {len(latencies):>6}/{expected:<6}"
+        f" {percentile(latencies, 50) * 1000:>9.1f}"
+        f" {percentile(latencies, 99) * 1000:>9.1f}"
+        f" {len(latencies) / elapsed:>9.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sockets", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5, help="messages per socket")
+    parser.add_argument(
+        "--interval", type=float, default=10, help="seconds between a socket's messages"
+    )
+    args = parser.parse_args()
+
+    print(f"{'db layer':>10} {'delivered':>13} {'p50 (ms)':>9} {'p99 (ms)':>9} {'msg/s':>9}")
+    run("sync", {"USE_ASYNC_DB": "false"}, args)
+    run("async", {"USE_ASYNC_DB": "true"}, args)
+
+
+if __name__ == "__main__":
+    main()
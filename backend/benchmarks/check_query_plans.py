@@ -0,0 +1,154 @@
+"""Checks that the hot message queries are answered from indexes.
+
+Runs the real `crud` functions against a seeded SQLite database, captures
+the SQL they execute and asks the planner for each statement with
+`EXPLAIN QUERY PLAN`. A plain `SCAN` of a hot table (a full table scan)
+fails the check, the indexes each query uses are printed.
+Writes run inside a rolled back transaction.
+
+Run from `backend/`:
+
+    python -m benchmarks.check_query_plans
+
+`tests/test_query_plans.py` runs the same checks with pytest.
+"""
+
+import re
+import sys
+from contextlib import contextmanager
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.models import utcnow
+
+from .common import fresh_session, seed_conversations
+
+# tables the chat reads and writes on every request, and the archive history pages read
+HOT_TABLES = ("messages", "conversation_state", "message_archive")
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+USED_INDEX = re.compile(r"(?:USING (?:COVERING )?INDEX|USING INTEGER PRIMARY KEY) ?(\w*)")
+
+
+@contextmanager
+def captured_statements(engine):
+    """Collects (statement, parameters) of everything `engine` executes."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+
+def hot_queries():
+    """(label, function of a session) for the queries behind the chat screens."""
+    return (
+        ("history page", lambda db: crud.get_message_history_page(db, "owner", "contact7", 50)),
+        (
+            "history page, scrolling back",
+            lambda db: crud.get_message_history_page(db, "owner", "contact7", 50, before_id=2000),
+        ),
+        (
+            "history page, catching up",
+            lambda db: crud.get_message_history_page(db, "owner", "contact7", 50, after_id=100),
+        ),
+        ("whole history", lambda db: crud.get_message_history(db, "owner", "contact7")),
+        ("conversation list", lambda db: crud.get_conversations(db, "owner")),
+        ("one conversation", lambda db: crud.get_conversation(db, "owner", "contact7")),
+        ("latest incoming id", lambda db: crud.get_latest_incoming_message_id(db, "owner")),
+        ("catch-up", lambda db: crud.get_incoming_messages_after(db, "owner", 100, 500)),
+        (
+            "mark read up to",
+            lambda db: crud.mark_messages_read_up_to(db, "owner", "contact7", 10**9),
+        ),
+        ("mark all read", lambda db: crud.mark_all_messages_as_read(db, "contact7", "owner")),
+        ("search", lambda db: crud.search_messages(db, "owner", "message 3")),
+        ("retention conversations", lambda db: crud.get_conversation_keys(db, ("m", "m"), 500)),
+        ("retention live limit", lambda db: crud.get_nth_newest_message_id(db, "owner", "contact7", 20)),
+        (
+            "retention archive batch",
+            lambda db: crud.archive_messages_batch(
+                db, "owner", "contact7", 10**9, 500, up_to_id=10**9, older_than=utcnow()
+            ),
+        ),
+        ("retention purge", lambda db: crud.purge_archive(db, utcnow(), 500)),
+    )
+
+
+def query_plan(connection, statement: str, parameters):
+    return [
+        row[-1]
+        for row in connection.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {statement}", parameters
+        )
+    ]
+
+
+def plan_steps(engine, run):
+    """The query plan steps of every statement `run(session)` executes, rolled back."""
+    # the crud writes commit, inside an outer transaction those commits only
+    # release savepoints and everything is rolled back
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        session = Session(bind=connection, join_transaction_mode="create_savepoint")
+        try:
+            with captured_statements(engine) as statements:
+                run(session)
+            plans = [query_plan(connection, *captured) for captured in statements]
+        finally:
+            session.close()
+            transaction.rollback()
+    return [step for plan in plans for step in plan]
+
+
+def full_scans(steps):
+    """The steps that scan a whole hot table."""
+    return [
+        step for step in steps
+        if (match := FULL_SCAN.match(step)) and match.group(1) in HOT_TABLES
+    ]
+
+
+def used_indexes(steps):
+    return sorted(
+        {match.group(1) or "rowid" for step in steps for match in USED_INDEX.finditer(step)}
+    )
+
+
+def seed(db):
+    """The data the checks run against, with planner statistics."""
+    seed_conversations(db, "owner", contacts=200, messages_per_contact=50)
+    # the planner picks between indexes from the table statistics
+    db.execute(text("ANALYZE"))
+    db.commit()
+
+
+def main():
+    failures = 0
+    with fresh_session() as db:
+        seed(db)
+        engine = db.get_bind()
+
+        for label, run in hot_queries():
+            steps = plan_steps(engine, run)
+            scans = full_scans(steps)
+            status = "FULL SCAN" if scans else "ok"
+            print(f"{label:<30} {status:<10} {', '.join(used_indexes(steps))}")
+            for step in scans:
+                print(f"    {step}")
+            failures += bool(scans)
+
+    if failures:
+        print(f"{failures} queries scan a whole table")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Shared helpers for the benchmark scripts.
+
+Every benchmark runs against a throwaway SQLite database so the numbers are
+not polluted by whatever is in `enkryptchan.db`.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, models, security
+from app.database import create_database_engine
+from app.logger import logger
+from app.sessions import SessionStore
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# benchmarks would otherwise spend most of their time logging
+logger.setLevel(logging.WARNING)
+
+
+@contextmanager
+def fresh_database_url():
+    """Yields the url of a brand new, empty SQLite database file."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yield f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+
+
+@contextmanager
+def fresh_session_factory():
+    """Yields a session factory bound to a brand new SQLite database with the schema."""
+    with fresh_database_url() as database_url:
+        engine = create_database_engine(database_url)
+        models.Base.metadata.create_all(bind=engine)
+        try:
+            yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        finally:
+            engine.dispose()
+
+
+@contextmanager
+def fresh_session():
+    """Yields a session bound to a brand new SQLite database file."""
+    with fresh_session_factory() as session_factory:
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def seed_conversations(db, owner: str, contacts: int, messages_per_contact: int):
+    """Creates `owner` plus `contacts` users who each exchanged messages with them."""
+    db.add(models.User(username=owner, name=owner.title(), hashed_password="x"))
+    users, messages = [], []
+    for i in range(contacts):
+        contact = f"contact{i}"
+        users.append({"username": contact, "name": f"Contact {i}", "hashed_password": "x"})
+        for j in range(messages_per_contact):
+            incoming = j % 2 == 0
+            messages.append(
+                {
+                    "sender": contact if incoming else owner,
+                    "recipient": owner if incoming else contact,
+                    "text": f"message {j} with {contact}",
+                    "timestamp": datetime(
+                        2024, 1, 1, 0, i % 60, j % 60, i % 1000000, tzinfo=timezone.utc
+                    ),
+                    "is_read": not incoming or j < messages_per_contact // 2,
+                }
+            )
+    db.bulk_insert_mappings(models.User, users)
+    db.bulk_insert_mappings(models.Message, messages)
+    db.commit()
+    crud.rebuild_conversation_state(db)
+
+
+def timed(func, repeat: int = 5):
+    """Runs `func` `repeat` times, returns (best seconds, last result)."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def seed_users(database_url: str, count: int, prefix: str = "user"):
+    """Creates `count` users straight in the database, returns their usernames.
+
+    Registration goes through bcrypt, which would dominate any benchmark that
+    needs more than a handful of users, so every user shares one password hash.
+    """
+    engine = create_database_engine(database_url)
+    models.Base.metadata.create_all(bind=engine)
+    usernames = [f"{prefix}{i}" for i in range(count)]
+    password_hash = security.get_password_hash("password")
+    with engine.begin() as connection:
+        connection.execute(
+            models.User.__table__.insert(),
+            [
+                {"username": u, "name": u.title(), "hashed_password": password_hash}
+                for u in usernames
+            ],
+        )
+    engine.dispose()
+    return usernames
+
+
+def access_tokens(database_url: str, usernames):
+    """Logs every user in straight in the database, returns username -> access token."""
+    engine = create_database_engine(database_url)
+    store = SessionStore(session_factory=sessionmaker(bind=engine))
+    tokens = {}
+    for username in usernames:
+        session = store.create(username)
+        tokens[username] = security.create_access_token(
+            username=username, session_id=session.session_id
+        )
+    engine.dispose()
+    return tokens
+
+
+@contextmanager
+def running_server(env: dict, port: int = 8765):
+    """Runs the app under uvicorn in a subprocess, yields its base url."""
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--port", str(port), "--log-level", "warning",
+        ],
+        cwd=BACKEND_DIR,
+        env={**os.environ, **env},
+        # the app logs every request and websocket disconnect to the console
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(f"{base_url}/docs", timeout=1)
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("uvicorn did not start")
+                time.sleep(0.2)
+        yield base_url
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def percentile(values, pct: float):
+    """Nearest-rank percentile of a non empty list."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
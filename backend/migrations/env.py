@@ -0,0 +1,69 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import pool
+
+from app import models
+from app.database import (SQLALCHEMY_DATABASE_URL, create_database_engine,
+                          get_sync_database_url, is_sqlite)
+
+config = context.config
+
+# `app.maintenance` runs migrations with the app's own logging
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    """Keeps autogenerate away from the search indexes, they're raw DDL in `models`."""
+    if reflected and compare_to is None and ("_fts" in name or "_trgm" in name):
+        return False
+    return True
+
+
+def run_migrations_offline() -> None:
+    """Prints the SQL instead of running it (`alembic upgrade head --sql`)."""
+    context.configure(
+        url=get_sync_database_url(SQLALCHEMY_DATABASE_URL),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        # SQLite can't ALTER most things, batch mode rebuilds the table instead
+        render_as_batch=is_sqlite(SQLALCHEMY_DATABASE_URL),
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations(connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        render_as_batch=connection.dialect.name == "sqlite",
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    # `app.maintenance.migrate` hands over its own connection
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        run_migrations(connection)
+        return
+    connectable = create_database_engine(
+        SQLALCHEMY_DATABASE_URL, poolclass=pool.NullPool
+    )
+    with connectable.connect() as connection:
+        run_migrations(connection)
+    connectable.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,53 @@
+"""initial schema
+
+The `users` and `messages` tables exactly as `create_all` made them before
+migrations. Databases created that way are stamped at this revision by
+`python -m app.maintenance migrate` instead of running it.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 20:59:32.794097
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("hashed_password", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("sender", sa.String(), nullable=False),
+        sa.Column("recipient", sa.String(), nullable=False),
+        sa.Column("text", sa.String(), nullable=False),
+        sa.Column("timestamp", sa.String(), nullable=False),
+        sa.Column("is_read", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+    op.create_index("ix_messages_sender", "messages", ["sender"])
+    op.create_index("ix_messages_recipient", "messages", ["recipient"])
+
+
+def downgrade() -> None:
+    op.drop_table("messages")
+    op.drop_table("users")
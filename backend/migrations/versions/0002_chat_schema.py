@@ -0,0 +1,212 @@
+"""chat schema
+
+Everything the app added on top of the baseline tables before it had
+migrations: the message paging indexes, `conversation_state` (filled from
+`messages`), `delivery_cursors`, `auth_sessions` and the full-text search
+indexes. Those releases made them with `create_all` on startup, so a
+database stamped at 0001 may already have some of them; only what is
+missing is created.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 21:02:18.405117
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MESSAGE_INDEXES = (
+    ("ix_messages_sender_recipient_id", ["sender", "recipient", "id"]),
+    ("ix_messages_recipient_id", ["recipient", "id"]),
+)
+
+# the search DDL as of this revision, see `app.models` for the current one
+SQLITE_MESSAGE_PARTICIPANTS = "'u' || hex({row}.sender) || ' u' || hex({row}.recipient)"
+
+SQLITE_MESSAGE_SEARCH_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, participants)
+        VALUES (new.id, new.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="new")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, participants)
+        VALUES ('delete', old.id, old.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="old")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, participants)
+        VALUES ('delete', old.id, old.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="old")});
+        INSERT INTO messages_fts(rowid, text, participants)
+        VALUES (new.id, new.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="new")});
+    END""",
+)
+
+SQLITE_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, participants, content='',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    *SQLITE_MESSAGE_SEARCH_TRIGGERS,
+    """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, name, content='users', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, name)
+        VALUES ('delete', old.id, old.username, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, name)
+        VALUES ('delete', old.id, old.username, old.name);
+        INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name);
+    END""",
+)
+
+# the FTS5 tables start empty next to existing rows
+SQLITE_SEARCH_FILL = (
+    f"""INSERT INTO messages_fts(rowid, text, participants)
+        SELECT id, text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="messages")} FROM messages""",
+    "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+)
+
+POSTGRES_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX IF NOT EXISTS ix_messages_text_fts
+        ON messages USING gin (to_tsvector('simple', text))""",
+    """CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+        ON users USING gin (username gin_trgm_ops)""",
+    """CREATE INDEX IF NOT EXISTS ix_users_name_trgm
+        ON users USING gin (name gin_trgm_ops)""",
+)
+
+# one row per (owner, contact) with the newest message and the owner's unread
+# count, every message seen from both sides and a message to yourself once
+CONVERSATION_STATE_FILL = """
+INSERT INTO conversation_state
+    (owner, contact, last_message_id, last_message, last_message_timestamp, unread_count)
+SELECT owner, contact, id, "text", "timestamp", unread_count
+FROM (
+    SELECT owner, contact, id, "text", "timestamp",
+        SUM(unread) OVER (PARTITION BY owner, contact) AS unread_count,
+        ROW_NUMBER() OVER (PARTITION BY owner, contact ORDER BY id DESC) AS newest
+    FROM (
+        SELECT sender AS owner, recipient AS contact, id, "text", "timestamp", 0 AS unread
+        FROM messages WHERE sender != recipient
+        UNION ALL
+        SELECT recipient, sender, id, "text", "timestamp", CASE WHEN is_read THEN 0 ELSE 1 END
+        FROM messages
+    ) AS sides
+) AS ranked
+WHERE newest = 1
+"""
+
+
+def existing_schema():
+    """Table names and index names per table, empty when printing SQL offline."""
+    if op.get_context().as_sql:
+        return set(), {}
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    indexes = {
+        table: {index["name"] for index in inspector.get_indexes(table)} for table in tables
+    }
+    return tables, indexes
+
+
+def upgrade() -> None:
+    tables, indexes = existing_schema()
+
+    for name, columns in MESSAGE_INDEXES:
+        if name not in indexes.get("messages", ()):
+            op.create_index(name, "messages", columns)
+
+    if "conversation_state" not in tables:
+        op.create_table(
+            "conversation_state",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("owner", sa.String(), nullable=False),
+            sa.Column("contact", sa.String(), nullable=False),
+            sa.Column("last_message_id", sa.Integer(), nullable=False),
+            sa.Column("last_message", sa.String(), nullable=True),
+            sa.Column("last_message_timestamp", sa.String(), nullable=True),
+            sa.Column("unread_count", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("id"),
+            sa.UniqueConstraint(
+                "owner", "contact", name="uq_conversation_state_owner_contact"
+            ),
+        )
+        op.create_index("ix_conversation_state_id", "conversation_state", ["id"])
+        op.create_index(
+            "ix_conversation_state_owner_timestamp",
+            "conversation_state",
+            ["owner", "last_message_timestamp"],
+        )
+        op.execute(CONVERSATION_STATE_FILL)
+
+    if "delivery_cursors" not in tables:
+        op.create_table(
+            "delivery_cursors",
+            sa.Column("username", sa.String(), nullable=False),
+            sa.Column("last_delivered_id", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("username"),
+        )
+
+    if "auth_sessions" not in tables:
+        op.create_table(
+            "auth_sessions",
+            sa.Column("id", sa.String(), nullable=False),
+            sa.Column("username", sa.String(), nullable=False),
+            sa.Column("refresh_token_hash", sa.String(), nullable=False),
+            sa.Column("previous_refresh_token_hash", sa.String(), nullable=True),
+            sa.Column("rotated_at", sa.Integer(), nullable=False),
+            sa.Column("expires_at", sa.Integer(), nullable=False),
+            sa.Column("revoked", sa.Boolean(), nullable=False),
+            sa.PrimaryKeyConstraint("id"),
+            sa.UniqueConstraint("refresh_token_hash"),
+        )
+        op.create_index("ix_auth_sessions_username", "auth_sessions", ["username"])
+        op.create_index(
+            "ix_auth_sessions_previous_refresh_token_hash",
+            "auth_sessions",
+            ["previous_refresh_token_hash"],
+        )
+
+    # FTS5 tables and triggers on SQLite, GIN indexes on postgres
+    dialect = op.get_context().dialect.name
+    if dialect == "sqlite":
+        for statement in SQLITE_SEARCH_DDL:
+            op.execute(statement)
+        if "messages_fts" not in tables:
+            for statement in SQLITE_SEARCH_FILL:
+                op.execute(statement)
+    elif dialect == "postgresql":
+        for statement in POSTGRES_SEARCH_DDL:
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == "sqlite":
+        # the triggers belong to `messages` and `users`, which stay
+        for table in ("messages", "users"):
+            for event in ("insert", "delete", "update"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{event}")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
+        op.execute("DROP TABLE IF EXISTS users_fts")
+    elif dialect == "postgresql":
+        for name in ("ix_messages_text_fts", "ix_users_username_trgm", "ix_users_name_trgm"):
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+    op.drop_table("auth_sessions")
+    op.drop_table("delivery_cursors")
+    op.drop_table("conversation_state")
+    for name, _ in reversed(MESSAGE_INDEXES):
+        op.drop_index(name, table_name="messages")
@@ -0,0 +1,168 @@
+"""timezone-aware message timestamps
+
+`messages.timestamp` and `conversation_state.last_message_timestamp` go from
+ISO 8601 strings to `timestamptz` on postgres and naive UTC DATETIME text on
+SQLite, what `models.UTCDateTime` reads and writes.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 21:04:10.512934
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, primary key, timestamp column)
+TIMESTAMP_COLUMNS = (
+    ("messages", "id", "timestamp"),
+    ("conversation_state", "id", "last_message_timestamp"),
+)
+# rows converted per UPDATE round trip on SQLite
+BATCH_SIZE = 10000
+# indexes over a timestamp column, rebuilt around the SQLite column swap
+TIMESTAMP_INDEXES = (
+    ("ix_conversation_state_owner_timestamp", "conversation_state", ["owner", "last_message_timestamp"]),
+)
+
+# SQLite recreates `messages` for the swap and loses its search triggers, as
+# they were created in 0002
+SQLITE_MESSAGE_PARTICIPANTS = "'u' || hex({row}.sender) || ' u' || hex({row}.recipient)"
+SQLITE_MESSAGE_SEARCH_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, participants)
+        VALUES (new.id, new.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="new")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, participants)
+        VALUES ('delete', old.id, old.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="old")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, participants)
+        VALUES ('delete', old.id, old.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="old")});
+        INSERT INTO messages_fts(rowid, text, participants)
+        VALUES (new.id, new.text, {SQLITE_MESSAGE_PARTICIPANTS.format(row="new")});
+    END""",
+)
+
+
+def parse_timestamp(value):
+    """The stored ISO string as naive UTC, strings without an offset were UTC."""
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def format_timestamp(value):
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc).isoformat()
+
+
+def convert_sqlite_rows(table_name: str, key: str, source, target, convert):
+    """Fills the `target` column from `source` in key order, `BATCH_SIZE` rows per statement."""
+    bind = op.get_bind()
+    table = sa.table(table_name, sa.column(key, sa.Integer), source, target)
+    update = (
+        sa.update(table)
+        .where(table.c[key] == sa.bindparam("_key"))
+        .values({target.name: sa.bindparam("_value")})
+    )
+    last_key = 0
+    while True:
+        rows = bind.execute(
+            sa.select(table.c[key], table.c[source.name])
+            .where(table.c[key] > last_key)
+            .order_by(table.c[key])
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        bind.execute(
+            update, [{"_key": row[0], "_value": convert(row[1])} for row in rows]
+        )
+        last_key = rows[-1][0]
+
+
+def retype_sqlite_column(table_name: str, key: str, column: str, convert, source_type, target_type):
+    """Moves one column to a new type through a scratch column.
+
+    A batch `alter_column` copies the values with CAST, which turns an ISO
+    string into its leading year under DATETIME's numeric affinity.
+    """
+    scratch = f"{column}_new"
+    nullable = table_name != "messages"
+    op.add_column(table_name, sa.Column(scratch, target_type, nullable=True))
+    convert_sqlite_rows(
+        table_name, key, sa.column(column, source_type), sa.column(scratch, target_type), convert
+    )
+    # recreates the table, its triggers are not copied
+    with op.batch_alter_table(table_name) as batch_op:
+        batch_op.drop_column(column)
+        batch_op.alter_column(
+            scratch, new_column_name=column, existing_type=target_type, nullable=nullable
+        )
+
+
+def upgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == "postgresql":
+        # strings without an offset were written as UTC
+        op.execute("SET LOCAL TIME ZONE 'UTC'")
+        for table_name, _, column in TIMESTAMP_COLUMNS:
+            op.alter_column(
+                table_name,
+                column,
+                type_=sa.DateTime(timezone=True),
+                existing_type=sa.String(),
+                postgresql_using=f'"{column}"::timestamptz',
+            )
+    else:
+        for name, table_name, _ in TIMESTAMP_INDEXES:
+            op.drop_index(name, table_name=table_name)
+        for table_name, key, column in TIMESTAMP_COLUMNS:
+            retype_sqlite_column(
+                table_name, key, column, parse_timestamp, sa.String(), sa.DateTime()
+            )
+        for name, table_name, columns in TIMESTAMP_INDEXES:
+            op.create_index(name, table_name, columns)
+        for statement in SQLITE_MESSAGE_SEARCH_TRIGGERS:
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == "postgresql":
+        for table_name, _, column in TIMESTAMP_COLUMNS:
+            op.alter_column(
+                table_name,
+                column,
+                type_=sa.String(),
+                existing_type=sa.DateTime(timezone=True),
+                postgresql_using=(
+                    f"""to_char("{column}" AT TIME ZONE 'UTC', """
+                    """'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"')"""
+                ),
+            )
+    else:
+        for name, table_name, _ in TIMESTAMP_INDEXES:
+            op.drop_index(name, table_name=table_name)
+        for table_name, key, column in TIMESTAMP_COLUMNS:
+            retype_sqlite_column(
+                table_name, key, column, format_timestamp, sa.DateTime(), sa.String()
+            )
+        for name, table_name, columns in TIMESTAMP_INDEXES:
+            op.create_index(name, table_name, columns)
+        for statement in SQLITE_MESSAGE_SEARCH_TRIGGERS:
+            op.execute(statement)
@@ -0,0 +1,49 @@
+"""message archive
+
+`message_archive` holds read messages the retention job moved out of
+`messages`, as zlib-compressed JSON chunks, see `app.retention`.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 23:12:47.208315
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "message_archive",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_a", sa.String(), nullable=False),
+        sa.Column("user_b", sa.String(), nullable=False),
+        sa.Column("first_message_id", sa.Integer(), nullable=False),
+        sa.Column("last_message_id", sa.Integer(), nullable=False),
+        sa.Column("last_timestamp", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("message_count", sa.Integer(), nullable=False),
+        sa.Column("payload", sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_message_archive_conversation",
+        "message_archive",
+        ["user_a", "user_b", "last_message_id"],
+    )
+    op.create_index(
+        "ix_message_archive_last_timestamp", "message_archive", ["last_timestamp"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_message_archive_last_timestamp", table_name="message_archive")
+    op.drop_index("ix_message_archive_conversation", table_name="message_archive")
+    op.drop_table("message_archive")
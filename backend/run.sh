@@ -1 +1 @@
-uvicorn app.main:app --host 0.0.0 --port 8000 --reload
+python -m app.maintenance migrate && uvicorn app.main:app --host 0.0.0 --port 8000 --reload
@@ -0,0 +1,117 @@
+from datetime import timedelta
+
+import pytest
+
+from app import crud, models, schemas
+
+
+def add_users(db, *usernames):
+    for username in usernames:
+        crud.create_user(
+            db,
+            schemas.UserCreate(username=username, name=username.title(), password="unused"),
+            hashed_password="x",
+        )
+
+
+def send(db, *messages):
+    """(sender, recipient, text) tuples, one minute apart. Returns the ids."""
+    start = models.utcnow() - timedelta(days=1)
+    rows = crud.create_messages(
+        db,
+        [
+            schemas.MessageCreate(
+                sender=sender,
+                recipient=recipient,
+                text=text,
+                timestamp=start + timedelta(minutes=index),
+            )
+            for index, (sender, recipient, text) in enumerate(messages)
+        ],
+    )
+    return [row.id for row in rows]
+
+
+@pytest.fixture
+def chat(db):
+    """alice and bob with 25 messages, carol with one message to alice."""
+    add_users(db, "alice", "bob", "carol")
+    ids = send(
+        db,
+        *[
+            ("alice", "bob", f"message {index}") if index % 2 else ("bob", "alice", f"message {index}")
+            for index in range(25)
+        ],
+        ("carol", "alice", "lunch tomorrow?"),
+    )
+    return ids
+
+
+def test_conversations_summarise_each_contact(db, chat):
+    conversations = crud.get_conversations(db, "alice")
+
+    # newest first
+    assert [row["username"] for row in conversations] == ["carol", "bob"]
+    carol, bob = conversations
+    assert carol["last_message"] == "lunch tomorrow?"
+    assert carol["unread_count"] == 1
+    assert bob["last_message"] == "message 24"
+    assert bob["unread_count"] == 13
+    assert bob["last_message_timestamp"].tzinfo is not None
+
+
+def test_read_receipt_updates_unread_count(db, chat):
+    changed = crud.mark_messages_read_up_to(db, "alice", "bob", chat[9])
+
+    assert changed == 5
+    assert crud.get_conversation(db, "alice", "bob")["unread_count"] == 8
+    # the other side's counter is untouched
+    assert crud.get_conversation(db, "bob", "alice")["unread_count"] == 12
+
+
+def test_history_pages_walk_the_conversation(db, chat):
+    conversation_ids = chat[:25]
+
+    newest = crud.get_message_history_page(db, "alice", "bob", limit=10)
+    assert [row.id for row in newest] == conversation_ids[-10:]
+
+    seen, before_id = [], None
+    while True:
+        page = crud.get_message_history_page(db, "bob", "alice", limit=7, before_id=before_id)
+        if not page:
+            break
+        seen = [row.id for row in page] + seen
+        before_id = page[0].id
+    assert seen == conversation_ids
+
+    seen, after_id = [], 0
+    while True:
+        page = crud.get_message_history_page(db, "alice", "bob", limit=7, after_id=after_id)
+        if not page:
+            break
+        seen += [row.id for row in page]
+        after_id = page[-1].id
+    assert seen == conversation_ids
+
+
+def test_search_only_returns_own_messages(db, chat):
+    assert [row.text for row in crud.search_messages(db, "alice", "lunch")] == ["lunch tomorrow?"]
+    assert crud.search_messages(db, "bob", "lunch") == []
+    assert crud.search_messages(db, "alice", "lunch", contact_username="bob") == []
+
+    matches = crud.search_messages(db, "bob", "message 7")
+    assert matches[0].text == "message 7"
+    assert {row.sender for row in matches} <= {"alice", "bob"}
+
+
+def test_archived_messages_stay_in_history(db, chat):
+    crud.mark_all_messages_as_read(db, "bob", "alice")
+    crud.mark_all_messages_as_read(db, "alice", "bob")
+    before = [tuple(row) for row in crud.get_message_history(db, "alice", "bob")]
+
+    moved = crud.archive_messages_batch(db, "alice", "bob", below_id=chat[24], limit=100, up_to_id=chat[20])
+
+    assert moved == 20
+    assert [tuple(row) for row in crud.get_message_history(db, "alice", "bob")] == before
+    page = crud.get_message_history_page(db, "alice", "bob", limit=10, before_id=chat[20])
+    assert [row.id for row in page] == chat[10:20]
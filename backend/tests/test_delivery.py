@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import WebSocketDisconnect
+from sqlalchemy.orm import sessionmaker
+from starlette.websockets import WebSocketState
+
+from app import models
+from app.delivery import DeliveryTracker, message_event
+from app.websocket import Connection
+
+from test_crud import add_users, send
+
+
+class RecordingConnection:
+    def __init__(self, username: str):
+        self.username = username
+        self.events = []
+
+    async def send(self, frame, message_id=None, completes_catch_up=False):
+        self.events.append(json.loads(frame.payload))
+
+
+class DroppingSocket:
+    """Takes `frames` frames, then the device goes away."""
+
+    def __init__(self, frames: int):
+        self.frames = frames
+        self.sent = []
+        self.client_state = WebSocketState.CONNECTED
+
+    async def send_text(self, data):
+        if len(self.sent) == self.frames:
+            self.client_state = WebSocketState.DISCONNECTED
+            raise ConnectionResetError("gone")
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+async def forget(connection, code):
+    pass
+
+
+@pytest.fixture
+def tracker(migrated):
+    return DeliveryTracker(batch_size=2, session_factory=sessionmaker(bind=migrated))
+
+
+@pytest.mark.anyio
+async def test_catch_up_completes_on_the_first_connection(db, tracker):
+    add_users(db, "alice", "bob")
+    ids = send(db, ("bob", "alice", "before the first connection"))
+
+    connection = RecordingConnection("alice")
+    await tracker.catch_up(connection)
+
+    # the history is loaded over HTTP, nothing is replayed
+    assert connection.events == [
+        {"type": "catch_up_complete", "data": {"last_id": ids[-1]}}
+    ]
+
+
+@pytest.mark.anyio
+async def test_catch_up_replays_what_was_missed(db, tracker):
+    add_users(db, "alice", "bob")
+    await tracker.catch_up(RecordingConnection("alice"))
+    ids = send(db, *[("bob", "alice", f"missed {index}") for index in range(3)])
+
+    connection = RecordingConnection("alice")
+    await tracker.catch_up(connection)
+
+    assert [event["data"]["id"] for event in connection.events[:-1]] == ids
+    assert connection.events[-1] == {"type": "catch_up_complete", "data": {"last_id": ids[-1]}}
+
+
+@pytest.mark.anyio
+async def test_socket_dropping_mid_catch_up_gets_the_whole_replay_again(db, tracker):
+    add_users(db, "alice", "bob")
+    await tracker.catch_up(RecordingConnection("alice"))
+    missed = send(db, *[("bob", "alice", f"missed {index}") for index in range(5)])
+    [live] = send(db, ("bob", "alice", "sent while catching up"))
+
+    socket = DroppingSocket(frames=2)
+    connection = Connection(socket, "alice", on_close=forget, on_delivered=tracker.delivered)
+    connection.start()
+    # live fan-out reaches the socket before the replay does
+    connection.enqueue(message_event(db.get(models.Message, live)), live)
+    try:
+        await tracker.catch_up(connection)
+    except WebSocketDisconnect:
+        # the socket died before the whole replay was queued
+        pass
+    while not connection.closed:
+        await asyncio.sleep(0.01)
+    assert [event["data"]["id"] for event in socket.sent] == [live, missed[0]]
+    await tracker.flush()
+
+    reconnected = RecordingConnection("alice")
+    await tracker.catch_up(reconnected)
+
+    assert [event["data"]["id"] for event in reconnected.events[:-1]] == missed + [live]
+    assert reconnected.events[-1]["data"] == {"last_id": live}
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+
+
+def test_importing_the_app_modules_leaves_logging_alone():
+    # what a spawned password hasher worker does, it must not open (or
+    # truncate) the server's log file
+    script = (
+        "import app.security, app.logger as log\n"
+        "assert log.listener is None, 'listener started on import'\n"
+        "assert not log.logger.handlers, log.logger.handlers\n"
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=BACKEND, check=True)
+
+
+def test_log_file_is_appended_to(tmp_path):
+    from app.logger import build_handlers
+
+    path = tmp_path / "logs" / "app.log"
+    path.parent.mkdir()
+    path.write_text("earlier run\n")
+    for handler in build_handlers(path=str(path)):
+        handler.close()
+
+    assert path.read_text() == "earlier run\n"
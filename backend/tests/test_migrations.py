@@ -0,0 +1,143 @@
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, maintenance, models
+
+# the tables as the app created them before it had migrations
+baseline = sa.MetaData()
+sa.Table(
+    "users",
+    baseline,
+    sa.Column("id", sa.Integer, primary_key=True, index=True),
+    sa.Column("username", sa.String, unique=True, index=True, nullable=False),
+    sa.Column("name", sa.String, nullable=False),
+    sa.Column("hashed_password", sa.String, nullable=False),
+)
+sa.Table(
+    "messages",
+    baseline,
+    sa.Column("id", sa.Integer, primary_key=True, index=True),
+    sa.Column("sender", sa.String, index=True, nullable=False),
+    sa.Column("recipient", sa.String, index=True, nullable=False),
+    sa.Column("text", sa.String, nullable=False),
+    sa.Column("timestamp", sa.String, nullable=False),
+    sa.Column("is_read", sa.Boolean, nullable=False),
+)
+
+BASELINE_MESSAGES = [
+    (1, "alice", "bob", "hello there", "2026-01-01T10:00:00.123456+00:00", True),
+    (2, "bob", "alice", "general kenobi", "2026-01-01T10:01:00+00:00", False),
+    (3, "bob", "alice", "you are a bold one", "2026-01-01T12:02:00+02:00", False),
+    (4, "carol", "alice", "hi alice", "2026-01-01T10:03:00+00:00", True),
+]
+
+
+def head_revision() -> str:
+    return ScriptDirectory.from_config(maintenance.alembic_config()).get_current_head()
+
+
+def schema_differences(engine):
+    """What autogenerate would change to match the models, the raw search DDL aside."""
+
+    def include_object(obj, name, type_, reflected, compare_to):
+        return not (reflected and compare_to is None and ("_fts" in name or "_trgm" in name))
+
+    with engine.connect() as connection:
+        context = MigrationContext.configure(
+            connection, opts={"include_object": include_object}
+        )
+        return compare_metadata(context, models.Base.metadata)
+
+
+def create_baseline(engine):
+    baseline.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            baseline.tables["users"].insert(),
+            [
+                {"id": index, "username": name, "name": name.title(), "hashed_password": "x"}
+                for index, name in enumerate(("alice", "bob", "carol"), start=1)
+            ],
+        )
+        connection.execute(
+            baseline.tables["messages"].insert(),
+            [
+                dict(zip(("id", "sender", "recipient", "text", "timestamp", "is_read"), row))
+                for row in BASELINE_MESSAGES
+            ],
+        )
+        if engine.dialect.name == "postgresql":
+            # the ids were given explicitly
+            connection.execute(
+                sa.text("SELECT setval('messages_id_seq', (SELECT max(id) FROM messages))")
+            )
+
+
+def test_migrate_fresh_database(engine):
+    maintenance.migrate(engine)
+
+    assert maintenance.pending_migrations(engine) == []
+    assert schema_differences(engine) == []
+
+
+def test_migrate_baseline_database(engine):
+    create_baseline(engine)
+
+    maintenance.migrate(engine)
+
+    with engine.connect() as connection:
+        version = connection.execute(sa.text("SELECT version_num FROM alembic_version")).scalar()
+    assert version == head_revision()
+    assert schema_differences(engine) == []
+
+    db = sessionmaker(bind=engine)()
+    try:
+        conversations = {
+            row["username"]: row for row in crud.get_conversations(db, "alice")
+        }
+        assert conversations["bob"]["last_message"] == "you are a bold one"
+        assert conversations["bob"]["unread_count"] == 2
+        assert conversations["carol"]["unread_count"] == 0
+        assert crud.get_conversations(db, "bob")[0]["unread_count"] == 0
+
+        history = crud.get_message_history(db, "alice", "bob")
+        assert [message.id for message in history] == [1, 2, 3]
+        # offsets are kept as the same instant in UTC
+        assert history[0].timestamp == datetime(2026, 1, 1, 10, 0, 0, 123456, tzinfo=timezone.utc)
+        assert history[2].timestamp == datetime(2026, 1, 1, 10, 2, tzinfo=timezone.utc)
+
+        # the search indexes cover the rows written before them
+        assert [row.id for row in crud.search_messages(db, "alice", "kenobi")] == [2]
+        assert [user.username for user in crud.search_users(db, "aro")] == ["carol"]
+    finally:
+        db.close()
+
+
+def test_migrations_downgrade_to_baseline_and_back(engine):
+    maintenance.migrate(engine)
+
+    with engine.begin() as connection:
+        command.downgrade(maintenance.alembic_config(connection), "0001")
+    tables = set(sa.inspect(engine).get_table_names())
+    assert tables == {"alembic_version", "users", "messages"}
+    # nothing left behind that writes to the dropped search tables
+    with engine.begin() as connection:
+        connection.execute(
+            baseline.tables["messages"].insert(),
+            {
+                "sender": "alice",
+                "recipient": "bob",
+                "text": "still works",
+                "timestamp": "2026-01-01T10:00:00+00:00",
+                "is_read": False,
+            },
+        )
+
+    maintenance.migrate(engine)
+    assert maintenance.pending_migrations(engine) == []
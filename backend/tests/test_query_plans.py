@@ -0,0 +1,41 @@
+import pytest
+
+from benchmarks.check_query_plans import (full_scans, hot_queries,
+                                          plan_steps, seed, used_indexes)
+
+
+@pytest.fixture
+def seeded(db):
+    if db.get_bind().dialect.name != "sqlite":
+        pytest.skip("EXPLAIN QUERY PLAN is SQLite's")
+    seed(db)
+    return db.get_bind()
+
+
+def test_hot_queries_use_indexes(seeded):
+    steps = {label: plan_steps(seeded, run) for label, run in hot_queries()}
+
+    assert all(steps.values()), "a query executed no statements"
+    scans = {label: full_scans(label_steps) for label, label_steps in steps.items()}
+    assert {label: found for label, found in scans.items() if found} == {}
+
+
+# the queries a (recipient, is_read) index would have served, answered by
+# the `conversation_state` counters and the conversation index instead
+UNREAD_QUERY_INDEXES = {
+    "conversation list": "ix_conversation_state_owner_timestamp",
+    "one conversation": "sqlite_autoindex_conversation_state_1",
+    "mark read up to": "ix_messages_sender_recipient_id",
+    "mark all read": "ix_messages_sender_recipient_id",
+}
+
+
+def test_unread_queries_use_the_conversation_indexes(seeded):
+    queries = dict(hot_queries())
+
+    used = {
+        label: used_indexes(plan_steps(seeded, queries[label])) for label in UNREAD_QUERY_INDEXES
+    }
+
+    for label, index in UNREAD_QUERY_INDEXES.items():
+        assert index in used[label], (label, used[label])
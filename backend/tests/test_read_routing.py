@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from app import database
+from app.database import RecentWriters
+
+
+def test_writes_are_announced_at_most_every_half_window():
+    writers = RecentWriters(window=60)
+
+    assert writers.wrote("alice")
+    assert writers.recent("alice")
+    # the other workers still have most of the first window
+    assert not writers.wrote("alice")
+    assert not writers.recent("bob")
+
+
+@pytest.mark.anyio
+async def test_announced_writes_open_the_window_on_other_workers(monkeypatch):
+    other_worker = RecentWriters(window=60)
+    monkeypatch.setattr(database, "recent_writers", other_worker)
+
+    assert await database.on_recent_writers(json.dumps(["alice", "bob"]))
+
+    assert other_worker.recent("alice") and other_worker.recent("bob")
+    assert not other_worker.recent("carol")
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app import models, sessions
+from app.sessions import RefreshTokenRaced, RefreshTokenReplayed, SessionStore
+
+
+@pytest.fixture
+def store(migrated):
+    return SessionStore(session_factory=sessionmaker(bind=migrated))
+
+
+@pytest.mark.anyio
+async def test_rotated_token_is_a_race_within_the_grace_period(store):
+    first = store.create("alice")
+    second = store.rotate(first.refresh_token)
+
+    with pytest.raises(RefreshTokenRaced):
+        store.rotate(first.refresh_token)
+    # the session survives, the winner's token keeps working
+    assert await store.is_active(first.session_id)
+    assert store.rotate(second.refresh_token) is not None
+
+
+@pytest.mark.anyio
+async def test_replayed_token_revokes_the_session(store, monkeypatch):
+    first = store.create("alice")
+    store.rotate(first.refresh_token)
+    monkeypatch.setattr(sessions, "REFRESH_REUSE_GRACE_SECONDS", -1)
+
+    with pytest.raises(RefreshTokenReplayed) as replayed:
+        store.rotate(first.refresh_token)
+
+    assert replayed.value.session_id == first.session_id
+    assert not await store.is_active(first.session_id)
+
+
+def test_unknown_token_is_invalid(store):
+    assert store.rotate("not a token") is None
+
+
+def test_purge_expired_sessions(store, db):
+    expired = store.create("alice")
+    active = store.create("bob")
+    db.query(models.AuthSession).filter_by(id=expired.session_id).update(
+        {"expires_at": int(time.time()) - 1}
+    )
+    db.commit()
+
+    assert store.purge_expired(limit=10) == 1
+    assert [row.id for row in db.query(models.AuthSession)] == [active.session_id]
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from fastapi import WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+from app.websocket import SLOW_CONSUMER_CLOSE_CODE, Connection
+from app.wire import Frame
+
+
+class StalledSocket:
+    """Never gets to send anything."""
+
+    client_state = WebSocketState.DISCONNECTED
+
+
+async def forget(connection, code):
+    pass
+
+
+def frame(index: int) -> Frame:
+    return Frame.from_event({"type": "message", "data": {"id": index}})
+
+
+@pytest.mark.anyio
+async def test_send_waiting_for_room_fails_when_the_socket_closes():
+    connection = Connection(StalledSocket(), "alice", on_close=forget, queue_size=1)
+    await connection.send(frame(1))
+
+    waiting = asyncio.create_task(connection.send(frame(2)))
+    await asyncio.sleep(0)
+    assert not waiting.done()
+
+    await connection.close(SLOW_CONSUMER_CLOSE_CODE)
+    with pytest.raises(WebSocketDisconnect) as closed:
+        await asyncio.wait_for(waiting, 1)
+    assert closed.value.code == SLOW_CONSUMER_CLOSE_CODE
+
+    with pytest.raises(WebSocketDisconnect):
+        await connection.send(frame(3))
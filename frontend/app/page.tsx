@@ -27,6 +27,11 @@ export default function Home() {
 		saveUserToLocalStorage(userData);
 	};
 
+	const handleUserUpdate = (userData: User) => {
+		setUser(userData);
+		saveUserToLocalStorage(userData);
+	};
+
 	const handleLogout = () => {
 		setUser(null);
 		removeUserFromLocalStorage();
@@ -49,5 +54,11 @@ export default function Home() {
 		return <LoginRegister onLogin={handleLogin} />;
 	}
 
-	return <ChatLayout user={user} onLogout={handleLogout} />;
+	return (
+		<ChatLayout
+			user={user}
+			onUserUpdate={handleUserUpdate}
+			onLogout={handleLogout}
+		/>
+	);
 }
@@ -5,29 +5,75 @@ import ChatHeader from "@/components/chat-header";
 import ChatWindow from "@/components/chat-window";
 import ContactList from "@/components/contact-list";
 import ProfileModal from "@/components/profile-modal";
+import { refreshSession } from "@/lib/auth";
 import { API_URL, WS_URL } from "@/lib/config";
 import type { Contact, Message, User } from "@/types";
 import ChatWelcome from "./chat-welcome";
 
 interface ChatLayoutProps {
 	user: User;
+	onUserUpdate: (user: User) => void;
 	onLogout: () => void;
 }
 
-export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
+// the server closes sockets whose access token expired or whose session ended
+const AUTH_EXPIRED_CLOSE_CODE = 4001;
+const POLICY_VIOLATION_CLOSE_CODE = 1008;
+// history is loaded newest first, a page at a time, older pages on scroll up
+const MESSAGE_PAGE_SIZE = 50;
+// the server's largest page
+const MESSAGE_PAGE_MAX = 200;
+
+export default function ChatLayout({
+	user,
+	onUserUpdate,
+	onLogout,
+}: ChatLayoutProps) {
 	const [selectedContact, setSelectedContact] = useState<Contact | null>(null);
 	const selectedContactRef = useRef<Contact | null>(null);
 	const [contacts, setContacts] = useState<Contact[]>([]);
 	const [messages, setMessages] = useState<Message[]>([]);
+	const [hasOlderMessages, setHasOlderMessages] = useState(false);
+	const loadingOlderRef = useRef(false);
 	const [isProfileOpen, setIsProfileOpen] = useState(false);
 	const [isConnected, setIsConnected] = useState(false);
 	const [isLoading, setIsLoading] = useState(true);
 	const wsRef = useRef<WebSocket | null>(null);
+	// the socket handlers outlive renders, they read the current tokens from here
+	const userRef = useRef<User>(user);
 
 	useEffect(() => {
 		selectedContactRef.current = selectedContact;
 	}, [selectedContact]);
 
+	useEffect(() => {
+		userRef.current = user;
+	}, [user]);
+
+	// access tokens are short-lived, trade the refresh token for a new one
+	const renewSession = async (): Promise<User | null> => {
+		const refreshed = await refreshSession(userRef.current);
+		if (refreshed) {
+			userRef.current = refreshed;
+			onUserUpdate(refreshed);
+		} else {
+			onLogout();
+		}
+		return refreshed;
+	};
+
+	const authFetch = async (url: string, init: RequestInit = {}) => {
+		const send = (token: string) =>
+			fetch(url, {
+				...init,
+				headers: { ...init.headers, Authorization: `Bearer ${token}` },
+			});
+		const response = await send(userRef.current.token);
+		if (response.status !== 401) return response;
+		const refreshed = await renewSession();
+		return refreshed ? send(refreshed.token) : response;
+	};
+
 	useEffect(() => {
 		console.log("useEffect");
 		console.log(user);
@@ -43,7 +89,11 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 
 	// TODO: fix why websocket gets disconnected, make sure only one websocket request is made and it stays stable
 	const connectWebSocket = () => {
-		const ws = new WebSocket(`${WS_URL}/ws?token=${user.token}`);
+		// same JSON either way, "orjson" frames are encoded by the server's fast path
+		const ws = new WebSocket(`${WS_URL}/ws?token=${userRef.current.token}`, [
+			"orjson",
+			"json",
+		]);
 		wsRef.current = ws;
 
 		ws.onopen = () => {
@@ -55,7 +105,13 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 			try {
 				const eventData = JSON.parse(event.data);
 
-				if (eventData.type === "message") {
+				if (eventData.type === "reauth_required") {
+					renewSession().then((refreshed) => {
+						if (refreshed && ws.readyState === WebSocket.OPEN) {
+							ws.send(JSON.stringify({ type: "auth", token: refreshed.token }));
+						}
+					});
+				} else if (eventData.type === "message") {
 					const newMessage: Message = eventData.data;
 
 					const contactUsername =
@@ -89,9 +145,20 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 
 						const existingContact = prevContacts[contactIndex];
 						const isOwnMessage = newMessage.sender === user.username;
+						const messageId = Number(newMessage.id);
+
+						// already counted, a reconnect catch-up replays messages
+						// the contact list (or an earlier event) has seen
+						if (
+							existingContact.last_message_id != null &&
+							messageId <= existingContact.last_message_id
+						) {
+							return prevContacts;
+						}
 
 						const updatedContact: Contact = {
 							...existingContact,
+							last_message_id: messageId,
 							last_message: newMessage.text,
 							last_message_timestamp: newMessage.timestamp,
 							// Only increment unread count for incoming messages
@@ -118,6 +185,18 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 
 						return newContacts;
 					});
+				} else if (eventData.type === "read") {
+					// the contact read our messages up to `up_to_id`
+					const { reader, up_to_id } = eventData.data;
+					if (selectedContactRef.current?.username === reader) {
+						setMessages((prevMessages) =>
+							prevMessages.map((msg) =>
+								msg.recipient === reader && msg.id <= up_to_id && !msg.is_read
+									? { ...msg, is_read: true }
+									: msg,
+							),
+						);
+					}
 				} else if (eventData.type === "conversation_update") {
 					const updatedConversation: Contact = eventData.data;
 					setContacts((prevContacts) => {
@@ -154,6 +233,16 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 		ws.onclose = (event) => {
 			console.log("WebSocket disconnected:", event.code, event.reason);
 			setIsConnected(false);
+			if (wsRef.current !== ws) return;
+			if (
+				event.code === AUTH_EXPIRED_CLOSE_CODE ||
+				event.code === POLICY_VIOLATION_CLOSE_CODE
+			) {
+				renewSession().then((refreshed) => {
+					if (refreshed) connectWebSocket();
+				});
+				return;
+			}
 			setTimeout(connectWebSocket, 3000);
 		};
 
@@ -166,9 +255,7 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 	const fetchContacts = async () => {
 		setIsLoading(true);
 		try {
-			const response = await fetch(`${API_URL}/conversations`, {
-				headers: { Authorization: `Bearer ${user.token}` },
-			});
+			const response = await authFetch(`${API_URL}/conversations`);
 			if (response.ok) {
 				const data: Contact[] = await response.json();
 				setContacts(data);
@@ -181,15 +268,18 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 	};
 
 	const markMessagesAsRead = async (messageId: number | string) => {
+		const contactUsername = selectedContactRef.current?.username;
+		if (!contactUsername) return;
 		try {
-			const response = await fetch(`${API_URL}/messages/read`, {
-				method: "POST",
-				headers: {
-					"Content-Type": "application/json",
-					Authorization: `Bearer ${user.token}`,
+			// one receipt covers every earlier message from the contact too
+			const response = await authFetch(
+				`${API_URL}/conversations/${contactUsername}/read`,
+				{
+					method: "POST",
+					headers: { "Content-Type": "application/json" },
+					body: JSON.stringify({ up_to_id: messageId }),
 				},
-				body: JSON.stringify({ message_id: messageId }),
-			});
+			);
 
 			if (response.ok) {
 				const updatedConversation: Contact = await response.json();
@@ -206,7 +296,9 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 
 			setMessages((prevMessages) =>
 				prevMessages.map((msg) =>
-					msg.id === messageId ? { ...msg, is_read: true } : msg,
+					msg.sender === contactUsername && msg.id <= Number(messageId)
+						? { ...msg, is_read: true }
+						: msg,
 				),
 			);
 		} catch (error) {
@@ -214,23 +306,65 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 		}
 	};
 
-	const fetchMessages = async (contactUsername: string) => {
+	const fetchMessagePage = async (
+		contactUsername: string,
+		limit: number,
+		beforeId?: number | string,
+	): Promise<Message[] | null> => {
+		const params = new URLSearchParams({ limit: String(limit) });
+		if (beforeId !== undefined) params.set("before_id", String(beforeId));
+		const response = await authFetch(
+			`${API_URL}/conversations/${contactUsername}/messages?${params}`,
+		);
+		return response.ok ? response.json() : null;
+	};
+
+	const fetchMessages = async (contact: Contact) => {
+		// the newest page, large enough to reach the first unread message
+		const limit = Math.min(
+			Math.max(MESSAGE_PAGE_SIZE, (contact.unread_count || 0) + 1),
+			MESSAGE_PAGE_MAX,
+		);
 		try {
-			const response = await fetch(
-				`${API_URL}/conversations/${contactUsername}/messages`,
-				{
-					headers: { Authorization: `Bearer ${user.token}` },
-				},
-			);
-			if (response.ok) {
-				const data: Message[] = await response.json();
+			const data = await fetchMessagePage(contact.username, limit);
+			if (data && selectedContactRef.current?.username === contact.username) {
 				setMessages(data);
+				setHasOlderMessages(data.length === limit);
 			}
 		} catch (error) {
 			console.error("Failed to fetch messages:", error);
 		}
 	};
 
+	const fetchOlderMessages = async () => {
+		const contactUsername = selectedContactRef.current?.username;
+		const oldest = messages[0];
+		if (!contactUsername || !oldest || loadingOlderRef.current) return;
+		loadingOlderRef.current = true;
+		try {
+			const data = await fetchMessagePage(
+				contactUsername,
+				MESSAGE_PAGE_SIZE,
+				oldest.id,
+			);
+			// the user may have switched conversations meanwhile
+			if (data && selectedContactRef.current?.username === contactUsername) {
+				setMessages((prevMessages) => {
+					const known = new Set(prevMessages.map((msg) => msg.id));
+					return [
+						...data.filter((msg) => !known.has(msg.id)),
+						...prevMessages,
+					];
+				});
+				setHasOlderMessages(data.length === MESSAGE_PAGE_SIZE);
+			}
+		} catch (error) {
+			console.error("Failed to fetch older messages:", error);
+		} finally {
+			loadingOlderRef.current = false;
+		}
+	};
+
 	const sendMessage = async (text: string) => {
 		if (!selectedContact) return;
 
@@ -246,9 +380,28 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 		}
 	};
 
+	const handleLogout = async () => {
+		const ws = wsRef.current;
+		wsRef.current = null;
+		ws?.close();
+		try {
+			// ends the session server side so its refresh token stops working
+			await fetch(`${API_URL}/logout`, {
+				method: "POST",
+				headers: { Authorization: `Bearer ${userRef.current.token}` },
+			});
+		} catch (error) {
+			console.error("Failed to log out:", error);
+		}
+		onLogout();
+	};
+
 	const handleContactSelect = (contact: Contact) => {
 		setSelectedContact(contact);
-		fetchMessages(contact.username);
+		selectedContactRef.current = contact;
+		setMessages([]);
+		setHasOlderMessages(false);
+		fetchMessages(contact);
 	};
 
 	const handleNewChat = (newContactUser: {
@@ -259,8 +412,7 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 			(c) => c.username === newContactUser.username,
 		);
 		if (existingContact) {
-			setSelectedContact(existingContact);
-			fetchMessages(existingContact.username);
+			handleContactSelect(existingContact);
 		} else {
 			const newContact: Contact = {
 				username: newContactUser.username,
@@ -271,6 +423,7 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 			setContacts((prev) => [newContact, ...prev]);
 			setSelectedContact(newContact);
 			setMessages([]);
+			setHasOlderMessages(false);
 		}
 	};
 
@@ -279,7 +432,7 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 			<ChatHeader
 				user={user}
 				isConnected={isConnected}
-				onLogout={onLogout}
+				onLogout={handleLogout}
 				onProfileOpen={() => setIsProfileOpen(true)}
 			/>
 
@@ -305,6 +458,8 @@ export default function ChatLayout({ user, onLogout }: ChatLayoutProps) {
 							key={selectedContact.username}
 							contact={selectedContact}
 							messages={messages}
+							hasOlderMessages={hasOlderMessages}
+							onLoadOlderMessages={fetchOlderMessages}
 							onSendMessage={sendMessage}
 							user={user}
 							onMarkAsRead={markMessagesAsRead}
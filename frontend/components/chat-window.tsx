@@ -15,6 +15,8 @@ import Separator from "./separator";
 interface ChatWindowProps {
 	contact: Contact;
 	messages: Message[];
+	hasOlderMessages: boolean;
+	onLoadOlderMessages: () => Promise<void>;
 	onSendMessage: (content: string) => void;
 	user: User;
 	onMarkAsRead: (messageId: number | string) => void;
@@ -23,6 +25,8 @@ interface ChatWindowProps {
 export default function ChatWindow({
 	contact,
 	messages,
+	hasOlderMessages,
+	onLoadOlderMessages,
 	onSendMessage,
 	user,
 	onMarkAsRead,
@@ -50,6 +54,29 @@ export default function ChatWindow({
 	const endIntersectionObserver = useIntersectionObserver({
 		threshold: 0.5,
 	});
+	const startIntersectionObserver = useIntersectionObserver({
+		threshold: 0,
+	});
+	const listRef = useRef<HTMLDivElement>(null);
+	// the message that was on top before an older page came in
+	const scrollAnchorIdRef = useRef<number | string | null>(null);
+
+	// INFO: load the previous page when the top of the history comes into view
+	useEffect(() => {
+		if (!startIntersectionObserver.isIntersecting || !hasOlderMessages) return;
+		scrollAnchorIdRef.current = messages[0]?.id ?? null;
+		onLoadOlderMessages();
+	}, [startIntersectionObserver.isIntersecting, hasOlderMessages, messages[0]?.id]);
+
+	// INFO: keep the message that was on top in place when older ones are prepended
+	useEffect(() => {
+		const anchorId = scrollAnchorIdRef.current;
+		if (anchorId === null || messages[0]?.id === anchorId) return;
+		scrollAnchorIdRef.current = null;
+		listRef.current
+			?.querySelector(`[data-message-id="${anchorId}"]`)
+			?.scrollIntoView({ block: "start" });
+	}, [messages[0]?.id]);
 
 	const firstUnreadId = useMemo(() => {
 		if (!messages.length) return null;
@@ -160,7 +187,8 @@ export default function ChatWindow({
 
 			<div className="flex-1 relative min-h-0">
 				<ScrollArea className="h-full p-4">
-					<div className="space-y-4">
+					<div ref={listRef} className="space-y-4">
+						<div ref={startIntersectionObserver.ref} />
 						{Object.entries(groupedMessages).map(([date, dateMessages]) => (
 							<div key={date}>
 								<div className="flex items-center justify-center my-4">
@@ -184,6 +212,7 @@ export default function ChatWindow({
 									return (
 										<div
 											key={message.id}
+											data-message-id={message.id}
 											ref={
 												dividerMessageIdRef.current === message.id
 													? unreadDividerRef
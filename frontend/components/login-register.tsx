@@ -82,6 +82,7 @@ export default function LoginRegister({ onLogin }: LoginRegisterProps) {
 					username: data.username,
 					name: data.name,
 					token: data.access_token,
+					refreshToken: data.refresh_token,
 				});
 			} else {
 				setError("Invalid credentials. Please try again!");
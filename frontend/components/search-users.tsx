@@ -1,5 +1,5 @@
 import { Loader2, Search, Users } from "lucide-react";
-import { useState } from "react";
+import { useRef, useState } from "react";
 import { Avatar, AvatarFallback, AvatarImage } from "@/components/ui/avatar";
 import { Button } from "@/components/ui/button";
 import {
@@ -29,9 +29,12 @@ export default function SearchUsers({ user, onNewChat }: SearchUsersProps) {
 	const [searchQuery, setSearchQuery] = useState("");
 	const [searchResults, setSearchResults] = useState<SearchUser[]>([]);
 	const [isSearching, setIsSearching] = useState(false);
+	// responses can arrive out of order while typing, only the latest one is shown
+	const latestQueryRef = useRef("");
 
 	const handleSearch = async (query: string) => {
 		setSearchQuery(query);
+		latestQueryRef.current = query;
 		if (!query.trim()) {
 			setSearchResults([]);
 			return;
@@ -40,11 +43,12 @@ export default function SearchUsers({ user, onNewChat }: SearchUsersProps) {
 		setIsSearching(true);
 		try {
 			const response = await fetch(
-				`${API_URL}/users/search?username=${encodeURIComponent(query)}`,
+				`${API_URL}/users/search?username=${encodeURIComponent(query)}&limit=20`,
 				{
 					headers: { Authorization: `Bearer ${user.token}` },
 				},
 			);
+			if (latestQueryRef.current !== query) return;
 			if (response.ok) {
 				const users: SearchUser[] = await response.json();
 				setSearchResults(users.filter((u) => u.username !== user.username));
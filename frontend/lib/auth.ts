@@ -1,3 +1,4 @@
+import { API_URL } from "@/lib/config";
 import type { User } from "@/types";
 
 export const saveUserToLocalStorage = (user: User) => {
@@ -20,3 +21,60 @@ export const loadUserFromLocalStorage = (): User | null => {
 export const removeUserFromLocalStorage = () => {
 	localStorage.removeItem("enkrypt-chan-user");
 };
+
+// refresh tokens are single use, concurrent callers share one refresh
+let pendingRefresh: Promise<User | null> | null = null;
+
+export const refreshSession = (user: User): Promise<User | null> => {
+	if (!pendingRefresh) {
+		pendingRefresh = requestRefresh(user).finally(() => {
+			pendingRefresh = null;
+		});
+	}
+	return pendingRefresh;
+};
+
+// the server's answer when another tab rotated the same refresh token a
+// moment ago, that tab saves the new tokens to the shared storage
+const REFRESH_RACED_STATUS = 409;
+const REFRESH_RACE_RETRIES = 5;
+const REFRESH_RACE_RETRY_MS = 200;
+
+const adoptStoredSession = async (user: User): Promise<User | null> => {
+	for (let attempt = 0; attempt < REFRESH_RACE_RETRIES; attempt++) {
+		const stored = loadUserFromLocalStorage();
+		if (
+			stored?.username === user.username &&
+			stored.refreshToken &&
+			stored.refreshToken !== user.refreshToken
+		) {
+			return { ...user, token: stored.token, refreshToken: stored.refreshToken };
+		}
+		await new Promise((resolve) => setTimeout(resolve, REFRESH_RACE_RETRY_MS));
+	}
+	return null;
+};
+
+const requestRefresh = async (user: User): Promise<User | null> => {
+	if (!user.refreshToken) return null;
+	try {
+		const response = await fetch(`${API_URL}/token/refresh`, {
+			method: "POST",
+			headers: { "Content-Type": "application/json" },
+			body: JSON.stringify({ refresh_token: user.refreshToken }),
+		});
+		if (response.status === REFRESH_RACED_STATUS) return adoptStoredSession(user);
+		if (!response.ok) return null;
+		const data = await response.json();
+		const refreshed: User = {
+			...user,
+			token: data.access_token,
+			refreshToken: data.refresh_token,
+		};
+		saveUserToLocalStorage(refreshed);
+		return refreshed;
+	} catch (error) {
+		console.error("Failed to refresh session:", error);
+		return null;
+	}
+};
@@ -2,11 +2,14 @@ export interface User {
 	username: string;
 	name: string;
 	token: string;
+	refreshToken?: string;
 }
 
 export interface Contact {
 	username: string;
 	name: string;
+	// the counters cover every message up to this id
+	last_message_id?: number | null;
 	last_message: string | null;
 	last_message_timestamp: string | null;
 	unread_count: number;